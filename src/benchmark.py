@@ -0,0 +1,337 @@
+"""Performance benchmarks for map loading, movement, menus, combat and saves.
+
+    python src/benchmark.py            compare against the stored baseline
+    python src/benchmark.py --save     store the current timings as the baseline
+    python src/benchmark.py --quick    skip the largest synthetic maps
+
+Exits with status 1 if any benchmark is slower than its baseline by more than the threshold, and with status 2 if
+there is no baseline to compare against (baselines are machine specific, so none is committed).
+"""
+
+import argparse
+import json
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Tuple
+import enemies
+import game_class
+import io_functs
+import main
+import maps
+import chunks
+import render
+import fov
+import rng_streams
+import terminal
+
+BASELINE_PATH: Path = Path(
+    __file__).parent.parent / "benchmarks" / "baseline.json"
+MAP_SIZES: Tuple[int, ...] = (50, 200, 500, 1000, 2000)
+QUICK_MAP_SIZES: Tuple[int, ...] = (50, 200, 500)
+MOVES: int = 20000
+WORLD_MOVES: int = 2000
+FOV_MOVES: int = 2000
+WORLD_SIZES: Tuple[int, ...] = (500, 2000, 5000)
+QUICK_WORLD_SIZES: Tuple[int, ...] = (500, )
+
+
+def generate_rows(size: int, seed: int = 0) -> Iterator[Tuple[str, str]]:
+    """Generates the (map line, map data line) rows of a size x size map with walls around the edge and scattered
+    inside. The start is in the bottom right so get_starting_pos has to scan most of the map"""
+    rng = random.Random(seed)
+    for y in range(size):
+        if y in (0, size - 1):
+            data_line = "#" * size
+        else:
+            inside = "".join("#" if rng.random() < 0.2 else " "
+                             for _ in range(size - 2))
+            data_line = "#" + inside + "#"
+        if y == 1:
+            data_line = "#e" + data_line[2:]
+        if y == size - 2:
+            data_line = data_line[:size - 2] + "S#"
+        yield data_line.replace("e", " ").replace("S", " "), data_line
+
+
+def generate_map(size: int, seed: int = 0) -> Tuple[List[str], List[str]]:
+    """All of the rows of generate_rows"""
+    rows = list(generate_rows(size, seed))
+    return [line for line, _ in rows], [data_line for _, data_line in rows]
+
+
+def _time(func: Callable[[], object], repeat: int = 5) -> float:
+    """Best wall time of `repeat` runs of func"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_map_loading(results: Dict[str, float]):
+    game_dir = Path(__file__).parent.parent
+    map_path = game_dir / "maps" / "cave.map"
+    map_data_path = game_dir / "maps" / "cave.mapdata"
+    results["map.from_files[cave]"] = _time(
+        lambda: maps.Map.from_files(map_path, map_data_path))
+
+    def uncached():
+        maps.clear_cache()
+        maps.Map.from_name("cave")
+
+    results["map.from_name[cave,uncached]"] = _time(uncached)
+    results["map.from_name[cave,cached]"] = _time(
+        lambda: maps.Map.from_name("cave"))
+
+
+def bench_large_maps(results: Dict[str, float], sizes: Tuple[int, ...]):
+    for size in sizes:
+        _map, map_data = generate_map(size)
+        results[f"map.from_list[{size}]"] = _time(
+            lambda: maps.Map.from_list(_map, map_data), repeat=3)
+        loaded = maps.Map.from_list(_map, map_data)
+        results[f"map.get_starting_pos[{size}]"] = _time(
+            loaded.get_starting_pos)
+
+
+def bench_movement(results: Dict[str, float], sizes: Tuple[int, ...]):
+    rng = random.Random(1)
+    keys = [
+        rng.choice(main.DOWN_KEYS + main.UP_KEYS + main.LEFT_KEYS +
+                   main.RIGHT_KEYS) for _ in range(MOVES)
+    ]
+    backend = terminal.MemoryBackend()
+    window = backend.stdscr
+    game = game_class.Game()
+    for size in sizes:
+        loaded = maps.Map.from_list(*generate_map(size))
+        start = loaded.get_starting_pos()
+
+        def walk():
+            pos = list(start)
+            for key in keys:
+                pos = main.find_new_pos(game, loaded, window, key, pos)
+
+        results[f"main.find_new_pos[{size},{MOVES} moves]"] = _time(walk,
+                                                                    repeat=3)
+
+
+def bench_fov(results: Dict[str, float], sizes: Tuple[int, ...]):
+    """Line of sight after every move, without drawing"""
+    rng = random.Random(1)
+    keys = [
+        rng.choice(main.DOWN_KEYS + main.UP_KEYS + main.LEFT_KEYS +
+                   main.RIGHT_KEYS) for _ in range(FOV_MOVES)
+    ]
+    backend = terminal.MemoryBackend()
+    game = game_class.Game()
+    for size in sizes:
+        loaded = maps.Map.from_list(*generate_map(size))
+        start = loaded.get_starting_pos()
+
+        def walk():
+            sight = fov.FieldOfView(loaded)
+            pos = list(start)
+            for key in keys:
+                pos = main.find_new_pos(game, loaded, backend.stdscr, key, pos)
+                sight.update(pos)
+
+        results[f"fov.update[{size},{FOV_MOVES} moves]"] = _time(walk,
+                                                                 repeat=3)
+
+
+def bench_overlays(results: Dict[str, float], size: int):
+    """Making a variant of a big map and changing a few of its cells"""
+    loaded = maps.Map.from_list(*generate_map(size))
+    results[f"map.layered[{size}]"] = _time(loaded.layered)
+    cells = {(y, 1): (" ", " ") for y in range(1, 101)}
+
+    def apply():
+        variant = loaded.layered()
+        variant.apply(maps.TAKEN_LAYER, cells)
+        variant.is_passable((1, 1))
+
+    results[f"map.apply[{size},100 cells]"] = _time(apply)
+
+
+def bench_worlds(results: Dict[str, float], sizes: Tuple[int, ...]):
+    """Opening a chunked world and walking around it in a scrolling view"""
+    rng = random.Random(1)
+    keys = [
+        rng.choice(main.DOWN_KEYS + main.UP_KEYS + main.LEFT_KEYS +
+                   main.RIGHT_KEYS) for _ in range(WORLD_MOVES)
+    ]
+    game = game_class.Game()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in sizes:
+            path = Path(tmp_dir) / f"world{size}.mapw"
+            chunks.write_world(path, generate_rows(size), size, size)
+            backend = terminal.MemoryBackend()
+            previous = terminal.get_backend()
+            terminal.set_backend(backend)
+            try:
+
+                def open_world():
+                    world = chunks.ChunkedMap(path)
+                    renderer = render.ViewportRenderer(world, 0, 0, 25, 85)
+                    renderer.move_player(world.get_starting_pos())
+                    renderer.flush()
+                    world.close()
+
+                def walk():
+                    world = chunks.ChunkedMap(path)
+                    renderer = render.ViewportRenderer(world, 0, 0, 25, 85)
+                    pos = world.get_starting_pos()
+                    for key in keys:
+                        pos = main.find_new_pos(game, world, backend.stdscr,
+                                                key, pos)
+                        renderer.move_player(pos)
+                        renderer.flush()
+                    world.close()
+
+                results[f"chunks.open_world[{size}]"] = _time(open_world)
+                results[f"chunks.walk[{size},{WORLD_MOVES} moves]"] = _time(
+                    walk, repeat=3)
+            finally:
+                terminal.set_backend(previous)
+
+
+def bench_menu(results: Dict[str, float]):
+    for count in (10, 100, 1000):
+        options = [f"Option {num}" for num in range(count)]
+        # Move to the last option and back up to the first before choosing
+        keys = [ord("j")] * count + [ord("k")] * count + [ord("\n")]
+
+        def choose():
+            backend = terminal.MemoryBackend(keys=keys)
+            previous = terminal.get_backend()
+            terminal.set_backend(backend)
+            try:
+                io_functs.menu(options, "Benchmark")
+            finally:
+                terminal.set_backend(previous)
+
+        results[f"io_functs.menu[{count} options]"] = _time(choose, repeat=1)
+
+
+def bench_battle(results: Dict[str, float]):
+    rng_streams.seed(2)
+
+    def fight():
+        game = game_class.Game(3, enemies.Player(10, ["Punch"]))
+        slimes = enemies.slime_wave(5, 20)
+        terminal.run_headless(
+            lambda stdscr: main.battle_menu(slimes, game, stdscr),
+            [" "] * 5000)
+
+    def wave():
+        game = game_class.Game(3, enemies.Player(40, ["Punch"]))
+        slimes = enemies.slime_wave(1, 500)
+        terminal.run_headless(
+            lambda stdscr: main.battle_menu(slimes, game, stdscr),
+            [" "] * 5000)
+
+    def auto():
+        player = enemies.Player(200, ["Punch"])
+        enemies.auto_battle(player, enemies.slime_wave(1, 500),
+                            enemies.lowest_hp_target, "Punch")
+
+    results["main.battle_menu[20 slimes]"] = _time(fight)
+    results["main.battle_menu[500 slimes]"] = _time(wave, repeat=1)
+    results["enemies.auto_battle[500 slimes]"] = _time(auto)
+
+
+def bench_saves(results: Dict[str, float]):
+    game = game_class.Game(3, enemies.Player(12, ["Punch", "Sword Strike"]))
+    # Kept out of the real saves folder, so the benchmark doesn't show up in its catalog
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        previous = game_class.save_dir()
+        game_class.set_save_dir(Path(tmp_dir))
+        save_file = Path(tmp_dir) / "benchmark.save"
+
+        def round_trip():
+            for _ in range(50):
+                game.make_save("benchmark")
+                with save_file.open("r") as f:
+                    game_class.Game.from_save(f.readlines())
+
+        try:
+            results["game.save_round_trip[50]"] = _time(round_trip)
+        finally:
+            game_class.set_save_dir(previous)
+
+
+def run(quick: bool = False) -> Dict[str, float]:
+    sizes = QUICK_MAP_SIZES if quick else MAP_SIZES
+    results: Dict[str, float] = {}
+    bench_map_loading(results)
+    bench_large_maps(results, sizes)
+    bench_movement(results, sizes)
+    bench_fov(results, QUICK_MAP_SIZES)
+    bench_overlays(results, sizes[-1])
+    bench_worlds(results, QUICK_WORLD_SIZES if quick else WORLD_SIZES)
+    bench_menu(results)
+    bench_battle(results)
+    bench_saves(results)
+    return results
+
+
+def compare(results: Dict[str, float], baseline: Dict[str, float],
+            threshold: float) -> List[str]:
+    """Prints each result next to its baseline and returns the names of the ones that regressed"""
+    regressions: List[str] = []
+    for name, seconds in results.items():
+        line = f"{name:45} {seconds * 1000:10.3f} ms"
+        if name in baseline:
+            change = seconds / baseline[name] - 1
+            line += f"  {change:+8.1%}"
+            if change > threshold:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line)
+    return regressions
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--save",
+                        action="store_true",
+                        help="Store the results as the new baseline")
+    parser.add_argument("--quick",
+                        action="store_true",
+                        help="Skip the largest synthetic maps")
+    parser.add_argument("--threshold",
+                        type=float,
+                        default=0.25,
+                        help="Allowed slowdown before failing (0.25 = 25%%)")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    args = parser.parse_args()
+
+    baseline: Dict[str, float] = {}
+    if args.baseline.exists():
+        with args.baseline.open("r") as f:
+            baseline = json.load(f)
+    elif not args.save:
+        print(f"No baseline at {args.baseline}, record one with --save first.",
+              file=sys.stderr)
+        sys.exit(2)
+    results = run(args.quick)
+    regressions = compare(results, baseline, args.threshold)
+    if args.save:
+        args.baseline.parent.mkdir(exist_ok=True)
+        with args.baseline.open("w") as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+        print(f"Saved baseline to {args.baseline}")
+        return
+    if regressions:
+        print(f"{len(regressions)} benchmark(s) regressed by more than "
+              f"{args.threshold:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,313 @@
+"""Chunked worlds: maps too big to keep in memory or show on one screen.
+
+A world file (.mapw, see maps/map_format.md) stores a map as square chunks of map tiles and map data. A ChunkedMap only
+reads the chunks around the player and forgets the least recently used ones, so its memory use and load time depend on
+how far the player can see, not on the size of the world.
+"""
+
+import argparse
+import os
+import struct
+from collections import OrderedDict
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+import maps
+
+# World file format (.mapw):
+# header: magic, format version, rows, columns, chunk size, start y, start x
+# followed by every chunk, row by row. A chunk is chunk size * chunk size bytes of map tiles, then the same for map data
+MAPW_MAGIC: bytes = b"TGMW"
+MAPW_VERSION: int = 1
+MAPW_HEADER = struct.Struct("<4sHIIHII")
+CHUNK_SIZE: int = 32
+# Chunks kept loaded beyond the ones needed for the current view
+CHUNK_CACHE_SLACK: int = 8
+# Past the edges of the world
+_PAD_TILE: bytes = b" "
+_PAD_DATA: bytes = b"#"
+
+ChunkKey = Tuple[int, int]
+
+
+class Chunk:
+    """One square of a world, with its tile classes and indexed symbols"""
+
+    __slots__ = ("key", "tiles", "data", "tile_classes", "symbols")
+
+    def __init__(self, key: ChunkKey, tiles: bytes, data: bytes, size: int):
+        self.key = key
+        self.tiles = tiles
+        self.data = data
+        self.tile_classes: bytes = maps.classify_tiles(data)
+        # Indexed symbol -> (y, x) in the world of each tile with it
+        self.symbols: Dict[str, List[Tuple[int, int]]] = {}
+        top = key[0] * size
+        left = key[1] * size
+        for symbol in maps.INDEXED_SYMBOLS:
+            raw = symbol.encode("latin-1")
+            index = data.find(raw)
+            while index != -1:
+                y, x = divmod(index, size)
+                self.symbols.setdefault(symbol, []).append((top + y, left + x))
+                index = data.find(raw, index + 1)
+
+
+class ChunkedMap(maps.LayeredMap):
+    """A map read from a world file a chunk at a time. Has the same query methods as maps.Map"""
+
+    def __init__(self, path: Path, cache_size: int = CHUNK_CACHE_SLACK):
+        self.path = path
+        self._file: BinaryIO = open(path, "rb")
+        header = self._file.read(MAPW_HEADER.size)
+        try:
+            (magic, version, rows, cols, chunk_size, start_y,
+             start_x) = MAPW_HEADER.unpack(header)
+        except struct.error:
+            self._file.close()
+            raise ValueError(f"{path} is truncated.")
+        if magic != MAPW_MAGIC or version != MAPW_VERSION:
+            self._file.close()
+            raise ValueError(f"{path} is not a world file.")
+        self.height: int = rows
+        self.width: int = cols
+        # Same meaning as in maps.Map
+        self.LINES: int = rows + 1
+        self.COLS: int = cols + 1
+        self.chunk_size: int = chunk_size
+        self.chunk_rows: int = -(-rows // chunk_size)
+        self.chunk_cols: int = -(-cols // chunk_size)
+        self._start = (start_y, start_x)
+        self._chunk_bytes = chunk_size * chunk_size
+        self.cache_size = cache_size
+        self._chunks: "OrderedDict[ChunkKey, Chunk]" = OrderedDict()
+        # Chunks loaded and forgotten since the last call to pop_chunk_changes
+        self._loaded: List[ChunkKey] = []
+        self._evicted: List[ChunkKey] = []
+        # Number of chunks read from the file, for benchmarks
+        self.chunk_reads: int = 0
+        self._set_overlays(None)
+
+    @classmethod
+    def from_name(cls, map_name: str):
+        """Opens maps/<map_name>.mapw"""
+        return cls(Path(__file__).parent.parent / "maps" / f"{map_name}.mapw")
+
+    def close(self):
+        self._file.close()
+
+    def layered(self,
+                overlays: Optional[maps.Overlays] = None) -> "ChunkedMap":
+        """Puts overlays on top of the world. Each ChunkedMap is only used by one game, so no copy is made"""
+        self._set_overlays(overlays)
+        return self
+
+    # Chunks
+    def chunk(self, key: ChunkKey) -> Chunk:
+        """Gets a chunk, reading it from the file if it isn't loaded"""
+        chunk = self._chunks.get(key)
+        if chunk is not None:
+            self._chunks.move_to_end(key)
+            return chunk
+        chunk_y, chunk_x = key
+        offset = MAPW_HEADER.size + (chunk_y * self.chunk_cols +
+                                     chunk_x) * self._chunk_bytes * 2
+        self._file.seek(offset)
+        raw = self._file.read(self._chunk_bytes * 2)
+        if len(raw) != self._chunk_bytes * 2:
+            raise ValueError(f"{self.path} is truncated.")
+        chunk = Chunk(key, raw[:self._chunk_bytes], raw[self._chunk_bytes:],
+                      self.chunk_size)
+        self.chunk_reads += 1
+        self._chunks[key] = chunk
+        self._loaded.append(key)
+        while len(self._chunks) > self.cache_size:
+            evicted, _ = self._chunks.popitem(last=False)
+            self._evicted.append(evicted)
+        return chunk
+
+    def chunk_key(self, pos: Sequence[int]) -> ChunkKey:
+        return pos[0] // self.chunk_size, pos[1] // self.chunk_size
+
+    def chunks_around(self, pos: Sequence[int], lines: int,
+                      cols: int) -> List[ChunkKey]:
+        """Keys of the chunks that a lines x cols view centered on pos touches"""
+        size = self.chunk_size
+        top = max(pos[0] - lines // 2, 0) // size
+        bottom = min(pos[0] + lines // 2, self.height - 1) // size
+        left = max(pos[1] - cols // 2, 0) // size
+        right = min(pos[1] + cols // 2, self.width - 1) // size
+        return [(chunk_y, chunk_x) for chunk_y in range(top, bottom + 1)
+                for chunk_x in range(left, right + 1)]
+
+    def load_around(self, pos: Sequence[int], lines: int, cols: int):
+        """Makes sure every chunk a lines x cols view centered on pos needs is loaded.
+        The cache grows to fit the view if it has to"""
+        keys = self.chunks_around(pos, lines, cols)
+        self.cache_size = max(self.cache_size, len(keys) + CHUNK_CACHE_SLACK)
+        for key in keys:
+            self.chunk(key)
+
+    def loaded_chunks(self) -> List[Chunk]:
+        return list(self._chunks.values())
+
+    def pop_chunk_changes(self) -> Tuple[List[ChunkKey], List[ChunkKey]]:
+        """Gets the keys of the chunks loaded and forgotten since the last call"""
+        loaded, evicted = self._loaded, self._evicted
+        self._loaded, self._evicted = [], []
+        return loaded, evicted
+
+    # Queries, same as maps.Map
+    def _in_bounds(self, pos: Sequence[int]) -> bool:
+        return 0 <= pos[0] < self.height and 0 <= pos[1] < self.width
+
+    def _index(self, pos: Sequence[int]) -> Tuple[Chunk, int]:
+        size = self.chunk_size
+        chunk = self.chunk((pos[0] // size, pos[1] // size))
+        return chunk, (pos[0] % size) * size + pos[1] % size
+
+    def get_tile_class(self, pos: Sequence[int]) -> int:
+        if not self._in_bounds(pos):
+            return maps.WALL
+        if self._overlay_classes:
+            tile_class = self._overlay_classes.get((pos[0], pos[1]))
+            if tile_class is not None:
+                return tile_class
+        chunk, index = self._index(pos)
+        return chunk.tile_classes[index]
+
+    def is_passable(self, pos: Sequence[int]) -> bool:
+        return self.get_tile_class(pos) != maps.WALL
+
+    def get_trigger(self, pos: Sequence[int]) -> int:
+        return maps.trigger_of(self.get_tile_class(pos))
+
+    def get_metamap_char(self, pos: Sequence[int]) -> str:
+        changed = self.overlays.cells.get((pos[0], pos[1]))
+        if changed is not None:
+            return changed[1]
+        chunk, index = self._index(pos)
+        return chr(chunk.data[index])
+
+    def get_starting_pos(self) -> List[int]:
+        return [self._start[0], self._start[1], 0]
+
+    def _row_bytes(self, y: int, start: int, end: int, attribute: str,
+                   pad: bytes) -> bytes:
+        """Columns start to end of row y of a Chunk attribute (tiles, data or tile_classes), padded past the edges"""
+        size = self.chunk_size
+        if not 0 <= y < self.height:
+            return pad * (end - start)
+        parts: List[bytes] = [pad * max(0, -start)]
+        x = max(start, 0)
+        stop = min(end, self.width)
+        row_start = (y % size) * size
+        while x < stop:
+            chunk = self.chunk((y // size, x // size))
+            chunk_end = min(stop, (x // size + 1) * size)
+            parts.append(
+                getattr(chunk, attribute)[row_start + x % size:row_start +
+                                          (chunk_end - 1) % size + 1])
+            x = chunk_end
+        return b"".join(parts)[:end - start].ljust(end - start, pad)
+
+    def _row_tiles(self, y: int, start: int, end: int) -> str:
+        return self._row_bytes(y, start, end, "tiles",
+                               _PAD_TILE).decode("latin-1")
+
+    def get_passability_window(self, top: int, left: int, lines: int,
+                               cols: int) -> bytes:
+        """Gets a flat lines * cols grid like maps.Map.get_passability for the part of the world with its top left at
+        (top, left). Tiles past the edges count as walls"""
+        wall = bytes([maps.WALL])
+        rows: List[bytes] = []
+        for y in range(top, top + lines):
+            tile_classes = bytearray(
+                self._row_bytes(y, left, left + cols, "tile_classes", wall))
+            for x in self._overlay_rows.get(y, ()):
+                if left <= x < left + cols:
+                    tile_classes[x - left] = self._overlay_classes[(y, x)]
+            rows.append(bytes(tile_classes))
+        return maps.passability_of(b"".join(rows))
+
+
+def write_world(path: Path,
+                rows: Iterable[Tuple[str, str]],
+                height: int,
+                width: int,
+                chunk_size: int = CHUNK_SIZE):
+    """Writes a world file from (map line, map data line) pairs, one per row.
+    Only chunk_size rows are kept in memory at a time"""
+    tmp_path = Path(f"{path}.tmp")
+    chunk_cols = -(-width // chunk_size)
+    padded_width = chunk_cols * chunk_size
+    start: Optional[Tuple[int, int]] = None
+    row_iter: Iterator[Tuple[str, str]] = iter(rows)
+    with open(tmp_path, "wb") as f:
+        f.write(bytes(MAPW_HEADER.size))
+        for band_top in range(0, height, chunk_size):
+            tile_rows: List[bytes] = []
+            data_rows: List[bytes] = []
+            for y in range(band_top, band_top + chunk_size):
+                line, data_line = next(row_iter,
+                                       ("", "")) if y < height else ("", "")
+                if start is None and "S" in data_line:
+                    start = (y, data_line.index("S"))
+                tile_row = line[:width].encode("latin-1", errors="replace")
+                tile_rows.append(tile_row.ljust(padded_width, _PAD_TILE))
+                data_row = data_line[:width].encode("latin-1",
+                                                    errors="replace")
+                if y < height:
+                    data_row = data_row.ljust(width, b" ")
+                data_rows.append(data_row.ljust(padded_width, _PAD_DATA))
+            for chunk_x in range(chunk_cols):
+                left = chunk_x * chunk_size
+                right = left + chunk_size
+                f.write(b"".join(row[left:right] for row in tile_rows))
+                f.write(b"".join(row[left:right] for row in data_rows))
+        if start is None:
+            raise ValueError("No starting position found.")
+        f.seek(0)
+        f.write(
+            MAPW_HEADER.pack(MAPW_MAGIC, MAPW_VERSION, height, width,
+                             chunk_size, start[0], start[1]))
+    os.replace(tmp_path, path)
+
+
+def build_world(map_path: Path,
+                map_data_path: Path,
+                path: Path,
+                chunk_size: int = CHUNK_SIZE):
+    """Converts a .map and .mapdata file to a world file, reading them a line at a time"""
+    height = 0
+    width = 0
+    with open(map_path, "r") as f:
+        for line in f:
+            height += 1
+            width = max(width, len(line.rstrip("\n")))
+    with open(map_path, "r") as f, open(map_data_path, "r") as f2:
+        rows = ((line.rstrip("\n"), data_line.rstrip("\n"))
+                for line, data_line in zip(f, f2))
+        write_world(path, rows, height, width, chunk_size)
+
+
+def load_map(map_name: str) -> Union[maps.Map, ChunkedMap]:
+    """Opens maps/<map_name>.mapw if there is one, otherwise loads the map with maps.Map.from_name"""
+    world_path = Path(__file__).parent.parent / "maps" / f"{map_name}.mapw"
+    if world_path.exists():
+        return ChunkedMap(world_path)
+    return maps.Map.from_name(map_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Converts maps/<name>.map and .mapdata to a world file")
+    parser.add_argument("name")
+    parser.add_argument("--chunk-size", default=CHUNK_SIZE, type=int)
+    args = parser.parse_args()
+    map_dir = Path(__file__).parent.parent / "maps"
+    build_world(map_dir / f"{args.name}.map", map_dir / f"{args.name}.mapdata",
+                map_dir / f"{args.name}.mapw", args.chunk_size)
+
+
+if __name__ == "__main__":
+    main()
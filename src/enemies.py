@@ -1,34 +1,200 @@
-"""Logic and Functions for the Turn-Based Combat System."""
+"""Logic and Functions for the Turn-Based Combat System.
+
+Combatants are stored in a CombatantPool, with one array per stat, so a battle against hundreds of enemies stays
+compact. Defeated combatants are masked out instead of being removed. Combatant, Slime and Player are views of one
+slot in a pool.
+"""
 
 import random
 import time
 import curses
-from typing import List, Tuple, Dict, Any, Union, Optional, Sequence, TypeVar
-import game_class
+from array import array
+from collections import deque
+from typing import Callable, Deque, Iterator, List, NamedTuple, Tuple, Dict, Any, Union, Optional, Sequence, TypeVar
+import markup
+import rng_streams
+
+# Lines kept in a CombatLog, older lines are dropped
+COMBAT_LOG_SIZE: int = 500
+# Skills Player.use_skill knows -> how many times the player's attack they deal
+SKILL_MULTIPLIERS: Dict[str, int] = {"Punch": 1, "Sword Strike": 2}
+SKILLS: Tuple[str, ...] = tuple(SKILL_MULTIPLIERS)
+# Skills deal up to this much extra damage
+SKILL_BONUS: int = 3
+
+
+def hit_range(atk: int) -> Tuple[int, int]:
+    """Least and most damage of an attack by a combatant with attack atk"""
+    return atk // 2, atk
+
+
+def skill_damage(skill: str, atk: int, bonus: int) -> int:
+    """Damage of a player skill, bonus being the random extra from 0 to SKILL_BONUS"""
+    return atk * SKILL_MULTIPLIERS[skill] + bonus
+
+
+class CombatantPool:
+    """Stats of a group of combatants (usually one side of a battle) in parallel arrays"""
+
+    __slots__ = ("names", "skills", "hp", "atk", "turns", "lvl", "alive",
+                 "alive_count", "_views")
+
+    def __init__(self):
+        self.names: List[str] = []
+        self.skills: List[List[str]] = []
+        self.hp = array("l")
+        self.atk = array("l")
+        self.turns = array("l")
+        self.lvl = array("l")
+        # 1 while the combatant in that slot is still fighting
+        self.alive = bytearray()
+        self.alive_count: int = 0
+        self._views: List["Combatant"] = []
+
+    def _add(self, view: "Combatant", name: str, hp: int, atk: int, turns: int,
+             lvl: int, skills: List[str]) -> int:
+        """Stores a new combatant, returns its slot"""
+        self.names.append(name)
+        self.skills.append(skills)
+        self.hp.append(hp)
+        self.atk.append(atk)
+        self.turns.append(turns)
+        self.lvl.append(lvl)
+        self.alive.append(hp > 0)
+        self.alive_count += hp > 0
+        self._views.append(view)
+        return len(self._views) - 1
+
+    def set_hp(self, index: int, hp: int):
+        self.hp[index] = hp
+        if hp <= 0 and self.alive[index]:
+            self.alive[index] = 0
+            self.alive_count -= 1
+
+    def view(self, index: int) -> "Combatant":
+        return self._views[index]
+
+    def alive_indices(self) -> List[int]:
+        alive = self.alive
+        return [index for index in range(len(alive)) if alive[index]]
+
+    def living(self) -> List["Combatant"]:
+        """Views of every combatant still fighting, in the order they were added"""
+        return [self._views[index] for index in self.alive_indices()]
+
+    def attack_all(
+            self,
+            target: "Combatant",
+            rng: Optional[random.Random] = None) -> List[Tuple[int, int]]:
+        """Every living combatant attacks target for each of its turns, stopping once target is defeated.
+        All damage is applied to target at once. Returns (slot, damage) for each attack made"""
+        randint = (rng or rng_streams.get("combat")).randint
+        atk = self.atk
+        turns = self.turns
+        hp = target.hp
+        hits: List[Tuple[int, int]] = []
+        for index in self.alive_indices():
+            low, high = hit_range(atk[index])
+            for _ in range(turns[index]):
+                damage = randint(low, high)
+                hits.append((index, damage))
+                hp -= damage
+                if hp <= 0:
+                    break
+            if hp <= 0:
+                break
+        target.hp = hp
+        return hits
+
+    def __len__(self) -> int:
+        return len(self._views)
 
 
 class Combatant:
+    """One slot of a CombatantPool. A new pool is made for it if none is given"""
 
-    def __init__(self, name: str, hp: int, atk: int, turns: int, lvl: int,
-                 skills: List[str]):
-        self.name = name
-        self.hp = hp
-        self.atk = atk
-        self.turns = turns
-        self.lvl = lvl
-        self.skills = skills
+    __slots__ = ("pool", "index")
+
+    def __init__(self,
+                 name: str,
+                 hp: int,
+                 atk: int,
+                 turns: int,
+                 lvl: int,
+                 skills: List[str],
+                 pool: Optional[CombatantPool] = None):
+        self.pool: CombatantPool = pool if pool is not None else CombatantPool(
+        )
+        self.index: int = self.pool._add(self, name, hp, atk, turns, lvl,
+                                         skills)
 
     @classmethod
-    def from_lvl(cls, name: str, lvl: int, skills: List[str]):
+    def from_lvl(cls,
+                 name: str,
+                 lvl: int,
+                 skills: List[str],
+                 pool: Optional[CombatantPool] = None):
         """Create a combatant with stats based on a level"""
         hp = lvl * 8
         atk = lvl * 2
         turns = lvl // 5 + 1
-        return cls(name, hp, atk, turns, lvl, skills)
+        return cls(name, hp, atk, turns, lvl, skills, pool)
+
+    @property
+    def name(self) -> str:
+        return self.pool.names[self.index]
+
+    @name.setter
+    def name(self, name: str):
+        self.pool.names[self.index] = name
+
+    @property
+    def hp(self) -> int:
+        return self.pool.hp[self.index]
+
+    @hp.setter
+    def hp(self, hp: int):
+        self.pool.set_hp(self.index, hp)
+
+    @property
+    def atk(self) -> int:
+        return self.pool.atk[self.index]
+
+    @atk.setter
+    def atk(self, atk: int):
+        self.pool.atk[self.index] = atk
+
+    @property
+    def turns(self) -> int:
+        return self.pool.turns[self.index]
+
+    @turns.setter
+    def turns(self, turns: int):
+        self.pool.turns[self.index] = turns
+
+    @property
+    def lvl(self) -> int:
+        return self.pool.lvl[self.index]
+
+    @lvl.setter
+    def lvl(self, lvl: int):
+        self.pool.lvl[self.index] = lvl
+
+    @property
+    def skills(self) -> List[str]:
+        return self.pool.skills[self.index]
+
+    @skills.setter
+    def skills(self, skills: List[str]):
+        self.pool.skills[self.index] = skills
+
+    @property
+    def alive(self) -> bool:
+        return bool(self.pool.alive[self.index])
 
     def attack(self, target) -> str:
         """Attack a target"""
-        damage = random.randint(self.atk // 2, self.atk)
+        damage = rng_streams.get("combat").randint(*hit_range(self.atk))
         target.hp -= damage
         return f"{self.name} attacked {target.name} for `b{damage} `ndamage."
 
@@ -38,27 +204,170 @@ class Combatant:
 
 class Slime(Combatant):
 
-    def __init__(self, lvl: int, num: int):
-        super().__init__(f"Slime {num}", lvl * 5 + random.randint(1, 2) * lvl,
-                         lvl + random.randint(1, 2) * lvl, lvl // 8 + 1, lvl,
-                         [""])
+    __slots__ = ()
+
+    def __init__(self,
+                 lvl: int,
+                 num: int,
+                 pool: Optional[CombatantPool] = None):
+        randint = rng_streams.get("spawn").randint
+        super().__init__(f"Slime {num}", lvl * 5 + randint(1, 2) * lvl,
+                         lvl + randint(1, 2) * lvl, lvl // 8 + 1, lvl, [""],
+                         pool)
 
 
 class Player(Combatant):
 
-    def __init__(self, lvl: int, skills: List[str]):
+    __slots__ = ()
+
+    def __init__(self,
+                 lvl: int,
+                 skills: List[str],
+                 pool: Optional[CombatantPool] = None):
         super().__init__("you", lvl * 6 + 15, lvl * 3, lvl // 5 + 1, lvl,
-                         skills)
+                         skills, pool)
+
+    def strongest_skill(self) -> str:
+        """The known skill that deals the most damage"""
+        return max(self.skills,
+                   key=lambda skill: SKILL_MULTIPLIERS.get(skill, 0))
+
+    def use_skill(self, skill: str, target: Combatant) -> str:
+        """Uses the skill called `skill` (as in self.skills) on target"""
+        if skill == "Punch":
+            return self.punch(target)
+        if skill == "Sword Strike":
+            return self.sword_strike(target)
+        raise ValueError(f"Unknown skill: {skill}")
 
     # Functions for skills
     def punch(self, target: Combatant):
         """Punch the target"""
-        attack = self.atk + random.randint(0, 3)
+        attack = skill_damage(
+            "Punch", self.atk,
+            rng_streams.get("combat").randint(0, SKILL_BONUS))
         target.hp -= attack
         return f"You punched {target.name} for {attack} damage."
 
     def sword_strike(self, target: Combatant):
         """Attack the target with your sword"""
-        attack = self.atk * 2 + random.randint(0, 3)
+        attack = skill_damage(
+            "Sword Strike", self.atk,
+            rng_streams.get("combat").randint(0, SKILL_BONUS))
         target.hp -= attack
         return f"You attacked {target.name} with your sword for `b{attack} `ndamage."
+
+
+def slime_wave(lvl: int,
+               count: int,
+               pool: Optional[CombatantPool] = None) -> CombatantPool:
+    """Adds count slimes of level lvl to a pool (a new one if not given)"""
+    pool = pool if pool is not None else CombatantPool()
+    start = len(pool)
+    for num in range(count):
+        Slime(lvl, start + num + 1, pool)
+    return pool
+
+
+class CombatLog:
+    """The newest COMBAT_LOG_SIZE lines of what happened in a battle, without attribute tags"""
+
+    def __init__(self, size: int = COMBAT_LOG_SIZE):
+        self._lines: Deque[str] = deque(maxlen=size)
+        # Lines that were pushed out by newer ones
+        self.dropped: int = 0
+
+    def add(self, line: str):
+        if len(self._lines) == self._lines.maxlen:
+            self.dropped += 1
+        self._lines.append(markup.plain_text(line))
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._lines)
+
+    def __len__(self) -> int:
+        return len(self._lines)
+
+
+# A policy picks the skill and target for the player's next turn:
+# policy(player, foes, last skill, last target) -> (skill, target)
+Policy = Callable[[Player, CombatantPool, str, Optional[Combatant]],
+                  Tuple[str, Combatant]]
+
+
+def repeat_last_action(player: Player, foes: CombatantPool, skill: str,
+                       target: Optional[Combatant]) -> Tuple[str, Combatant]:
+    """Same skill on the same target, moving on to the next enemy once it is defeated"""
+    if target is None or not target.alive:
+        target = foes.view(foes.alive_indices()[0])
+    return skill, target
+
+
+def lowest_hp_target(player: Player, foes: CombatantPool, skill: str,
+                     target: Optional[Combatant]) -> Tuple[str, Combatant]:
+    """Same skill on whichever enemy has the least HP left"""
+    hp = foes.hp
+    return skill, foes.view(min(foes.alive_indices(), key=hp.__getitem__))
+
+
+# Name shown in the battle menu -> policy
+AUTO_POLICIES: Dict[str, Policy] = {
+    "Repeat last action": repeat_last_action,
+    "Lowest HP target": lowest_hp_target,
+}
+
+
+class BattleResult(NamedTuple):
+    won: bool
+    rounds: int
+    damage_dealt: int
+    damage_taken: int
+    defeated: int  # Number of enemies defeated
+
+    def __str__(self):
+        outcome = "You won" if self.won else "You were defeated"
+        return (
+            f"{outcome} after {self.rounds} rounds. You defeated {self.defeated} enemies, "
+            f"dealt {self.damage_dealt} damage and took {self.damage_taken} damage."
+        )
+
+
+def auto_battle(player: Player,
+                foes: CombatantPool,
+                policy: Policy,
+                skill: str,
+                target: Optional[Combatant] = None,
+                log: Optional[CombatLog] = None,
+                max_rounds: int = 10000) -> BattleResult:
+    """Fights until one side is defeated (or max_rounds pass) with policy choosing the player's moves.
+    Takes the same turns as main.battle_menu, but writes what happens to log instead of showing it"""
+    log = log if log is not None else CombatLog()
+    hp = foes.hp
+    start_hp = player.hp
+    dealt = 0
+    defeated = 0
+    rounds = 0
+    while foes.alive_count and player.hp > 0 and rounds < max_rounds:
+        rounds += 1
+        skill, target = policy(player, foes, skill, target)
+        for _ in range(player.turns):
+            before = hp[target.index]
+            log.add(player.use_skill(skill, target))
+            dealt += before - hp[target.index]
+            if not target.alive:
+                log.add(f"{target.name} has been defeated!")
+                defeated += 1
+                break
+
+        if not foes.alive_count:
+            break
+        for index, damage in foes.attack_all(player):
+            log.add(
+                f"{foes.names[index]} attacked {player.name} for {damage} damage."
+            )
+        if player.hp <= 0:
+            log.add("You have been defeated!")
+        else:
+            log.add(f"You have {player.hp} HP left.")
+    return BattleResult(not foes.alive_count, rounds, dealt,
+                        start_hp - player.hp, defeated)
@@ -0,0 +1,330 @@
+"""Things that are on a map: the player, NPCs, roaming enemies and pickups like the sword.
+
+Entities are stored in a spatial hash so finding what is on or near a tile only looks at nearby buckets, and
+entities that act on their own are woken by a priority queue scheduler at their own rates, so a move only costs as much
+as the entities that are actually due.
+"""
+
+import heapq
+import itertools
+import random
+from typing import Dict, FrozenSet, Iterable, List, Optional, Sequence, Set, Tuple, Union
+import chunks
+import maps
+import navigation
+import rng_streams
+
+Pos = Tuple[int, int]
+HASH_CELL_SIZE: int = 8
+
+
+class Entity:
+
+    def __init__(self,
+                 kind: str,
+                 pos: Sequence[int],
+                 glyph: Optional[str] = None,
+                 tick_interval: Optional[int] = None,
+                 cells: Optional[Iterable[Pos]] = None,
+                 solid: bool = False):
+        cells = list(cells) if cells else None
+        self.kind = kind
+        self._pos: Pos = (pos[0], pos[1])
+        # Drawn over the map, None if the map already draws it (like the sword)
+        self.glyph = glyph
+        # Ticks between calls to tick, None if it never acts on its own
+        self.tick_interval = tick_interval
+        # Tiles taken up relative to pos
+        self._offsets: FrozenSet[Pos] = frozenset(
+            (y - self._pos[0], x - self._pos[1])
+            for y, x in cells) if cells else frozenset([(0, 0)])
+        self.cells: FrozenSet[Pos] = frozenset(cells) if cells else frozenset(
+            [self._pos])
+        self.solid = solid
+        self.id: int = -1
+
+    @property
+    def pos(self) -> Pos:
+        return self._pos
+
+    @pos.setter
+    def pos(self, new: Pos):
+        self._pos = new
+        self.cells = frozenset(
+            (new[0] + dy, new[1] + dx) for dy, dx in self._offsets)
+
+    def tick(self, world: "World"):
+        """Called every tick_interval ticks"""
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.kind!r}, {self.pos})"
+
+
+class Pickup(Entity):
+    """Something on the map the player can interact with. `number` is the interactable number from the .mapdata"""
+
+    def __init__(self, number: int, cells: Iterable[Pos]):
+        cells = sorted(cells)
+        super().__init__("pickup", cells[0], cells=cells)
+        self.number = number
+
+
+class Chaser(Entity):
+    """Wanders around and walks toward the player once the player is close"""
+
+    def __init__(self,
+                 kind: str,
+                 pos: Sequence[int],
+                 glyph: str,
+                 tick_interval: int = 2,
+                 sight: int = 10,
+                 rng: Optional[random.Random] = None):
+        super().__init__(kind, pos, glyph, tick_interval, solid=True)
+        self.sight = sight
+        self._rng = rng or rng_streams.get("world")
+
+    def tick(self, world: "World"):
+        player = world.player
+        if player is not None:
+            field = world.navigator.player_field(player.pos, self.sight)
+            distance = field.distance(self.pos)
+            if distance is not None and 1 < distance <= self.sight:
+                step = field.next_step(self.pos)
+                if step is not None:
+                    world.move(self, step)
+                return
+        dy, dx = self._rng.choice(((0, 1), (0, -1), (1, 0), (-1, 0)))
+        world.move(self, (self.pos[0] + dy, self.pos[1] + dx))
+
+
+class SpatialHash:
+    """Buckets entities by the square of HASH_CELL_SIZE tiles they are in"""
+
+    def __init__(self, cell_size: int = HASH_CELL_SIZE):
+        self.cell_size = cell_size
+        self._buckets: Dict[Pos, Set[Entity]] = {}
+
+    def _keys(self, entity: Entity) -> Set[Pos]:
+        size = self.cell_size
+        return {(y // size, x // size) for y, x in entity.cells}
+
+    def insert(self, entity: Entity):
+        for key in self._keys(entity):
+            self._buckets.setdefault(key, set()).add(entity)
+
+    def remove(self, entity: Entity):
+        for key in self._keys(entity):
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(entity)
+                if not bucket:
+                    del self._buckets[key]
+
+    def at(self, pos: Sequence[int]) -> List[Entity]:
+        size = self.cell_size
+        bucket = self._buckets.get((pos[0] // size, pos[1] // size), ())
+        tile = (pos[0], pos[1])
+        return [entity for entity in bucket if tile in entity.cells]
+
+    def near(self, pos: Sequence[int], radius: int) -> List[Entity]:
+        """Entities with a tile within radius steps (up, down, left, right) of pos"""
+        size = self.cell_size
+        found: Set[Entity] = set()
+        for key_y in range((pos[0] - radius) // size,
+                           (pos[0] + radius) // size + 1):
+            for key_x in range((pos[1] - radius) // size,
+                               (pos[1] + radius) // size + 1):
+                for entity in self._buckets.get((key_y, key_x), ()):
+                    if any(
+                            abs(y - pos[0]) + abs(x - pos[1]) <= radius
+                            for y, x in entity.cells):
+                        found.add(entity)
+        return list(found)
+
+
+class Scheduler:
+    """Priority queue of entities by the tick they next act on"""
+
+    def __init__(self):
+        self._queue: List[Tuple[int, int, Entity]] = []
+        self._counter = itertools.count()
+
+    def schedule(self, entity: Entity, tick: int):
+        heapq.heappush(self._queue, (tick, next(self._counter), entity))
+
+    def pop_due(self, now: int) -> List[Entity]:
+        due: List[Entity] = []
+        while self._queue and self._queue[0][0] <= now:
+            due.append(heapq.heappop(self._queue)[2])
+        return due
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+
+class World:
+    """Every entity on one map"""
+
+    def __init__(self, world_map: Union[maps.Map, chunks.ChunkedMap]):
+        self.map = world_map
+        self._navigator: Optional[navigation.Navigator] = None
+        self.spatial_hash = SpatialHash()
+        self.scheduler = Scheduler()
+        self.entities: Dict[int, Entity] = {}
+        self.player: Optional[Entity] = None
+        self.now: int = 0
+        self._ids = itertools.count()
+        # Tiles whose drawing changed since the last call to pop_changed_cells
+        self._changed: Set[Pos] = set()
+        # (number, tiles) of pickups that were removed, so they aren't added again when their chunk is loaded again
+        self._removed_pickups: Set[Tuple[int, FrozenSet[Pos]]] = set()
+        # Chunk key -> pickups made from that chunk of a chunked map
+        self._chunk_pickups: Dict[chunks.ChunkKey, List[Pickup]] = {}
+
+    @property
+    def navigator(self) -> navigation.Navigator:
+        """Pathfinding for the map. Only made when something needs it, since it covers the whole map"""
+        if self._navigator is None or (self._navigator.overlay_version
+                                       != self.map.overlay_version):
+            self._navigator = navigation.get_navigator(self.map)
+        return self._navigator
+
+    @classmethod
+    def from_map(cls, world_map: Union[maps.Map, chunks.ChunkedMap]):
+        """Makes a world with a Pickup for each group of touching interactable tiles in the map.
+        Pickups on a chunked map are added as their chunks are loaded, see sync_chunks"""
+        world = cls(world_map)
+        if isinstance(world_map, maps.Map):
+            for number, symbol in enumerate(maps.INTERACTABLE_SYMBOLS,
+                                            start=1):
+                world.add_pickups(number,
+                                  world_map.get_symbol_positions(symbol))
+        return world
+
+    def add_pickups(self, number: int, tiles: Iterable[Pos]) -> List[Pickup]:
+        """Adds a Pickup for each group of touching tiles"""
+        added: List[Pickup] = []
+        remaining = set(tiles)
+        while remaining:
+            group = [remaining.pop()]
+            index = 0
+            while index < len(group):
+                y, x = group[index]
+                for neighbour in ((y + 1, x), (y - 1, x), (y, x + 1), (y,
+                                                                       x - 1)):
+                    if neighbour in remaining:
+                        remaining.remove(neighbour)
+                        group.append(neighbour)
+                index += 1
+            if (number, frozenset(group)) not in self._removed_pickups:
+                added.append(self.add(Pickup(number, group)))
+        return added
+
+    def sync_chunks(self):
+        """Adds the pickups in chunks of a chunked map that were just loaded, and removes the ones in forgotten chunks"""
+        if not isinstance(self.map, chunks.ChunkedMap):
+            return
+        loaded, evicted = self.map.pop_chunk_changes()
+        for key in evicted:
+            for pickup in self._chunk_pickups.pop(key, []):
+                self._remove(pickup)
+        for key in loaded:
+            chunk = self.map.chunk(key)
+            added: List[Pickup] = []
+            for number, symbol in enumerate(maps.INTERACTABLE_SYMBOLS,
+                                            start=1):
+                # Leaving out tiles an overlay changed, like a pickup taken in an earlier session
+                added += self.add_pickups(number, [
+                    cell for cell in chunk.symbols.get(symbol, [])
+                    if self.map.get_metamap_char(cell) == symbol
+                ])
+            if added:
+                self._chunk_pickups[key] = added
+
+    def set_map(self, world_map: Union[maps.Map, chunks.ChunkedMap]):
+        """Switches to a version of the map with the same layout of entities, like after an item was taken"""
+        self.map = world_map
+        self._navigator = None
+
+    def add(self, entity: Entity) -> Entity:
+        entity.id = next(self._ids)
+        self.entities[entity.id] = entity
+        self.spatial_hash.insert(entity)
+        if entity.kind == "player":
+            self.player = entity
+        if entity.tick_interval:
+            self.scheduler.schedule(entity, self.now + entity.tick_interval)
+        if entity.glyph is not None:
+            self._changed.update(entity.cells)
+        return entity
+
+    def remove(self, entity: Entity):
+        if isinstance(entity, Pickup):
+            self._removed_pickups.add((entity.number, entity.cells))
+        self._remove(entity)
+
+    def _remove(self, entity: Entity):
+        if self.entities.pop(entity.id, None) is None:
+            return
+        self.spatial_hash.remove(entity)
+        if entity is self.player:
+            self.player = None
+        if entity.glyph is not None:
+            self._changed.update(entity.cells)
+
+    def is_free(self,
+                pos: Sequence[int],
+                mover: Optional[Entity] = None) -> bool:
+        """Whether pos isn't a wall and has no solid entity other than mover on it"""
+        if not (0 <= pos[0] < self.map.height and 0 <= pos[1] < self.map.width
+                and self.map.is_passable(pos)):
+            return False
+        return not any(entity.solid and entity is not mover
+                       for entity in self.spatial_hash.at(pos))
+
+    def move(self, entity: Entity, pos: Sequence[int]) -> bool:
+        """Moves an entity if the tile is free. Returns whether it moved"""
+        new = (pos[0], pos[1])
+        if new == entity.pos:
+            return True
+        if not self.is_free(new, entity):
+            return False
+        self.spatial_hash.remove(entity)
+        if entity.glyph is not None:
+            self._changed.update(entity.cells)
+        entity.pos = new
+        self.spatial_hash.insert(entity)
+        if entity.glyph is not None:
+            self._changed.update(entity.cells)
+        return True
+
+    def entities_at(self, pos: Sequence[int]) -> List[Entity]:
+        return self.spatial_hash.at(pos)
+
+    def entities_near(self, pos: Sequence[int], radius: int) -> List[Entity]:
+        return self.spatial_hash.near(pos, radius)
+
+    def glyph_at(self, pos: Sequence[int]) -> Optional[str]:
+        """The glyph of an entity on pos other than the player, None if the map should be drawn"""
+        for entity in self.spatial_hash.at(pos):
+            if entity.glyph is not None and entity is not self.player:
+                return entity.glyph
+        return None
+
+    def advance(self, ticks: int = 1):
+        """Moves time forward, letting every entity that is due act"""
+        for _ in range(ticks):
+            self.now += 1
+            for entity in self.scheduler.pop_due(self.now):
+                if entity.id not in self.entities:
+                    # Removed since it was scheduled
+                    continue
+                entity.tick(self)
+                if entity.tick_interval:
+                    self.scheduler.schedule(entity,
+                                            self.now + entity.tick_interval)
+
+    def pop_changed_cells(self) -> Set[Pos]:
+        changed = self._changed
+        self._changed = set()
+        return changed
@@ -0,0 +1,259 @@
+"""Line of sight and fog of war.
+
+What the player can see is worked out with symmetric shadowcasting over the wall grid of the map's .mapdata, one
+quadrant (north, east, south, west) at a time. Each quadrant's visible cells are cached, so only the quadrants a change
+affects are scanned again: all four when the player moves, none when they bump into a wall, and only the ones that can
+see a cell whose opacity changed. Cells the player has seen are remembered in a bitset that is stored in saves.
+"""
+
+import base64
+import weakref
+import zlib
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple, Union
+import maps
+import chunks
+
+# How far the player can see, in tiles
+FOV_RADIUS: int = 10
+# Quadrants
+NORTH: int = 0
+EAST: int = 1
+SOUTH: int = 2
+WEST: int = 3
+
+Cell = Tuple[int, int]
+# A slope is numerator / denominator, denominator always positive
+Slope = Tuple[int, int]
+
+# Opacity grids shared by everything looking at the same loaded map
+_opacity_cache: "weakref.WeakKeyDictionary[maps.Map, bytes]" = weakref.WeakKeyDictionary(
+)
+
+
+def opacity(map: maps.Map) -> bytes:
+    """Gets a flat height * width grid with 1 for every tile that blocks sight and 0 for the rest.
+    Overlays aren't included, the grid is shared by every layered variant of the map"""
+    base = map.base
+    grid = _opacity_cache.get(base)
+    if grid is None:
+        grid = _opacity_cache[base] = base.get_passability().translate(
+            bytes([1, 0]) + bytes(254))
+    return grid
+
+
+def new_explored(map: Union[maps.Map, chunks.ChunkedMap]) -> bytearray:
+    """An explored bitset for a map with nothing explored"""
+    return bytearray((map.height * map.width + 7) // 8)
+
+
+def encode_explored(explored: bytearray) -> str:
+    """Turns an explored bitset into text for save files"""
+    return base64.b64encode(zlib.compress(bytes(explored))).decode("ascii")
+
+
+def decode_explored(text: str) -> bytearray:
+    return bytearray(zlib.decompress(base64.b64decode(text)))
+
+
+def _transform(quadrant: int, origin: Cell, depth: int, col: int) -> Cell:
+    """Map position of the cell depth rows away from origin and col columns to the side, in a quadrant"""
+    if quadrant == NORTH:
+        return origin[0] - depth, origin[1] + col
+    if quadrant == SOUTH:
+        return origin[0] + depth, origin[1] + col
+    if quadrant == EAST:
+        return origin[0] + col, origin[1] + depth
+    return origin[0] + col, origin[1] - depth
+
+
+def _quadrants_of(origin: Cell, cell: Cell) -> List[int]:
+    """Quadrants whose scans around origin can reach cell. Cells on a diagonal are in two"""
+    dy = cell[0] - origin[0]
+    dx = cell[1] - origin[1]
+    found: List[int] = []
+    if dy < 0 and abs(dx) <= -dy:
+        found.append(NORTH)
+    if dy > 0 and abs(dx) <= dy:
+        found.append(SOUTH)
+    if dx > 0 and abs(dy) <= dx:
+        found.append(EAST)
+    if dx < 0 and abs(dy) <= -dx:
+        found.append(WEST)
+    return found
+
+
+class FieldOfView:
+    """The cells visible from the player's position, and the cells they have ever seen"""
+
+    def __init__(self,
+                 map: Union[maps.Map, chunks.ChunkedMap],
+                 explored: Optional[bytearray] = None,
+                 radius: int = FOV_RADIUS):
+        self.radius = radius
+        self.visible: Set[Cell] = set()
+        self._origin: Optional[Cell] = None
+        # Visible cells of each quadrant, None if it has to be scanned again
+        self._quadrants: List[Optional[Set[Cell]]] = [None] * 4
+        # Cells whose visibility changed since the last call to pop_changed_cells
+        self._changed: Set[Cell] = set()
+        # Opacity of cells changed with set_opaque, by index
+        self._overrides: Dict[int, int] = {}
+        self.set_map(map, explored)
+
+    def set_map(self,
+                new_map: Union[maps.Map, chunks.ChunkedMap],
+                explored: Optional[bytearray] = None):
+        """Switches to a different map. A map the same size as the current one keeps what was explored, and only the
+        quadrants that can see a cell whose opacity changed are scanned again"""
+        old_grid = getattr(self, "_grid", None)
+        same_size = getattr(self, "map", None) is not None and (
+            self.map.height, self.map.width) == (new_map.height, new_map.width)
+        self.map = new_map
+        self._width = new_map.width
+        self._grid: Optional[bytes] = opacity(new_map) if isinstance(
+            new_map, maps.Map) else None
+        self._overrides.clear()
+        if self._grid is not None:
+            for cell in new_map.overlays.cells:
+                self._overrides[cell[0] * self._width +
+                                cell[1]] = int(not new_map.is_passable(cell))
+                self._invalidate(cell)
+        if explored is not None and len(explored) == len(
+                new_explored(new_map)):
+            self.explored = explored
+        elif not same_size:
+            self.explored = new_explored(new_map)
+        if not same_size or old_grid is None or self._grid is None:
+            self._invalidate_all()
+        elif old_grid != self._grid and self._origin is not None:
+            # Only changes within sight range can matter
+            origin_y, origin_x = self._origin
+            left = max(origin_x - self.radius, 0)
+            right = min(origin_x + self.radius + 1, self._width)
+            for y in range(max(origin_y - self.radius, 0),
+                           min(origin_y + self.radius + 1, new_map.height)):
+                row = y * self._width
+                window = slice(row + left, row + right)
+                if old_grid[window] == self._grid[window]:
+                    continue
+                for x in range(left, right):
+                    if old_grid[row + x] != self._grid[row + x]:
+                        self._invalidate((y, x))
+
+    def set_opaque(self, cell: Cell, opaque: bool):
+        """Changes whether a cell blocks sight, like a door opening"""
+        index = cell[0] * self._width + cell[1]
+        self._overrides[index] = int(opaque)
+        self._invalidate(cell)
+
+    def _invalidate(self, cell: Cell):
+        if self._origin is None:
+            return
+        if max(abs(cell[0] - self._origin[0]),
+               abs(cell[1] - self._origin[1])) > self.radius:
+            return
+        for quadrant in _quadrants_of(self._origin, cell):
+            self._quadrants[quadrant] = None
+
+    def _invalidate_all(self):
+        self._quadrants = [None] * 4
+
+    def _in_bounds(self, cell: Cell) -> bool:
+        return 0 <= cell[0] < self.map.height and 0 <= cell[1] < self._width
+
+    def _is_opaque(self, cell: Cell) -> bool:
+        if not self._in_bounds(cell):
+            return True
+        index = cell[0] * self._width + cell[1]
+        override = self._overrides.get(index)
+        if override is not None:
+            return bool(override)
+        if self._grid is not None:
+            return bool(self._grid[index])
+        return not self.map.is_passable(cell)
+
+    def _scan(self, quadrant: int, origin: Cell) -> Set[Cell]:
+        """Symmetric shadowcasting of one quadrant, row by row going away from origin"""
+        seen: Set[Cell] = set()
+        # A little more than radius squared gives rounder circles
+        radius_squared = self.radius * self.radius + self.radius
+        # Rows still to scan: depth, start slope, end slope
+        rows: List[Tuple[int, Slope, Slope]] = [(1, (-1, 1), (1, 1))]
+        while rows:
+            depth, start, end = rows.pop()
+            if depth > self.radius:
+                continue
+            # Round depth * start up on ties and depth * end down on ties
+            min_col = (2 * depth * start[0] + start[1]) // (2 * start[1])
+            max_col = -((end[1] - 2 * depth * end[0]) // (2 * end[1]))
+            previous_opaque: Optional[bool] = None
+            for col in range(min_col, max_col + 1):
+                cell = _transform(quadrant, origin, depth, col)
+                opaque = self._is_opaque(cell)
+                in_range = depth * depth + col * col <= radius_squared
+                symmetric = col * start[1] >= depth * start[0] and col * end[
+                    1] <= depth * end[0]
+                if in_range and self._in_bounds(cell) and (opaque
+                                                           or symmetric):
+                    seen.add(cell)
+                if previous_opaque and not opaque:
+                    start = (2 * col - 1, 2 * depth)
+                if previous_opaque is False and opaque:
+                    rows.append((depth + 1, start, (2 * col - 1, 2 * depth)))
+                previous_opaque = opaque
+            if previous_opaque is False:
+                rows.append((depth + 1, start, end))
+        return seen
+
+    def update(self, pos: Sequence[int]):
+        """Works out what can be seen from pos, scanning only the quadrants that changed"""
+        origin = (pos[0], pos[1])
+        if origin != self._origin:
+            self._origin = origin
+            self._invalidate_all()
+        if all(quadrant is not None for quadrant in self._quadrants):
+            return
+        visible: Set[Cell] = {origin}
+        for quadrant in range(4):
+            cells = self._quadrants[quadrant]
+            if cells is None:
+                cells = self._quadrants[quadrant] = self._scan(
+                    quadrant, origin)
+            visible |= cells
+        self._changed |= visible ^ self.visible
+        self.visible = visible
+        self.explore(visible)
+
+    def explore(self, cells: Iterable[Cell]):
+        explored = self.explored
+        width = self._width
+        for y, x in cells:
+            index = y * width + x
+            explored[index >> 3] |= 1 << (index & 7)
+
+    def is_visible(self, cell: Cell) -> bool:
+        return cell in self.visible
+
+    def is_explored(self, cell: Cell) -> bool:
+        index = cell[0] * self._width + cell[1]
+        return bool(self.explored[index >> 3] >> (index & 7) & 1)
+
+    def pop_changed_cells(self) -> Set[Cell]:
+        """Gets the cells that came into or went out of sight since the last call"""
+        changed = self._changed
+        self._changed = set()
+        return changed
+
+    def mask_row(self, y: int, start: int, text: str) -> str:
+        """Blanks out the characters of text (the cells of row y from column start on) that haven't been explored"""
+        if not 0 <= y < self.map.height:
+            return " " * len(text)
+        explored = self.explored
+        index = y * self._width + start
+        chars = list(text)
+        for offset in range(len(chars)):
+            cell = index + offset
+            if not (0 <= start + offset < self._width
+                    and explored[cell >> 3] >> (cell & 7) & 1):
+                chars[offset] = " "
+        return "".join(chars)
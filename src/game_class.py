@@ -1,6 +1,45 @@
-from typing import List
+from typing import Dict, List, Optional
 from enemies import Combatant, Player
+import json
 import pathlib
+import threading
+import save_service
+import save_catalog
+import time
+import instrument
+import fov
+import maps
+
+SAVE_DIR: pathlib.Path = pathlib.Path(__file__).parent.parent / "saves"
+# Longest save name in bytes, so the file name stays within file system limits
+MAX_SAVE_NAME: int = 200
+# Characters that would let a save name reach outside the save folder
+_PATH_CHARS: str = "/\\\0"
+
+
+class _SessionSaveDir(threading.local):
+    """Save folder of the game running on the current thread, if it isn't SAVE_DIR"""
+    path: Optional[pathlib.Path] = None
+
+
+_session_save_dir = _SessionSaveDir()
+
+
+def save_dir() -> pathlib.Path:
+    """The folder saves are kept in. Each server session (see server.py) has its own"""
+    return _session_save_dir.path or SAVE_DIR
+
+
+def set_save_dir(path: Optional[pathlib.Path]):
+    """Sets the save folder of the current thread. None goes back to SAVE_DIR"""
+    _session_save_dir.path = path
+
+
+def is_valid_save_name(save_name: str) -> bool:
+    """Whether a typed save name is safe to use as a file name in the save folder"""
+    return bool(save_name.strip()) and ".." not in save_name and not any(
+        char in _PATH_CHARS for char in save_name) and len(
+            save_name.encode("utf-8")) <= MAX_SAVE_NAME
 
 
 class Game:
@@ -8,20 +47,67 @@ class Game:
     def __init__(self, story_progress: int = 0, player: Player = None):
         self.story_progress = story_progress
         self.player: Player = player or Player(1, ["Punch"])
+        # Map name -> bitset of the tiles the player has seen (see fov.py)
+        self.explored: Dict[str, bytearray] = {}
+        # Map name -> changes made to the map, like taken pickups
+        self.overlays: Dict[str, maps.Overlays] = {}
 
     @classmethod
     def from_save(cls, save_data: List[str]):
         """Create a game from a save file"""
         story_progress = int(save_data[0])
-        player = Player(int(save_data[1]), save_data[2].split("~"))
-        return cls(story_progress, player)
+        player = Player(int(save_data[1]),
+                        save_data[2].rstrip("\n").split("~"))
+        game = cls(story_progress, player)
+        # Saves from before fog of war don't have explored tiles
+        if len(save_data) > 3 and save_data[3].strip():
+            for entry in save_data[3].strip().split("~"):
+                map_name, explored = entry.split("=", 1)
+                game.explored[map_name] = fov.decode_explored(explored)
+        if len(save_data) > 4 and save_data[4].strip():
+            for map_name, layers in json.loads(save_data[4]).items():
+                game.overlays[map_name] = maps.Overlays.from_json(layers)
+        return game
+
+    def save_data(self) -> str:
+        """The contents of a save file for the current state of the game"""
+        explored = "~".join(f"{map_name}={fov.encode_explored(bits)}"
+                            for map_name, bits in self.explored.items())
+        # Only the changes are saved, the maps themselves are always loaded from the maps folder
+        overlays = json.dumps(
+            {
+                map_name: overlays.to_json()
+                for map_name, overlays in self.overlays.items()
+                if overlays.cells
+            },
+            separators=(",", ":"))
+        return f"{self.story_progress}\n{self.player.lvl}\n{'~'.join(self.player.skills)}\n{explored}\n{overlays}"
 
+    @staticmethod
+    def save_path(save_name: str) -> pathlib.Path:
+        """Path of a save file. The folder is made when the first save is written to it, see save_service"""
+        if not is_valid_save_name(save_name):
+            raise ValueError(f"Invalid save name: {save_name!r}")
+        return save_dir() / (save_name + ".save")
+
+    def _catalog_updater(self, save_name: str):
+        """Makes a function that records the current state in the save catalog"""
+        catalog = save_catalog.get_catalog(save_dir())
+        story_progress = self.story_progress
+        level = self.player.lvl
+        timestamp = time.time()
+        return lambda: catalog.update(save_name, story_progress, level,
+                                      timestamp)
+
+    @instrument.timed("game.make_save")
     def make_save(self, save_name: str):
-        """Save the game"""
-        game_dir = pathlib.Path(__file__).parent.parent
-        save_dir = game_dir / "saves"
-        save_dir.mkdir(exist_ok=True)
-        save_file = save_dir / (save_name + ".save")
-        save_data = f"{self.story_progress}\n{self.player.lvl}\n{'~'.join(self.player.skills)}"
-        with save_file.open("w") as f:
-            f.write(save_data)
+        """Save the game. Queued autosaves are written first, so they can't replace this save afterwards"""
+        save_service.flush()
+        save_service.write_atomic(self.save_path(save_name), self.save_data())
+        self._catalog_updater(save_name)()
+
+    @instrument.timed("game.autosave")
+    def autosave(self, save_name: str = "autosave"):
+        """Save the game in the background. Use save_service.flush() to wait for it to finish"""
+        save_service.request(self.save_path(save_name), self.save_data(),
+                             self._catalog_updater(save_name))
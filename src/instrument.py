@@ -0,0 +1,221 @@
+"""Counters and latency histograms for the game's subsystems.
+
+Functions decorated with timed record how long each call took, both in total and without the time spent in other
+timed functions they called (so story_print's own drawing can be told apart from the key waits inside it).
+Profiling is off unless the TEXTGAME_PROFILE environment variable is set (to the file to write the results to) or
+main.py is run with --profile. When it is off a timed function only costs one extra check per call.
+"""
+
+import atexit
+import csv
+import functools
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
+
+ENV_VAR: str = "TEXTGAME_PROFILE"
+DEFAULT_PATH: Path = Path("profile.json")
+# Histogram bucket n counts calls that took less than 2 ** n microseconds (and at least 2 ** (n - 1))
+BUCKETS: int = 32
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+class Histogram:
+
+    __slots__ = ("count", "total", "self_total", "min", "max", "buckets")
+
+    def __init__(self):
+        self.count: int = 0
+        self.total: float = 0.0
+        # Total without time spent in other timed functions
+        self.self_total: float = 0.0
+        self.min: float = float("inf")
+        self.max: float = 0.0
+        self.buckets: List[int] = [0] * BUCKETS
+
+    def add(self, elapsed: float, self_elapsed: float):
+        self.count += 1
+        self.total += elapsed
+        self.self_total += self_elapsed
+        self.min = min(self.min, elapsed)
+        self.max = max(self.max, elapsed)
+        self.buckets[min(int(elapsed * 1e6).bit_length(), BUCKETS - 1)] += 1
+
+    def percentile(self, fraction: float) -> float:
+        """Upper bound of the bucket the call at `fraction` of the way through the sorted calls fell in (seconds)"""
+        wanted = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= wanted:
+                return max(min(2**bucket / 1e6, self.max), self.min)
+        return self.max
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "total_s": self.total,
+            "self_s": self.self_total,
+            "mean_ms": self.total / self.count * 1e3 if self.count else 0.0,
+            "min_ms": self.min * 1e3 if self.count else 0.0,
+            "max_ms": self.max * 1e3,
+            "p50_ms": self.percentile(0.5) * 1e3,
+            "p90_ms": self.percentile(0.9) * 1e3,
+            "p99_ms": self.percentile(0.99) * 1e3,
+        }
+
+
+class Profiler:
+
+    def __init__(self):
+        self.enabled: bool = False
+        # Whether the results are written to path, rather than only read by the program (like replay.py)
+        self.saves_results: bool = False
+        self.path: Path = DEFAULT_PATH
+        self.histograms: Dict[str, Histogram] = {}
+        self.counters: Dict[str, int] = {}
+        # Per thread, time spent in timed functions called by each timed function that is running
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._exit_registered = False
+
+    def enable(self, path: Optional[Path] = None, dump_at_exit: bool = True):
+        """Starts recording. The results are written to path when the game exits"""
+        self.enabled = True
+        self.saves_results = self.saves_results or dump_at_exit
+        if path is not None:
+            self.path = path
+        if dump_at_exit and not self._exit_registered:
+            atexit.register(self.dump)
+            self._exit_registered = True
+
+    def record(self,
+               name: str,
+               elapsed: float,
+               self_elapsed: Optional[float] = None):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(elapsed,
+                          elapsed if self_elapsed is None else self_elapsed)
+
+    def count(self, name: str, amount: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def call(self, name: str, func: Callable[..., Any], *args,
+             **kwargs) -> Any:
+        """Calls func, recording how long it took under name"""
+        child_times: Optional[List[float]] = getattr(self._local, "child_time",
+                                                     None)
+        if child_times is None:
+            child_times = self._local.child_time = []
+        child_times.append(0.0)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            child_time = child_times.pop()
+            if child_times:
+                child_times[-1] += elapsed
+            self.record(name, elapsed, elapsed - child_time)
+
+    def results(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "timings": {
+                    name: histogram.summary()
+                    for name, histogram in sorted(self.histograms.items())
+                },
+                "counters": dict(sorted(self.counters.items())),
+            }
+
+    def dump(self, path: Optional[Path] = None) -> Path:
+        """Writes the results as JSON, or as CSV if path ends in .csv"""
+        path = path or self.path
+        results = self.results()
+        with open(path, "w", newline="") as f:
+            if path.suffix == ".csv":
+                fields = list(Histogram().summary())
+                writer = csv.writer(f)
+                writer.writerow(["name"] + fields)
+                for name, summary in results["timings"].items():
+                    writer.writerow([name] +
+                                    [summary[field] for field in fields])
+                for name, value in results["counters"].items():
+                    writer.writerow([name, value])
+            else:
+                json.dump(results, f, indent=2)
+        return path
+
+
+_profiler = Profiler()
+
+
+def timed(name: str) -> Callable[[F], F]:
+    """Decorator that records how long each call takes when profiling is enabled"""
+
+    def decorator(func: F) -> F:
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _profiler.enabled:
+                return func(*args, **kwargs)
+            return _profiler.call(name, func, *args, **kwargs)
+
+        return wrapper  # type: ignore
+
+    return decorator
+
+
+def enabled() -> bool:
+    return _profiler.enabled
+
+
+def saves_results() -> bool:
+    """Whether the results are written to a file, so the escape menu should offer to save them"""
+    return _profiler.saves_results
+
+
+def set_saves_results(saves: bool,
+                      path: Optional[Path] = None) -> Tuple[bool, Path]:
+    """Sets whether the escape menu offers to save the results, and the file they go to.
+    Returns the old settings, so replay.py can show the menu a recorded session had and put them back afterwards"""
+    old = (_profiler.saves_results, _profiler.path)
+    _profiler.saves_results = saves
+    if path is not None:
+        _profiler.path = path
+    return old
+
+
+def enable(path: Optional[Path] = None, dump_at_exit: bool = True):
+    _profiler.enable(path, dump_at_exit)
+
+
+def record(name: str, elapsed: float):
+    """Records a latency measured outside of a timed function"""
+    if _profiler.enabled:
+        _profiler.record(name, elapsed)
+
+
+def count(name: str, amount: int = 1):
+    if _profiler.enabled:
+        _profiler.count(name, amount)
+
+
+def results() -> Dict[str, Any]:
+    return _profiler.results()
+
+
+def dump(path: Optional[Path] = None) -> Path:
+    return _profiler.dump(path)
+
+
+if os.environ.get(ENV_VAR):
+    enable(Path(os.environ[ENV_VAR]) if os.environ[ENV_VAR] != "1" else None)
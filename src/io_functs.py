@@ -1,13 +1,51 @@
 import time
 import curses
-from typing import List, Sequence, TypeVar, Tuple, Union, NoReturn
+import bisect
+import threading
+from collections import deque
+from typing import Deque, List, Sequence, TypeVar, Tuple, Union, NoReturn
 import game_class
+import markup
+import terminal
+import save_service
+import keyloop
+import instrument
+import recording
 
 DOWN_KEYS: Tuple[int, int, int] = (curses.KEY_DOWN, ord('j'), ord('s'))
 RIGHT_KEYS: Tuple[int, int, int] = (curses.KEY_RIGHT, ord('l'), ord('d'))
 UP_KEYS: Tuple[int, int, int] = (curses.KEY_UP, ord('k'), ord('w'))
 LEFT_KEYS: Tuple[int, int, int] = (curses.KEY_LEFT, ord('h'), ord('a'))
 
+# Typewriter effect speed for story_print
+CHARS_PER_SECOND: int = 50
+FRAMES_PER_SECOND: int = 30
+# Seconds between the "..." after a story message appearing and disappearing
+DOTS_BLINK_DELAY: float = 0.7
+
+
+class _ScreenState(threading.local):
+    """Popup window bookkeeping for the screen the current thread draws to"""
+
+    def __init__(self):
+        # (begin_y, begin_x, size_y, size_x) of popup windows that have been closed,
+        # so whatever was drawn under them can be redrawn
+        self.closed_windows: Deque[Tuple[int, int, int,
+                                         int]] = deque(maxlen=32)
+        # (backend, window, in use) of the window reused by menu
+        self.menu_window: Union[Tuple[object, curses.window, bool],
+                                None] = None
+
+
+_screen_state = _ScreenState()
+
+
+def pop_closed_windows() -> List[Tuple[int, int, int, int]]:
+    """Gets the screen areas of every popup window closed since the last call"""
+    closed = list(_screen_state.closed_windows)
+    _screen_state.closed_windows.clear()
+    return closed
+
 
 def print_center(string: str,
                  line: int,
@@ -21,8 +59,8 @@ def print_center(string: str,
 def error_screen(error: str, stdscr: curses.window):
     """Prints an error message"""
     stdscr.clear()
-    print_center(error, curses.LINES // 2, stdscr, curses.A_STANDOUT)
-    stdscr.getch()
+    print_center(error, terminal.lines() // 2, stdscr, curses.A_STANDOUT)
+    keyloop.get_key(stdscr, "error")
 
 
 def clear_input(stdscr: curses.window):
@@ -35,31 +73,23 @@ def clear_input(stdscr: curses.window):
     stdscr.nodelay(False)
 
 
-def _get_attribute(char: str, stdscr: curses.window) -> int:
-    """Gets the curses attribute for a given attribute code"""
-    if char == "b": return curses.A_BOLD
-    if char == "i": return curses.A_ITALIC
-    if char == "u": return curses.A_UNDERLINE
-    if char == "n": return curses.A_NORMAL
-    error_screen("Invalid attribute tag", stdscr)
-    return curses.A_NORMAL
-
-
 def input_screen(prompt: str) -> str:
     """Gets a string input from the user"""
     size_y = 3
-    size_x = len(prompt) + curses.COLS // 2
-    begin_y: int = curses.LINES // 2 - size_y // 2
-    begin_x: int = curses.COLS // 2 - size_x // 2
-    inputscr = curses.newwin(size_y, size_x, begin_y, begin_x)
+    size_x = len(prompt) + terminal.cols() // 2
+    begin_y: int = terminal.lines() // 2 - size_y // 2
+    begin_x: int = terminal.cols() // 2 - size_x // 2
+    inputscr = terminal.newwin(size_y, size_x, begin_y, begin_x)
 
     inputscr.box()
     inputscr.addstr(1, 1, prompt)
     a = inputscr.getstr(1,
                         len(prompt) + 1,
                         size_x - len(prompt) - 2).decode("utf-8")
+    recording.record_text(a)
     inputscr.clear()
     inputscr.refresh()
+    _screen_state.closed_windows.append((begin_y, begin_x, size_y, size_x))
     return a
 
 
@@ -71,7 +101,7 @@ def valid_int_input(lower_limit: int,
     lower_limit and upper_limit are inclusive"""
     while True:
         scr.addstr(prompt)
-        curses.echo()
+        terminal.echo()
         user_input = scr.getstr()
         try:
             as_num = int(user_input)
@@ -81,78 +111,227 @@ def valid_int_input(lower_limit: int,
         if not lower_limit <= as_num <= upper_limit:
             # Does not fit between upper and lower limit
             continue
-        curses.noecho()
+        terminal.noecho()
         return as_num
 
 
 T = TypeVar("T")
 
 
+class PrefixIndex:
+    """Sorted index of the option strings of a menu. Narrows the matching options down one typed character at a time"""
+
+    def __init__(self, str_options: Sequence[str]):
+        self._sorted: List[Tuple[str, int]] = sorted(
+            (option.lower(), index)
+            for index, option in enumerate(str_options))
+        self._keys: List[str] = [key for key, _ in self._sorted]
+        # Range of matching options in self._sorted for each prefix typed so far
+        self._ranges: List[Tuple[int, int]] = [(0, len(self._sorted))]
+        self.query: str = ""
+
+    def push(self, char: str):
+        low, high = self._ranges[-1]
+        self.query += char
+        prefix = self.query.lower()
+        low = bisect.bisect_left(self._keys, prefix, low, high)
+        high = bisect.bisect_left(self._keys, prefix + "\U0010ffff", low, high)
+        self._ranges.append((low, high))
+
+    def pop(self):
+        if len(self._ranges) > 1:
+            self._ranges.pop()
+            self.query = self.query[:-1]
+
+    def __len__(self) -> int:
+        low, high = self._ranges[-1]
+        return high - low
+
+    def __getitem__(self, index: int) -> int:
+        """Gets the option index of the index-th matching option"""
+        return self._sorted[self._ranges[-1][0] + index][1]
+
+
+def _get_menu_window(size_y: int, size_x: int, begin_y: int,
+                     begin_x: int) -> curses.window:
+    """Reuses the last menu window if it isn't still open, otherwise makes a new one"""
+    backend = terminal.get_backend()
+    menu_window = _screen_state.menu_window
+    if menu_window is None or menu_window[0] is not backend or menu_window[2]:
+        window = terminal.newwin(size_y, size_x, begin_y, begin_x)
+    else:
+        window = menu_window[1]
+        # Move to the corner first so the resize can't push it off the screen
+        window.mvwin(0, 0)
+        window.resize(size_y, size_x)
+        window.mvwin(begin_y, begin_x)
+    _screen_state.menu_window = (backend, window, True)
+    return window
+
+
+def _release_menu_window(window: curses.window):
+    menu_window = _screen_state.menu_window
+    if menu_window is not None and menu_window[1] is window:
+        _screen_state.menu_window = (menu_window[0], window, False)
+
+
+def _draw_menu_row(menuscr: curses.window, row: int, text: str,
+                   selected: bool):
+    """Draws one option row of a menu, row 0 being the first visible option"""
+    width = menuscr.getmaxyx()[1]
+    menuscr.addstr(row + 2, 1, " " * (width - 2))
+    if text:
+        print_center(text[:width - 2], row + 2, menuscr,
+                     curses.A_REVERSE if selected else curses.A_NORMAL)
+
+
+@instrument.timed("io_functs.menu")
 def menu(options: Sequence[T],
          prompt: str,
-         prompt_attr: int = curses.A_BOLD) -> T:
-    """Lets the user choose from a selection of options, returns the chosen option"""
+         prompt_attr: int = curses.A_BOLD,
+         screen: str = "menu") -> T:
+    """Lets the user choose from a selection of options, returns the chosen option.
+    Long lists scroll. Pressing / lets the user type the start of an option to filter the list"""
     str_options: List[str] = list(map(str, options))
-    all_menu_things: List[str] = [prompt] + str_options
-
-    curses.update_lines_cols()
-    size_y: int = len(options) + 3
-    size_x: int = len(max(all_menu_things, key=len)) + 6
-    begin_y: int = curses.LINES // 2 - size_y // 2
-    begin_x: int = curses.COLS // 2 - size_x // 2
-    menuscr = curses.newwin(size_y, size_x, begin_y, begin_x)
+
+    terminal.update_lines_cols()
+    visible: int = max(1, min(len(options), terminal.lines() - 4))
+    size_y: int = visible + 3
+    size_x: int = min(
+        max(len(prompt), max(map(len, str_options), default=0)) + 6,
+        terminal.cols())
+    begin_y: int = terminal.lines() // 2 - size_y // 2
+    begin_x: int = terminal.cols() // 2 - size_x // 2
+    menuscr = _get_menu_window(size_y, size_x, begin_y, begin_x)
     menuscr.keypad(True)
-    curses.curs_set(0)
-    # From before I knew about scr.box
-    """
-    textpad.rectangle(stdscr, begin_y - 1, begin_x - 1, begin_y + size_y + 1,
-                      begin_x + size_x + 1)
-                      """
+    terminal.curs_set(0)
 
-    # Selection cycle
+    # The options currently shown, as indexes into options
+    view: Union[range, PrefixIndex] = range(len(options))
+    prefix_index: Union[PrefixIndex, None] = None
+    filtering: bool = False
+    # Indexes into view of the highlighted option and of the first visible row
     selected: int = 0
+    top: int = 0
+    redraw_all: bool = True
+
+    # Selection cycle
     while True:
-        index: int
-        item: str
-        for index, item in enumerate(str_options):
-            if index == selected:
-                print_center(item, index + 1 + 1, menuscr, curses.A_REVERSE)
+        if redraw_all:
+            menuscr.erase()
+            menuscr.box()
+            if filtering:
+                assert prefix_index is not None
+                menuscr.addstr(1, 2, ("/" + prefix_index.query)[:size_x - 4])
+            else:
+                print_center(prompt[:size_x - 2], 1, menuscr, prompt_attr)
+            for row in range(visible):
+                index = top + row
+                text = str_options[view[index]] if index < len(view) else ""
+                _draw_menu_row(menuscr, row, text, index == selected)
+            # Scroll markers on the border
+            if top > 0:
+                menuscr.addch(0, size_x - 3, "^")
+            if top + visible < len(view):
+                menuscr.addch(size_y - 1, size_x - 3, "v")
+            redraw_all = False
+        menuscr.refresh()
+
+        key: int = keyloop.get_key(menuscr, screen)
+        old_selected = selected
+        old_top = top
+        if key in (ord("\n"), curses.KEY_ENTER) or (key == ord(" ")
+                                                    and not filtering):
+            if not len(view):
                 continue
-            print_center(item, index + 1 + 1, menuscr)
-        menuscr.box()
-        print_center(prompt, 1, menuscr, prompt_attr)
-        key: int = menuscr.getch()
-        if key in UP_KEYS and selected > 0:
-            selected -= 1
-        elif key in DOWN_KEYS and selected < len(str_options) - 1:
-            selected += 1
-        elif key == ord("\n") or key == ord(" "):
             menuscr.clear()
             menuscr.refresh()
-            return options[selected]
+            _release_menu_window(menuscr)
+            _screen_state.closed_windows.append(
+                (begin_y, begin_x, size_y, size_x))
+            return options[view[selected]]
+        elif key == curses.KEY_UP or (key in UP_KEYS and not filtering):
+            selected = max(selected - 1, 0)
+        elif key == curses.KEY_DOWN or (key in DOWN_KEYS and not filtering):
+            selected = min(selected + 1, max(len(view) - 1, 0))
+        elif key == ord("/") and not filtering:
+            if prefix_index is None:
+                prefix_index = PrefixIndex(str_options)
+            filtering = True
+            view = prefix_index
+            selected = top = 0
+            redraw_all = True
+        elif filtering and key == 27:
+            filtering = False
+            while prefix_index and prefix_index.query:
+                prefix_index.pop()
+            view = range(len(options))
+            selected = top = 0
+            redraw_all = True
+        elif filtering and key in (curses.KEY_BACKSPACE, 127, 8):
+            assert prefix_index is not None
+            if not prefix_index.query:
+                filtering = False
+                view = range(len(options))
+            prefix_index.pop()
+            selected = top = 0
+            redraw_all = True
+        elif filtering and 32 <= key < 127:
+            assert prefix_index is not None
+            prefix_index.push(chr(key))
+            selected = top = 0
+            redraw_all = True
 
-        menuscr.refresh()
+        # Keep the highlighted option in view
+        if selected < top:
+            top = selected
+        elif selected >= top + visible:
+            top = selected - visible + 1
+        if top != old_top:
+            redraw_all = True
+        elif selected != old_selected and not redraw_all:
+            _draw_menu_row(menuscr, old_selected - top,
+                           str_options[view[old_selected]], False)
+            _draw_menu_row(menuscr, selected - top,
+                           str_options[view[selected]], True)
 
 
 def escape_menu(game: game_class.Game) -> Union[None, NoReturn]:
     """Escape menu"""
     options: List[str] = ["Resume", "Save", "Exit"]
-    option: str = menu(options, "Escape Menu")
+    if instrument.saves_results():
+        options.insert(2, "Save Profile")
+    option: str = menu(options, "Escape Menu", screen="escape menu")
     if option == "Save":
-        curses.echo()
-        curses.curs_set(1)
+        terminal.echo()
+        terminal.curs_set(1)
         save_name: str = input_screen("Save Name: ")
-        curses.noecho()
-        curses.curs_set(0)
+        while not game_class.is_valid_save_name(save_name):
+            # Names can't reach outside the save folder, which matters when players connect remotely
+            save_name = input_screen("Invalid name, try another: ")
+        terminal.noecho()
+        terminal.curs_set(0)
         game.make_save(save_name)
         return escape_menu(game)
+    elif option == "Save Profile":
+        instrument.dump()
+        return escape_menu(game)
     elif option == "Exit":
+        save_service.flush()
         exit()
     elif option == "Resume":
         return None
     raise ValueError("io_functs.menu returned a value it shouldn't have")
 
 
+def _draw_runs(compiled: markup.CompiledText, start: int, end: int,
+               stdscr: curses.window):
+    """Draws characters start to end of compiled text at the cursor"""
+    for attribute, run in markup.slice_runs(compiled.runs, start, end):
+        stdscr.addstr(run, attribute)
+
+
+@instrument.timed("io_functs.story_print")
 def story_print(text: str, stdscr: curses.window, game: Union[game_class.Game,
                                                               None]):
     """Prints a story message. `game` is needed for the escape menu.
@@ -163,40 +342,50 @@ def story_print(text: str, stdscr: curses.window, game: Union[game_class.Game,
     \`u - underline
     \`n - normal"""
     stdscr.clear()
-    # TODO: Implement attribute tags
-    attribute_delcaration: bool = False
-    attribute: int = curses.A_NORMAL
-    for char in text:
-        if char == "`":
-            attribute_delcaration = True
-            continue
-        if attribute_delcaration:
-            attribute = _get_attribute(char, stdscr)
-            attribute_delcaration = False
-            continue
-        stdscr.addch(char, attribute)
+    compiled = markup.compile_text(text, stdscr.getmaxyx()[1])
+    if compiled.invalid_tags:
+        error_screen("Invalid attribute tag", stdscr)
+        stdscr.clear()
+    # Typewriter effect, drawn a frame at a time. A keypress shows the rest at once
+    frame_delay = 1 / FRAMES_PER_SECOND
+    shown: int = 0
+    if not terminal.delays_enabled():
+        _draw_runs(compiled, shown, compiled.length, stdscr)
+        shown = compiled.length
+    start_time = time.monotonic()
+    while shown < compiled.length:
+        elapsed = time.monotonic() - start_time
+        target = min(compiled.length,
+                     max(shown + 1, int(elapsed * CHARS_PER_SECOND)))
+        _draw_runs(compiled, shown, target, stdscr)
+        shown = target
         stdscr.refresh()
-        time.sleep(0.02)
+        if shown < compiled.length and keyloop.get_key(
+                stdscr, "story animation", frame_delay) != curses.ERR:
+            _draw_runs(compiled, shown, compiled.length, stdscr)
+            shown = compiled.length
     stdscr.addch('\n')
     clear_input(stdscr)
     # Blinking dots effect
-    curses.halfdelay(7)
-    while True:
-        stdscr.addstr("...")
-        key = stdscr.getch()
-        if key in [27, ord('q')] and not game is None:
-            # Escape or q was pressed, display escape menu
-            escape_menu(game)
-            y, x = stdscr.getyx()
-            stdscr.move(y, x - 3)
-            continue
+    dots_y, dots_x = stdscr.getyx()
+    dots_visible: bool = False
 
-        if key != curses.ERR:
-            break
-        y, x = stdscr.getyx()
-        stdscr.move(y, x - 3)
-        stdscr.clrtoeol()
+    def toggle_dots():
+        nonlocal dots_visible
+        dots_visible = not dots_visible
+        stdscr.addstr(dots_y, dots_x, "..." if dots_visible else "   ")
         stdscr.refresh()
-        if stdscr.getch() != curses.ERR:
+
+    toggle_dots()
+    blinking = keyloop.call_every(DOTS_BLINK_DELAY, toggle_dots)
+    try:
+        while True:
+            key = keyloop.get_key(stdscr, "story")
+            if key in [27, ord('q')] and not game is None:
+                # Escape or q was pressed, display escape menu
+                escape_menu(game)
+                stdscr.touchwin()
+                continue
             break
-    curses.cbreak()
+    finally:
+        blinking.cancel()
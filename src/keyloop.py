@@ -0,0 +1,201 @@
+"""asyncio event loop for keyboard input and animations.
+
+Everything that waits for a key goes through get_key. While waiting, the loop sleeps until stdin is readable or the
+next timer is due, so an idle game uses no CPU. Timers made with call_later and call_every (animations, background
+work) run while the game is waiting for a key.
+
+Keys are routed to the active screen (map, menu, story, escape menu...). Hooks added with add_key_hook see every key
+read on a screen and can swallow it.
+
+Each thread gets its own loop the first time it reads a key, so server sessions (see server.py) don't share screens,
+hooks or timers.
+"""
+
+import asyncio
+import contextlib
+import curses
+import selectors
+import threading
+from typing import Callable, Dict, Iterator, List, Optional
+import terminal
+import instrument
+
+KeyHook = Callable[[str, int], bool]
+
+
+class KeyLoop:
+
+    def __init__(self):
+        self._loop = asyncio.SelectorEventLoop(selectors.DefaultSelector())
+        self._screens: List[str] = []
+        # Screen name ("*" for every screen) -> hooks
+        self._hooks: Dict[str, List[KeyHook]] = {}
+
+    # Screens
+    @contextlib.contextmanager
+    def screen(self, name: str) -> Iterator[None]:
+        """Makes name the active screen while in the with block"""
+        self._screens.append(name)
+        try:
+            yield
+        finally:
+            self._screens.pop()
+
+    @property
+    def active_screen(self) -> str:
+        return self._screens[-1] if self._screens else ""
+
+    def add_key_hook(self, hook: KeyHook, screen: str = "*"):
+        """Calls hook(screen, key) for every key read on screen. If it returns True the key is swallowed"""
+        self._hooks.setdefault(screen, []).append(hook)
+
+    def remove_key_hook(self, hook: KeyHook, screen: str = "*"):
+        self._hooks.get(screen, []).remove(hook)
+
+    def close(self):
+        self._loop.close()
+
+    def _swallowed(self, screen: str, key: int) -> bool:
+        for hook in self._hooks.get(screen, []) + self._hooks.get("*", []):
+            if hook(screen, key):
+                return True
+        return False
+
+    # Timers
+    def call_later(self, delay: float,
+                   callback: Callable[[], object]) -> asyncio.TimerHandle:
+        return self._loop.call_later(delay, callback)
+
+    def call_every(self, interval: float,
+                   callback: Callable[[], object]) -> "Repeating":
+        return Repeating(self, interval, callback)
+
+    # Input
+    @instrument.timed("keyloop.get_key")
+    def get_key(self,
+                window: curses.window,
+                screen: Optional[str] = None,
+                timeout: Optional[float] = None) -> int:
+        """Waits for a key on window. Returns curses.ERR if timeout seconds pass first"""
+        screen = screen or self.active_screen
+        with self.screen(screen):
+            while True:
+                key = self._loop.run_until_complete(
+                    self._read_key(window, timeout))
+                if key == curses.ERR or not self._swallowed(screen, key):
+                    return key
+
+    async def _read_key(self, window: curses.window,
+                        timeout: Optional[float]) -> int:
+        fileno = terminal.fileno()
+        if fileno is None:
+            # Scripted input, the next key is always ready
+            return window.getch()
+        window.nodelay(True)
+        try:
+            key = window.getch()
+            if key != curses.ERR:
+                return key
+            future: "asyncio.Future[int]" = self._loop.create_future()
+
+            def on_readable():
+                try:
+                    read = window.getch()
+                except Exception as e:
+                    # Like a disconnected player. Raised from get_key instead of being lost in the loop
+                    if not future.done():
+                        future.set_exception(e)
+                    return
+                if read != curses.ERR and not future.done():
+                    future.set_result(read)
+
+            try:
+                self._loop.add_reader(fileno, on_readable)
+            except (NotImplementedError, OSError, ValueError):
+                # stdin can't be waited on here (Windows), poll instead
+                return await self._poll_key(window, timeout)
+            try:
+                return await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                return curses.ERR
+            finally:
+                self._loop.remove_reader(fileno)
+        finally:
+            window.nodelay(False)
+
+    async def _poll_key(self, window: curses.window,
+                        timeout: Optional[float]) -> int:
+        waited = 0.0
+        while timeout is None or waited < timeout:
+            key = window.getch()
+            if key != curses.ERR:
+                return key
+            await asyncio.sleep(0.01)
+            waited += 0.01
+        return curses.ERR
+
+
+class Repeating:
+    """Calls a callback every interval seconds until cancelled"""
+
+    def __init__(self, key_loop: KeyLoop, interval: float,
+                 callback: Callable[[], object]):
+        self._key_loop = key_loop
+        self._interval = interval
+        self._callback = callback
+        self._handle = key_loop.call_later(interval, self._fire)
+
+    def _fire(self):
+        self._callback()
+        self._handle = self._key_loop.call_later(self._interval, self._fire)
+
+    def cancel(self):
+        self._handle.cancel()
+
+
+class _ThreadKeyLoop(threading.local):
+    key_loop: Optional[KeyLoop] = None
+
+
+_current = _ThreadKeyLoop()
+
+
+def _key_loop() -> KeyLoop:
+    """The current thread's loop"""
+    if _current.key_loop is None:
+        _current.key_loop = KeyLoop()
+    return _current.key_loop
+
+
+def close():
+    """Closes the current thread's loop, for threads that are about to finish"""
+    if _current.key_loop is not None:
+        _current.key_loop.close()
+        _current.key_loop = None
+
+
+def get_key(window: curses.window,
+            screen: Optional[str] = None,
+            timeout: Optional[float] = None) -> int:
+    return _key_loop().get_key(window, screen, timeout)
+
+
+def screen(name: str):
+    return _key_loop().screen(name)
+
+
+def call_later(delay: float,
+               callback: Callable[[], object]) -> asyncio.TimerHandle:
+    return _key_loop().call_later(delay, callback)
+
+
+def call_every(interval: float, callback: Callable[[], object]) -> Repeating:
+    return _key_loop().call_every(interval, callback)
+
+
+def add_key_hook(hook: KeyHook, screen: str = "*"):
+    _key_loop().add_key_hook(hook, screen)
+
+
+def remove_key_hook(hook: KeyHook, screen: str = "*"):
+    _key_loop().remove_key_hook(hook, screen)
@@ -1,74 +1,310 @@
 from pathlib import Path
+import argparse
 import curses
+import time
 import curses.textpad as textpad
-from typing import NoReturn, Sequence, Any, List, Tuple, Union, TypeVar
+from typing import Callable, Dict, NoReturn, Sequence, Any, List, Tuple, Union, TypeVar
 import io_functs
 from io_functs import story_print, menu, escape_menu
 import game_class
 import maps
+import chunks
 import enemies
+import render
+import entities
+import fov
+import save_catalog
+import terminal
+import keyloop
+import story
+import instrument
+import recording
 
 DOWN_KEYS: Tuple[int, int, int] = (curses.KEY_DOWN, ord('j'), ord('s'))
 RIGHT_KEYS: Tuple[int, int, int] = (curses.KEY_RIGHT, ord('l'), ord('d'))
 UP_KEYS: Tuple[int, int, int] = (curses.KEY_UP, ord('k'), ord('w'))
 LEFT_KEYS: Tuple[int, int, int] = (curses.KEY_LEFT, ord('h'), ord('a'))
+# Smallest terminal the menus and story fit in. Maps that don't fit scroll
+MIN_LINES: int = 15
+MIN_COLS: int = 60
+# Enemy attacks in one round beyond this are summed up in one message
+MAX_ATTACK_MESSAGES: int = 6
+AUTO_BATTLE: str = "Auto Battle"
+CLOSE_LOG: str = "Close log"
+# Enemy kind in a story battle step -> function that makes a group of them
+ENEMY_WAVES: Dict[str, Callable[[int, int], enemies.CombatantPool]] = {
+    "slime": enemies.slime_wave
+}
 
 
 def load_game_menu(stdscr: curses.window) -> game_class.Game:
     """Menu for loading a game"""
-    game_dir = Path(__file__).parent.parent
-    save_dir = game_dir / "saves"
-    save_dir.mkdir(exist_ok=True)
-    save_files: List[Path] = list(save_dir.glob("*.save"))
-    if not save_files:
+    catalog = save_catalog.get_catalog(game_class.save_dir())
+    saves: List[save_catalog.CatalogEntry] = catalog.entries()
+    if not saves:
         io_functs.error_screen("No save files found.", stdscr)
         return main(stdscr)
-    save_names: List[str] = [save_file.stem for save_file in save_files]
-    save_name: str = io_functs.menu(save_names, "Load Save")
-    save_file: Path = save_dir / (save_name + ".save")
-    with save_file.open("r") as f:
-        save_data: List[str] = f.readlines()
+    save: save_catalog.CatalogEntry = io_functs.menu(saves, "Load Save")
+    save_file: Path = game_class.Game.save_path(save.name)
+    try:
+        with save_file.open("r") as f:
+            save_data: List[str] = f.readlines()
+    except FileNotFoundError:
+        catalog.remove(save.name)
+        io_functs.error_screen("That save file no longer exists.", stdscr)
+        return main(stdscr)
     return game_class.Game.from_save(save_data)
 
 
-def battle_menu(enemies: List[enemies.Combatant], game: game_class.Game,
+@instrument.timed("main.battle_menu")
+def battle_menu(foes: enemies.CombatantPool, game: game_class.Game,
                 stdscr: curses.window) -> None:
-    while enemies:
-        action = menu(game.player.skills, "Choose an action")
-        enemy = menu(enemies, "Choose an enemy")
-        player_turns = game.player.turns
+    player = game.player
+    # Auto battle goes on with the last skill used, or the strongest one if none was used yet
+    action = player.strongest_skill()
+    enemy = None
+    while foes.alive_count:
+        choice = menu(player.skills + [AUTO_BATTLE], "Choose an action")
+        if choice == AUTO_BATTLE:
+            auto_battle_menu(foes, game, stdscr, action, enemy)
+            return
+        action = choice
+        enemy = menu(foes.living(), "Choose an enemy")
+        player_turns = player.turns
 
         while player_turns > 0:
-            if action == "Punch":
-                story_print(game.player.punch(enemy), stdscr, game)
-            elif action == "Sword Strike":
-                story_print(game.player.sword_strike(enemy), stdscr, game)
+            story_print(player.use_skill(action, enemy), stdscr, game)
 
-            if enemy.hp <= 0:
+            if not enemy.alive:
                 story_print(f"{enemy.name} has been defeated!", stdscr, game)
-                enemies.remove(enemy)
+                break
             player_turns -= 1
 
-        for enemy in enemies:
-            enemy_turns = enemy.turns
-            while enemy_turns > 0:
-                story_print(enemy.attack(game.player), stdscr, game)
-                if game.player.hp <= 0:
-                    story_print("You have been defeated!", stdscr, game)
+        if not foes.alive_count:
+            break
+        hp_before = player.hp
+        hits = foes.attack_all(player)
+        if len(hits) > MAX_ATTACK_MESSAGES:
+            story_print(
+                f"{foes.alive_count} enemies attacked you {len(hits)} times for `b{hp_before - player.hp} `ndamage.",
+                stdscr, game)
+        else:
+            hp = hp_before
+            for index, damage in hits:
+                hp -= damage
+                story_print(
+                    f"{foes.names[index]} attacked {player.name} for `b{damage} `ndamage.",
+                    stdscr, game)
+                if hp > 0:
+                    story_print(f"You have {hp} HP left.", stdscr, game)
+        if player.hp <= 0:
+            story_print("You have been defeated!", stdscr, game)
+            return
+        if len(hits) > MAX_ATTACK_MESSAGES:
+            story_print(f"You have {player.hp} HP left.", stdscr, game)
+
+
+def auto_battle_menu(foes: enemies.CombatantPool, game: game_class.Game,
+                     stdscr: curses.window, action: str,
+                     enemy: Union[enemies.Combatant, None]) -> None:
+    """Resolves the rest of a battle in one step, then shows what happened"""
+    policy_name = menu(list(enemies.AUTO_POLICIES), "Choose a policy")
+    log = enemies.CombatLog()
+    result = enemies.auto_battle(game.player, foes,
+                                 enemies.AUTO_POLICIES[policy_name], action,
+                                 enemy, log)
+    story_print(str(result), stdscr, game)
+    if log.dropped:
+        title = f"Combat log (last {len(log)} of {len(log) + log.dropped} lines)"
+    else:
+        title = "Combat log"
+    menu(list(log) + [CLOSE_LOG], title)
+
+
+class Exploration:
+    """A map the player is walking around on"""
+
+    def __init__(self, game: game_class.Game, map_name: str):
+        self.game = game
+        terminal.update_lines_cols()
+        # Changes to the map made while playing, like taken pickups. Kept in saves
+        self.overlays = game.overlays.setdefault(map_name, maps.Overlays())
+        loaded = chunks.load_map(map_name)
+        self.map: Union[maps.Map,
+                        chunks.ChunkedMap] = loaded.layered(self.overlays)
+        self.renderer: Union[render.MapRenderer, render.ViewportRenderer]
+        fits = (isinstance(self.map, maps.Map)
+                and self.map.LINES <= terminal.lines()
+                and self.map.COLS <= terminal.cols())
+        if fits:
+            mapy = terminal.lines() // 2 - self.map.LINES // 2
+            mapx = terminal.cols() // 2 - self.map.COLS // 2
+            self.window = terminal.newwin(self.map.LINES, self.map.COLS, mapy,
+                                          mapx)
+            self.renderer = render.MapRenderer(self.window, self.map)
+        else:
+            # Too big for the screen, show the part around the player
+            view_lines = min(terminal.lines(), self.map.height)
+            view_cols = min(terminal.cols(), self.map.width)
+            view_y = (terminal.lines() - view_lines) // 2
+            view_x = (terminal.cols() - view_cols) // 2
+            # Only used for reading keys. Drawn once now, so reading keys doesn't draw it over the map
+            self.window = terminal.newwin(1, 1, view_y, view_x)
+            self.window.refresh()
+            self.renderer = render.ViewportRenderer(self.map, view_y, view_x,
+                                                    view_lines, view_cols)
+        self.window.keypad(True)
+        self.world = entities.World.from_map(self.map)
+        self.player = self.world.add(
+            entities.Entity("player", self.map.get_starting_pos(),
+                            render.PLAYER))
+        self.renderer.world = self.world
+        self.fov = fov.FieldOfView(self.map, game.explored.get(map_name))
+        game.explored[map_name] = self.fov.explored
+        self.renderer.fov = self.fov
+        # The pickup the player is standing on while its handler runs
+        self.pickup: Union[entities.Pickup, None] = None
+
+    def swap_map(self, map_name: str):
+        """Switches to a version of the map with something changed, like the sword gone"""
+        self.close()
+        self.map = chunks.load_map(map_name).layered(self.overlays)
+        self.world.set_map(self.map)
+        self.fov.set_map(self.map)
+        self.renderer.set_map(self.map)
+
+    def change_tiles(self, layer: str, cells: Dict[maps.Cell, maps.CellValue]):
+        """Changes tiles of the map in an overlay layer, like opening a door. Only the changed cells are redrawn"""
+        changed = self.map.apply(layer, cells)
+        if not changed:
+            return
+        for cell in changed:
+            self.fov.set_opaque(cell, not self.map.is_passable(cell))
+        # Paths are worked out again the next time something needs one, see World.navigator
+        self.renderer.mark_dirty(changed)
+
+    def close(self):
+        """Closes the world file of a chunked map"""
+        if isinstance(self.map, chunks.ChunkedMap):
+            self.map.close()
+
+    def take(self):
+        """Removes the pickup the player is standing on, and its tiles from the map"""
+        if self.pickup is not None:
+            self.world.remove(self.pickup)
+            self.change_tiles(maps.TAKEN_LAYER,
+                              {cell: (" ", " ")
+                               for cell in self.pickup.cells})
+
+    def run(self, on_pickup: Callable[[entities.Pickup], object]):
+        """Lets the player walk around until they reach an exit. Calls on_pickup while they stand on a pickup"""
+        try:
+            key_time = None
+            while True:
+                # Draw player and whatever changed since the last frame
+                self.fov.update(self.player.pos)
+                self.renderer.move_player(self.player.pos)
+                self.renderer.flush()
+                self.world.sync_chunks()
+                if key_time is not None:
+                    instrument.record("map.key_to_redraw",
+                                      time.perf_counter() - key_time)
+                # Input
+                key = keyloop.get_key(self.window, "map")
+                key_time = time.perf_counter()
+                # Figure out player's new position
+                pos = find_new_pos(self.game, self.map, self.window, key,
+                                   [self.player.pos[0], self.player.pos[1], 0])
+                self.world.move(self.player, pos)
+                self.world.advance()
+                for entity in self.world.entities_at(self.player.pos):
+                    if isinstance(entity, entities.Pickup):
+                        self.pickup = entity
+                        on_pickup(entity)
+                        self.pickup = None
+                # Redraw the map under any menus that were closed
+                self.renderer.restore_regions(io_functs.pop_closed_windows())
+                if self.map.get_trigger(self.player.pos) == -1:
+                    self.window.clear()
                     return
-                story_print(f"You have {game.player.hp} HP left.", stdscr,
-                            game)
-                enemy_turns -= 1
+        finally:
+            self.close()
+
+
+def run_steps(steps: Sequence[story.Step],
+              pc: int,
+              game: game_class.Game,
+              stdscr: curses.window,
+              exploration: Union[Exploration, None] = None) -> bool:
+    """Runs compiled story steps from steps[pc] until a return or the last step.
+    Returns False if the story ended"""
+    while pc < len(steps):
+        step = steps[pc]
+        command = step[0]
+        pc += 1
+        if command == "print":
+            story_print(step[1], stdscr, game)
+        elif command == "clear":
+            stdscr.clear()
+            stdscr.refresh()
+        elif command == "advance":
+            game.story_progress += 1
+        elif command == "autosave":
+            game.autosave()
+        elif command == "grant":
+            if step[1] not in game.player.skills:
+                game.player.skills.append(step[1])
+        elif command == "battle":
+            _, kind, lvl, count = step
+            if kind not in ENEMY_WAVES:
+                raise story.StoryError(f"Unknown enemy: {kind}")
+            battle_menu(ENEMY_WAVES[kind](lvl, count), game, stdscr)
+        elif command == "choice":
+            _, prompt, options, targets = step
+            pc = targets[options.index(menu(list(options), prompt))]
+        elif command == "jump":
+            pc = step[1]
+        elif command == "map":
+            _, map_name, handlers, pc = step
+            map_exploration = Exploration(game, map_name)
+
+            def on_pickup(pickup: entities.Pickup):
+                if pickup.number in handlers:
+                    run_steps(steps, handlers[pickup.number], game, stdscr,
+                              map_exploration)
+
+            map_exploration.run(on_pickup)
+        elif command == "take":
+            if exploration is not None:
+                exploration.take()
+        elif command == "swap_map":
+            if exploration is not None:
+                exploration.swap_map(step[1])
+        elif command == "return":
+            return True
+        elif command == "end":
+            return False
+    return True
+
+
+def run_story(game: game_class.Game, stdscr: curses.window):
+    """Plays the story from game.story_progress until it ends"""
+    the_story = story.get_story()
+    while True:
+        section = the_story.section(game.story_progress)
+        if section is None or not run_steps(section[1], 0, game, stdscr):
+            return
 
 
-def find_new_pos(game: game_class.Game, map: maps.Map, mapscr: curses.window,
-                 key: int, pos: List[int]) -> List[int]:
+@instrument.timed("main.find_new_pos")
+def find_new_pos(game: game_class.Game, map: Union[maps.Map,
+                                                   chunks.ChunkedMap],
+                 mapscr: curses.window, key: int, pos: List[int]) -> List[int]:
     """Gets input and returns new player position
-    [2] is 1 if the player is on interactable 1 tile, -1 if player is on exit tile, 0 otherwise"""
+    [2] is n if the player is on interactable n tile, -1 if player is on exit tile, 0 otherwise"""
     old_pos = pos.copy()
     if key == ord("q") or key == 27:
         escape_menu(game)
-        mapscr.redrawwin()
     elif key in DOWN_KEYS and pos[0] < map.LINES - 1:
         pos[0] += 1
     elif key in RIGHT_KEYS and pos[1] < map.COLS - 1:
@@ -78,135 +314,52 @@ def find_new_pos(game: game_class.Game, map: maps.Map, mapscr: curses.window,
     elif key in LEFT_KEYS and pos[1] > 0:
         pos[1] -= 1
 
-    if map.get_metamap_char(pos) == "#":
+    if not map.is_passable(pos):
         # User moved into a wall, so don't move them
         return old_pos
     # pos[2] is used to tell main if the player moved into a special zone
-    elif map.get_metamap_char(pos) == "%":
-        pos[2] = 1
-    elif map.get_metamap_char(pos) == "e":
-        pos[2] = -1
-    elif map.get_metamap_char(pos) == " ":
-        pos[2] = 0
+    pos[2] = map.get_trigger(pos)
     return pos
 
 
 def main(stdscr: curses.window):
     """Main menu"""
-    curses.curs_set(0)
-    while curses.LINES < 25 or curses.COLS < 85:
+    terminal.curs_set(0)
+    while terminal.lines() < MIN_LINES or terminal.cols() < MIN_COLS:
         story_print(
-            "Please resize your terminal to at least 25 lines and 85 columns.",
+            f"Please resize your terminal to at least {MIN_LINES} lines and {MIN_COLS} columns.",
             stdscr, None)
-        curses.update_lines_cols()
+        terminal.update_lines_cols()
     stdscr.clear()
     options: List[str] = ["New Game", "Load Save", "Exit"]
     option: str = io_functs.menu(options, "Main Menu")
     if option == "Exit": exit()
     elif option == "New Game": game = game_class.Game()
     elif option == "Load Save": game = load_game_menu(stdscr)
-    PLAYER: str = "@"
-    while True:
-        if game.story_progress == 0:
-            # Intro
-            story_print(
-                "You wake up. The ground is hard. You open your eyes and see that you are in a cave. ",
-                stdscr, game)
-            story_print(
-                "`iWhy am I in a cave? `nyou think to yourself. You try your best to remember how you got there.",
-                stdscr, game)
-            story_print("You think back to that the last thing you remember.",
-                        stdscr, game)
-            story_print(
-                "You were standing in the subway station, waiting for your train home.",
-                stdscr, game)
-            story_print(
-                "As the train started to pull into the station, someone shoved you forward, off the platform.",
-                stdscr, game)
-            story_print("The train instantly killed you.", stdscr, game)
-            story_print("`bYou were murdered.", stdscr, game)
-            story_print(
-                "As this realization sinks in, you look around in the cave you are sitting in.",
-                stdscr, game)
-            stdscr.clear()
-            stdscr.refresh()
-            game.story_progress += 1
-            game.make_save("autosave")
-        elif game.story_progress == 1:
-            # Cave exploration
-            curses.update_lines_cols()
-            current_map: maps.Map = maps.Map.from_name("cave")
-            mapy = curses.LINES // 2 - current_map.LINES // 2
-            mapx = curses.COLS // 2 - current_map.COLS // 2
-            mapscr = curses.newwin(current_map.LINES, current_map.COLS, mapy,
-                                   mapx)
-            mapscr.addstr(current_map.as_str)
-            mapscr.keypad(True)
-            pos: List[int] = list(current_map.get_starting_pos())
-
-            while True:
-                # Draw player
-                mapscr.addch(pos[0], pos[1], PLAYER, curses.A_BOLD)
-                mapscr.refresh()
-                # Input
-                key = mapscr.getch()
-                # Delete old player
-                mapscr.addch(pos[0], pos[1],
-                             current_map.as_list[pos[0]][pos[1]])
-                # Figure out player's new position
-                pos = find_new_pos(game, current_map, mapscr, key, pos)
-                if pos[2] == 1:
-                    choice = io_functs.menu(
-                        ["Pick up the sword", "Leave it"],
-                        "You see a sword on the ground. What do you do?")
-                    if choice == "Pick up the sword":
-                        current_map = maps.Map.from_name("cave_no_sword")
-                        mapscr.addstr(0, 0, current_map.as_str)
-                        game.player.skills.append("Sword Strike")
-                        if io_functs.menu(
-                            ["Great!", "idk that sounds pretty mid"],
-                                "You gained a new skill: Sword Strike!"
-                        ) == "idk that sounds pretty mid":
-                            io_functs.menu(["Continue"], "Be Greatful")
-                    mapscr.redrawwin()
-                if pos[2] == -1:
-                    mapscr.clear()
-                    game.story_progress += 1
-                    game.make_save("autosave")
-                    break
-        elif game.story_progress == 2:
-            # After getting out of the cave
-            io_functs.story_print(
-                "As you walk out of the cave, you find yourself in a forest.",
-                stdscr, game)
-            io_functs.story_print(
-                "As you are looking around, you stuble upon a small group of 3 slimes.",
-                stdscr, game)
-            io_functs.story_print("Or at least that is what they look like.",
-                                  stdscr, game)
-            io_functs.story_print("`iI guess I am in a different world now.",
-                                  stdscr, game)
-            io_functs.story_print(
-                "As you look at the slimes, you prepare for battle.", stdscr,
-                game)
-            stdscr.clear()
-            stdscr.refresh()
-            game.story_progress += 1
-            game.make_save("autosave")
-        elif game.story_progress == 3:
-            # Slime battle
-            slimes: List[enemies.Combatant] = [
-                enemies.Slime(1, num + 1) for num in range(3)
-            ]
-            battle_menu(slimes, game, stdscr)
-            game.story_progress += 1
-            game.make_save("autosave")
-        else:
-            story_print(
-                "To be continued... (This is all the game content I have developed so far)",
-                stdscr, game)
-            return
+    recording.set_game(game)
+    run_story(game, stdscr)
 
 
 if __name__ == "__main__":
-    curses.wrapper(main)
+    parser = argparse.ArgumentParser(description="A basic text game")
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const=instrument.DEFAULT_PATH,
+        type=Path,
+        metavar="PATH",
+        help="record timings and write them to PATH (.json or .csv) on exit")
+    parser.add_argument(
+        "--record",
+        type=Path,
+        metavar="PATH",
+        help="record the session to a trace file for replay.py")
+    args = parser.parse_args()
+    if args.profile:
+        instrument.enable(args.profile)
+    if args.record:
+        recording.start_recording(args.record)
+    try:
+        curses.wrapper(main)
+    finally:
+        recording.finish_recording()
@@ -1,8 +1,209 @@
 from pathlib import Path
-from typing import List
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+import abc
+import copy
+import hashlib
+import os
+import struct
+import threading
 
+# Compiled map format (.mapc):
+# header: magic, format version, rows, columns
+# followed by rows * columns bytes of map tiles and then rows * columns bytes of map data
+MAPC_MAGIC: bytes = b"TGMC"
+MAPC_VERSION: int = 1
+MAPC_HEADER = struct.Struct("<4sHII")
+MAP_CACHE_SIZE: int = 16
+# Compiled maps are build output, so they go in the user's cache folder instead of the game's maps folder
+COMPILED_DIR: Path = Path(
+    os.environ.get("XDG_CACHE_HOME") or os.environ.get("LOCALAPPDATA")
+    or Path.home() / ".cache") / "text-game" / "maps"
 
-class Map:
+# Tile classes, built from the .mapdata symbols when a map is loaded
+FLOOR: int = 0
+WALL: int = 1
+EXIT: int = 2
+START: int = 3
+# Interactable n has the tile class INTERACTABLE + n - 1
+INTERACTABLE: int = 8
+# Symbols for Interactable 1, Interactable 2, ...
+INTERACTABLE_SYMBOLS: str = "%&$*+=?!"
+# Symbols whose coordinates are indexed when a map is loaded
+INDEXED_SYMBOLS: str = "eS" + INTERACTABLE_SYMBOLS
+
+_SYMBOL_CLASSES: Dict[str, int] = {
+    "#": WALL,
+    "e": EXIT,
+    "S": START,
+    **{
+        symbol: INTERACTABLE + number
+        for number, symbol in enumerate(INTERACTABLE_SYMBOLS)
+    }
+}
+_CLASS_TABLE: bytes = bytes(
+    _SYMBOL_CLASSES.get(chr(char), FLOOR) for char in range(256))
+_PASSABLE_TABLE: bytes = bytes(0 if tile == WALL else 1 for tile in range(256))
+# Tile class -> value find_new_pos stores in pos[2]
+_TRIGGERS: Tuple[int, ...] = ((0, 0, -1) + (0, ) * (INTERACTABLE - 3) +
+                              tuple(range(1,
+                                          len(INTERACTABLE_SYMBOLS) + 1)))
+
+Cell = Tuple[int, int]
+# What an overlay puts in a cell: (map tile, map data symbol)
+CellValue = Tuple[str, str]
+# Overlay layer the story's take command clears pickups in
+TAKEN_LAYER: str = "taken"
+
+
+def classify_tiles(map_data: bytes) -> bytes:
+    """Turns .mapdata symbols (latin-1 encoded) into tile classes"""
+    return map_data.translate(_CLASS_TABLE)
+
+
+def trigger_of(tile_class: int) -> int:
+    """The value Map.get_trigger gives for a tile class"""
+    return _TRIGGERS[tile_class]
+
+
+def passability_of(tile_classes: bytes) -> bytes:
+    """Turns tile classes into 1 for every tile that isn't a wall and 0 for walls"""
+    return tile_classes.translate(_PASSABLE_TABLE)
+
+
+class Overlays:
+    """Named layers of sparse changes to a map (removed items, opened doors...), later layers on top.
+    Kept apart from the map, so the map itself can be shared and only the changes need to be saved"""
+
+    def __init__(self):
+        self.layers: Dict[str, Dict[Cell, CellValue]] = {}
+        # Top value of every changed cell
+        self.cells: Dict[Cell, CellValue] = {}
+
+    def apply(self, layer: str, cells: Dict[Cell, CellValue]) -> List[Cell]:
+        """Puts cells in a layer, making it if it doesn't exist. Returns the cells whose top value changed"""
+        for tile, symbol in cells.values():
+            if len(tile) != 1 or len(symbol) != 1:
+                raise ValueError(
+                    "Overlay cells are one map tile and one map data symbol.")
+        self.layers.setdefault(layer, {}).update(cells)
+        changed: List[Cell] = []
+        for cell in cells:
+            top = self._top(cell)
+            if self.cells.get(cell) != top:
+                self.cells[cell] = top
+                changed.append(cell)
+        return changed
+
+    def remove(self, layer: str, cells: Iterable[Cell]) -> List[Cell]:
+        """Takes cells out of a layer, showing what is under them again. A layer left empty is removed.
+        Returns the cells whose top value changed"""
+        layer_cells = self.layers.get(layer, {})
+        changed: List[Cell] = []
+        for cell in cells:
+            if layer_cells.pop(cell, None) is None:
+                continue
+            top = self._top(cell)
+            if top is None:
+                del self.cells[cell]
+            elif self.cells[cell] == top:
+                continue
+            else:
+                self.cells[cell] = top
+            changed.append(cell)
+        if layer in self.layers and not layer_cells:
+            del self.layers[layer]
+        return changed
+
+    def _top(self, cell: Cell) -> Optional[CellValue]:
+        for layer in reversed(list(self.layers.values())):
+            if cell in layer:
+                return layer[cell]
+        return None
+
+    def to_json(self) -> Dict[str, List[List[Any]]]:
+        return {
+            name: [[y, x, tile, symbol]
+                   for (y, x), (tile, symbol) in cells.items()]
+            for name, cells in self.layers.items()
+        }
+
+    @classmethod
+    def from_json(cls, data: Dict[str, List[List[Any]]]):
+        overlays = cls()
+        for name, cells in data.items():
+            overlays.apply(name, {
+                (y, x): (tile, symbol)
+                for y, x, tile, symbol in cells
+            })
+        return overlays
+
+
+class LayeredMap(abc.ABC):
+    """Overlay handling shared by Map and chunks.ChunkedMap. Subclasses give the tiles under the overlays"""
+
+    # Goes up whenever overlays change cells, so things worked out from the map (like paths) know they are stale
+    overlay_version: int = 0
+
+    def _set_overlays(self, overlays: Optional[Overlays]):
+        """Puts overlays on top of the map, replacing the ones that were there"""
+        self.overlays: Overlays = overlays or Overlays()
+        # Tile class of each cell an overlay changed, and the changed columns of each row
+        self._overlay_classes: Dict[Cell, int] = {}
+        self._overlay_rows: Dict[int, List[int]] = {}
+        self._refresh_overlays(list(self.overlays.cells))
+
+    def apply(self, layer: str, cells: Dict[Cell, CellValue]) -> List[Cell]:
+        """Changes cells in an overlay layer. Returns the cells that look or act differently now"""
+        self._check_changeable()
+        changed = self.overlays.apply(layer, cells)
+        self._refresh_overlays(changed)
+        return changed
+
+    def remove(self, layer: str, cells: Iterable[Cell]) -> List[Cell]:
+        """Takes cells out of an overlay layer. Returns the cells that look or act differently now"""
+        self._check_changeable()
+        changed = self.overlays.remove(layer, cells)
+        self._refresh_overlays(changed)
+        return changed
+
+    def _check_changeable(self):
+        """Raises ValueError if the overlays of this map can't be changed"""
+
+    def _refresh_overlays(self, cells: Iterable[Cell]):
+        for y, x in cells:
+            value = self.overlays.cells.get((y, x))
+            if value is None:
+                # Nothing over the cell anymore
+                del self._overlay_classes[(y, x)]
+                columns = self._overlay_rows[y]
+                columns.remove(x)
+                if not columns:
+                    del self._overlay_rows[y]
+                continue
+            self._overlay_classes[(y, x)] = classify_tiles(value[1].encode(
+                "latin-1", errors="replace"))[0]
+            columns = self._overlay_rows.setdefault(y, [])
+            if x not in columns:
+                columns.append(x)
+        self.overlay_version += 1
+
+    @abc.abstractmethod
+    def _row_tiles(self, y: int, start: int, end: int) -> str:
+        """Map tiles of columns start to end of row y without overlays, padded with spaces"""
+
+    def row_text(self, y: int, start: int, end: int) -> str:
+        """The drawn characters of columns start to end of row y, padded with spaces"""
+        text = self._row_tiles(y, start, end)
+        for x in self._overlay_rows.get(y, ()):
+            if start <= x < end:
+                offset = x - start
+                text = text[:offset] + self.overlays.cells[
+                    (y, x)][0] + text[offset + 1:]
+        return text
+
+
+class Map(LayeredMap):
 
     def __init__(self, _map: List[str], _map_data: List[str]):
         self._map: List[str] = _map
@@ -13,25 +214,128 @@ class Map:
             raise ValueError("Map and map data are not the same size.")
         if not self.LINES == len(self._map_data) + 1:
             raise ValueError("Map and map data are not the same size.")
+        self._build_index()
+
+    def _build_index(self):
+        """Builds the tile class grid and the coordinates of every indexed symbol"""
+        width = self.COLS - 1
+        rows = [line[:width].ljust(width) for line in self._map_data]
+        self._width: int = width
+        self._tile_classes: bytearray = bytearray(
+            classify_tiles("".join(rows).encode("latin-1", errors="replace")))
+        self._symbol_index: Dict[str, List[Tuple[int, int]]] = {}
+        for y, line in enumerate(rows):
+            for symbol in INDEXED_SYMBOLS:
+                if symbol not in line:
+                    continue
+                x = line.find(symbol)
+                while x != -1:
+                    self._symbol_index.setdefault(symbol, []).append((y, x))
+                    x = line.find(symbol, x + 1)
+        # The map without overlays, shared by every variant made with layered
+        self.base: Map = self
+        # Rows with the overlays drawn in, made when first needed after a change
+        self._layered_rows: Optional[List[str]] = None
+        self._set_overlays(None)
+
+    def layered(self, overlays: Optional[Overlays] = None) -> "Map":
+        """A variant of the map with overlays on top. Shares this map's tiles, so it only costs the changed cells"""
+        variant = copy.copy(self.base)
+        variant._set_overlays(overlays)
+        return variant
+
+    def _check_changeable(self):
+        if self.base is self:
+            raise ValueError(
+                "Loaded maps are shared, use a layered variant to change them."
+            )
+
+    def _refresh_overlays(self, cells: Iterable[Cell]):
+        super()._refresh_overlays(cells)
+        self._layered_rows = None
 
     @property
     def as_str(self) -> str:
-        return "\n".join(self._map)
+        return "\n".join(self.as_list)
 
     @property
     def as_list(self) -> List[str]:
-        return self._map
+        if not self.overlays.cells:
+            return self._map
+        if self._layered_rows is None:
+            rows = list(self._map)
+            for (y, x), (tile, _) in self.overlays.cells.items():
+                rows[y] = rows[y][:x] + tile + rows[y][x + 1:]
+            self._layered_rows = rows
+        return self._layered_rows
+
+    def _row_tiles(self, y: int, start: int, end: int) -> str:
+        return self._map[y][start:end].ljust(end - start)
 
     def get_starting_pos(self) -> List[int]:
-        for y, line in enumerate(self._map_data):
-            for x, char in enumerate(line):
-                if char == "S":
-                    return [y, x, 0]
-        raise ValueError("No starting position found.")
+        starts = self.get_symbol_positions("S")
+        if not starts:
+            raise ValueError("No starting position found.")
+        return [starts[0][0], starts[0][1], 0]
 
-    def get_metamap_char(self, pos: List[int]) -> str:
+    def get_metamap_char(self, pos: Sequence[int]) -> str:
+        if self._overlay_classes:
+            changed = self.overlays.cells.get((pos[0], pos[1]))
+            if changed is not None:
+                return changed[1]
         return self._map_data[pos[0]][pos[1]]
 
+    def get_tile_class(self, pos: Sequence[int]) -> int:
+        """Gets the tile class (WALL, EXIT, ...) at a position"""
+        if self._overlay_classes:
+            tile_class = self._overlay_classes.get((pos[0], pos[1]))
+            if tile_class is not None:
+                return tile_class
+        return self._tile_classes[pos[0] * self._width + pos[1]]
+
+    def is_passable(self, pos: Sequence[int]) -> bool:
+        if self._overlay_classes:
+            tile_class = self._overlay_classes.get((pos[0], pos[1]))
+            if tile_class is not None:
+                return tile_class != WALL
+        return self._tile_classes[pos[0] * self._width + pos[1]] != WALL
+
+    def get_trigger(self, pos: Sequence[int]) -> int:
+        """Gets n if the position is on an interactable n tile, -1 if it is on an exit tile, 0 otherwise"""
+        return _TRIGGERS[self.get_tile_class(pos)]
+
+    @property
+    def width(self) -> int:
+        """Number of tile columns (COLS is one more so the map fits in a curses window)"""
+        return self._width
+
+    @property
+    def height(self) -> int:
+        return self.LINES - 1
+
+    def get_passability(self) -> bytes:
+        """Gets a flat height * width grid with 1 for every tile that isn't a wall and 0 for walls"""
+        grid = passability_of(bytes(self._tile_classes))
+        if not self._overlay_classes:
+            return grid
+        patched = bytearray(grid)
+        for (y, x), tile_class in self._overlay_classes.items():
+            patched[y * self._width + x] = _PASSABLE_TABLE[tile_class]
+        return bytes(patched)
+
+    def get_symbol_positions(self, symbol: str) -> List[Tuple[int, int]]:
+        """Gets the (y, x) of every tile with an indexed .mapdata symbol"""
+        if symbol not in INDEXED_SYMBOLS:
+            raise ValueError(f"{symbol!r} is not an indexed symbol.")
+        positions = self._symbol_index.get(symbol, [])
+        if not self._overlay_classes:
+            return positions
+        changed = self.overlays.cells
+        return [cell for cell in positions if cell not in changed] + [
+            cell for cell, (_, changed_symbol) in changed.items()
+            if changed_symbol == symbol
+        ]
+
     @classmethod
     def from_files(cls, map_path: Path, map_data_path: Path):
         with open(map_data_path, "r") as f2:
@@ -42,10 +346,130 @@ class Map:
     def from_list(cls, map: List[str], map_data: List[str]):
         return cls(map, map_data)
 
+    @classmethod
+    def from_compiled(cls, path: Path):
+        """Loads a map compiled with Map.compile. Skips the size checks, they were done when compiling"""
+        with open(path, "rb") as f:
+            data = f.read()
+        magic, version, rows, cols = MAPC_HEADER.unpack_from(data, 0)
+        if magic != MAPC_MAGIC or version != MAPC_VERSION:
+            raise ValueError(f"{path} is not a compiled map.")
+        grid_size = rows * cols
+        if len(data) != MAPC_HEADER.size + grid_size * 2:
+            raise ValueError(f"{path} is truncated.")
+        # Map tiles then map data, one character per cell
+        text = data[MAPC_HEADER.size:].decode("latin-1")
+        loaded = cls.__new__(cls)
+        loaded._map = [text[y * cols:(y + 1) * cols] for y in range(rows)]
+        loaded._map_data = [
+            text[grid_size + y * cols:grid_size + (y + 1) * cols]
+            for y in range(rows)
+        ]
+        loaded.COLS = cols + 1
+        loaded.LINES = rows + 1
+        loaded._build_index()
+        return loaded
+
+    def compile(self, path: Path):
+        """Writes the map in the compiled map format. Only works with rectangular maps"""
+        rows = len(self._map)
+        cols = len(self._map[0])
+        for line in self._map + self._map_data:
+            if len(line) != cols:
+                raise ValueError("Map rows are not all the same length.")
+        header = MAPC_HEADER.pack(MAPC_MAGIC, MAPC_VERSION, rows, cols)
+        body = "".join(self._map + self._map_data).encode("latin-1")
+        tmp_path = Path(f"{path}.tmp")
+        try:
+            tmp_file = open(tmp_path, "wb")
+        except FileNotFoundError:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = open(tmp_path, "wb")
+        with tmp_file as f:
+            f.write(header)
+            f.write(body)
+        os.replace(tmp_path, path)
+
     @classmethod
     def from_name(cls, map_name: str):
-        """Looks for a .map and .mapdata file with the name given in the maps folder"""
+        """Looks for a .map and .mapdata file with the name given in the maps folder.
+        Uses the compiled .mapc file (see compiled_path) when it is newer than both, and caches loaded maps"""
         game_dir = Path(__file__).parent.parent
         map_dir = game_dir / "maps"
-        return cls.from_files(map_dir / f"{map_name}.map",
-                              map_dir / f"{map_name}.mapdata")
+        map_path = map_dir / f"{map_name}.map"
+        map_data_path = map_dir / f"{map_name}.mapdata"
+        mtimes = (map_path.stat().st_mtime_ns,
+                  map_data_path.stat().st_mtime_ns)
+        # Loaded maps are never changed, so every thread (like each server session) shares one copy
+        with _map_cache.lock:
+            cached = _map_cache.get(map_name, mtimes)
+            if cached is not None:
+                return cached
+
+            compiled_path = cls.compiled_path(map_dir, map_name)
+            loaded = None
+            try:
+                if compiled_path.stat().st_mtime_ns >= max(mtimes):
+                    loaded = cls.from_compiled(compiled_path)
+            except (OSError, ValueError, struct.error):
+                loaded = None
+            if loaded is None:
+                loaded = cls.from_files(map_path, map_data_path)
+                try:
+                    loaded.compile(compiled_path)
+                except (OSError, ValueError):
+                    # No cache folder or map that can't be compiled
+                    pass
+            _map_cache.put(map_name, mtimes, loaded)
+            return loaded
+
+    @staticmethod
+    def compiled_path(map_dir: Path, map_name: str) -> Path:
+        """Where the compiled copy of a map is kept. Each maps folder has its own folder in COMPILED_DIR, so two copies
+        of the game don't use each other's maps"""
+        folder = hashlib.sha1(str(map_dir.resolve()).encode()).hexdigest()[:16]
+        return COMPILED_DIR / folder / f"{map_name}.mapc"
+
+
+class _MapCache:
+    """Least recently used cache of loaded maps keyed by name and file modification times"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        # Held while looking up or loading a map
+        self.lock = threading.RLock()
+        self._maps: "OrderedDict[str, Tuple[Tuple[int, int], Map]]" = OrderedDict(
+        )
+
+    def get(self, name: str, mtimes: Tuple[int, int]) -> Optional[Map]:
+        entry = self._maps.get(name)
+        if entry is None or entry[0] != mtimes:
+            return None
+        self._maps.move_to_end(name)
+        return entry[1]
+
+    def put(self, name: str, mtimes: Tuple[int, int], loaded: Map):
+        self._maps[name] = (mtimes, loaded)
+        self._maps.move_to_end(name)
+        while len(self._maps) > self.max_size:
+            self._maps.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self._maps.clear()
+
+    def __len__(self) -> int:
+        return len(self._maps)
+
+
+_map_cache = _MapCache(MAP_CACHE_SIZE)
+
+
+def clear_cache():
+    """Forgets all cached maps"""
+    _map_cache.clear()
+
+
+def cached_maps() -> int:
+    """Number of maps loaded and shared through the cache"""
+    return len(_map_cache)
@@ -0,0 +1,100 @@
+"""Compiles story text with attribute tags into word wrapped runs of text that can be drawn with addstr."""
+
+import curses
+import functools
+from typing import Dict, List, NamedTuple, Tuple
+
+# Attribute tag character -> curses attribute
+ATTRIBUTES: Dict[str, int] = {
+    "b": curses.A_BOLD,
+    "i": curses.A_ITALIC,
+    "u": curses.A_UNDERLINE,
+    "n": curses.A_NORMAL,
+}
+
+
+class CompiledText(NamedTuple):
+    runs: Tuple[Tuple[int, str], ...]  # (attribute, text) pairs
+    length: int  # Number of characters in all of the runs
+    invalid_tags: bool  # True if the text used an attribute tag that doesn't exist
+
+
+def _wrap(chars: List[str], width: int):
+    """Replaces spaces in chars with newlines so no line is longer than width - 1"""
+    limit = width - 1
+    if limit < 1:
+        return
+    line_start = 0
+    last_space = -1
+    for index, char in enumerate(chars):
+        if char == "\n":
+            line_start = index + 1
+            last_space = -1
+            continue
+        if char == " ":
+            last_space = index
+        if index - line_start >= limit:
+            if last_space >= line_start:
+                chars[last_space] = "\n"
+                line_start = last_space + 1
+                last_space = -1
+            else:
+                # Word longer than a whole line, let curses wrap it
+                line_start = index
+
+
+@functools.lru_cache(maxsize=256)
+def compile_text(text: str, width: int = 0) -> CompiledText:
+    """Compiles text with attribute tags (see io_functs.story_print).
+    Wraps words to `width` columns if width is given"""
+    chars: List[str] = []
+    attributes: List[int] = []
+    invalid_tags = False
+    attribute: int = curses.A_NORMAL
+    attribute_declaration: bool = False
+    for char in text:
+        if char == "`":
+            attribute_declaration = True
+            continue
+        if attribute_declaration:
+            if char in ATTRIBUTES:
+                attribute = ATTRIBUTES[char]
+            else:
+                invalid_tags = True
+                attribute = curses.A_NORMAL
+            attribute_declaration = False
+            continue
+        chars.append(char)
+        attributes.append(attribute)
+    if width:
+        _wrap(chars, width)
+
+    runs: List[Tuple[int, str]] = []
+    run_start = 0
+    for index in range(1, len(chars) + 1):
+        if index == len(chars) or attributes[index] != attributes[run_start]:
+            runs.append(
+                (attributes[run_start], "".join(chars[run_start:index])))
+            run_start = index
+    return CompiledText(tuple(runs), len(chars), invalid_tags)
+
+
+def slice_runs(runs: Tuple[Tuple[int, str], ...], start: int,
+               end: int) -> List[Tuple[int, str]]:
+    """Gets the runs covering characters start to end of the compiled text"""
+    sliced: List[Tuple[int, str]] = []
+    position = 0
+    for attribute, run in runs:
+        run_end = position + len(run)
+        if run_end > start and position < end:
+            sliced.append(
+                (attribute, run[max(start - position, 0):end - position]))
+        position = run_end
+        if position >= end:
+            break
+    return sliced
+
+
+def plain_text(text: str) -> str:
+    """text without its attribute tags"""
+    return "".join(run for _, run in compile_text(text).runs)
@@ -0,0 +1,320 @@
+"""Pathfinding on the walls of a map's .mapdata.
+
+Distance fields give the number of steps from every tile to the nearest goal (the player, exits...), so any number of
+chasers can each find their next step with one lookup. Fields are cached per map, and the field toward the player is
+updated incrementally when the player takes a step instead of being rebuilt. Chunked worlds are never in memory all at
+once, so on them fields toward the player are worked out on a window of the world around the player instead.
+"""
+
+import heapq
+import weakref
+from array import array
+from collections import OrderedDict, deque
+from typing import Deque, Dict, FrozenSet, Iterable, List, Optional, Sequence, Tuple, Union
+import maps
+import chunks
+
+Pos = Tuple[int, int]
+FIELD_CACHE_SIZE: int = 32
+_WORLD_FIELDS_ONLY: str = "Chunked worlds only have fields toward the player with a max_distance."
+
+
+class DistanceField:
+    """Steps from every tile to the nearest goal tile, moving up, down, left and right"""
+
+    def __init__(self,
+                 passable: bytes,
+                 width: int,
+                 goals: Iterable[Pos],
+                 max_distance: Optional[int] = None,
+                 origin: Pos = (0, 0)):
+        self._passable = passable
+        self._width = width
+        # Map position of the grid's top left tile, when the grid only covers part of a map
+        self.origin = origin
+        self.goals: FrozenSet[Pos] = frozenset(goals)
+        # Tiles further than this from every goal are treated as unreachable
+        self.max_distance = max_distance
+        # Tiles reached by a limited search, so the next search only has to reset those
+        self._touched: List[int] = []
+        # Distances are stored minus self._offset, which lets a goal move raise every distance by one for free
+        self._raw = array("l", bytes(array("l").itemsize * len(passable)))
+        self._reached = bytearray(len(passable))
+        self._offset = 0
+        self._build()
+
+    def _neighbours(self, index: int) -> List[int]:
+        width = self._width
+        found: List[int] = []
+        x = index % width
+        if x > 0:
+            found.append(index - 1)
+        if x < width - 1:
+            found.append(index + 1)
+        if index >= width:
+            found.append(index - width)
+        if index + width < len(self._passable):
+            found.append(index + width)
+        return found
+
+    def _build(self):
+        """Breadth first search from every goal"""
+        if self.max_distance is None:
+            self._reached = bytearray(len(self._passable))
+        else:
+            for index in self._touched:
+                self._reached[index] = 0
+        self._offset = 0
+        queue: Deque[int] = deque()
+        for goal in self.goals:
+            index = self._index(goal)
+            if index is not None and self._passable[
+                    index] and not self._reached[index]:
+                self._reached[index] = 1
+                self._raw[index] = 0
+                queue.append(index)
+        raw = self._raw
+        reached = self._reached
+        passable = self._passable
+        limit = self.max_distance
+        touched: List[int] = list(queue) if limit is not None else []
+        while queue:
+            index = queue.popleft()
+            next_distance = raw[index] + 1
+            if limit is not None and next_distance > limit:
+                continue
+            for neighbour in self._neighbours(index):
+                if passable[neighbour] and not reached[neighbour]:
+                    reached[neighbour] = 1
+                    raw[neighbour] = next_distance
+                    queue.append(neighbour)
+                    if limit is not None:
+                        touched.append(neighbour)
+        self._touched = touched
+
+    def _index(self, pos: Sequence[int]) -> Optional[int]:
+        """Index of a map position in the grid, None if the grid doesn't cover it"""
+        y = pos[0] - self.origin[0]
+        x = pos[1] - self.origin[1]
+        if not (0 <= x < self._width
+                and 0 <= y < len(self._passable) // self._width):
+            return None
+        return y * self._width + x
+
+    def distance(self, pos: Sequence[int]) -> Optional[int]:
+        """Steps from pos to the nearest goal, None if no goal can be reached"""
+        index = self._index(pos)
+        if index is None or not self._reached[index]:
+            return None
+        return self._raw[index] + self._offset
+
+    def next_step(self, pos: Sequence[int]) -> Optional[Pos]:
+        """The neighbouring tile one step closer to a goal, None if pos is a goal or can't reach one"""
+        index = self._index(pos)
+        if index is None or not self._reached[
+                index] or self._raw[index] + self._offset == 0:
+            return None
+        target = self._raw[index] - 1
+        for neighbour in self._neighbours(index):
+            if self._reached[neighbour] and self._raw[neighbour] == target:
+                y, x = divmod(neighbour, self._width)
+                return y + self.origin[0], x + self.origin[1]
+        return None
+
+    def move_goal(self, new_goal: Sequence[int]) -> int:
+        """Moves the only goal to new_goal, updating as few tiles as possible. Returns the number of tiles updated.
+
+        When the goal moves one step, every distance changes by exactly one (the grid is a checkerboard, so the
+        distance's parity flips). All of them going up by one is done by changing the offset, then only the tiles that
+        got closer are visited, with a breadth first search from the new goal that stops where distances stop dropping"""
+        new = (new_goal[0], new_goal[1])
+        if len(self.goals) != 1:
+            raise ValueError("Only fields with one goal can move their goal.")
+        (old, ) = self.goals
+        if new == old:
+            return 0
+        new_index = self._index(new)
+        adjacent = abs(new[0] - old[0]) + abs(new[1] - old[1]) == 1
+        self.goals = frozenset((new, ))
+        if self.max_distance is not None:
+            # A limited search is cheaper to redo than to update
+            self._build()
+            return len(self._touched)
+        if new_index is None:
+            raise ValueError("The goal can't move off the grid.")
+        if not adjacent or not self._reached[new_index]:
+            self._build()
+            return len(self._passable)
+
+        self._offset += 1
+        raw = self._raw
+        reached = self._reached
+        offset = self._offset
+        raw[new_index] = -offset
+        updated = 1
+        queue: Deque[int] = deque([new_index])
+        while queue:
+            index = queue.popleft()
+            next_distance = raw[index] + 1
+            for neighbour in self._neighbours(index):
+                if reached[neighbour] and raw[neighbour] > next_distance:
+                    raw[neighbour] = next_distance
+                    updated += 1
+                    queue.append(neighbour)
+        return updated
+
+
+class Navigator:
+    """Pathfinding for one map"""
+
+    def __init__(self, nav_map: maps.Map):
+        self.width: int = nav_map.width
+        self.height: int = nav_map.height
+        self._passable: bytes = nav_map.get_passability()
+        # The map's overlay_version the passability was read at
+        self.overlay_version: int = nav_map.overlay_version
+        self._exits: List[Pos] = nav_map.get_symbol_positions("e")
+        self._fields: "OrderedDict[FrozenSet[Pos], DistanceField]" = OrderedDict(
+        )
+        # Fields toward the player by the furthest distance they cover (None for the whole map)
+        self._player_fields: Dict[Optional[int], DistanceField] = {}
+
+    def is_passable(self, pos: Sequence[int]) -> bool:
+        return 0 <= pos[0] < self.height and 0 <= pos[1] < self.width and bool(
+            self._passable[pos[0] * self.width + pos[1]])
+
+    def field_to(self, goals: Iterable[Pos]) -> DistanceField:
+        """Gets the cached distance field toward a fixed set of goals"""
+        key = frozenset(goals)
+        field = self._fields.get(key)
+        if field is None:
+            field = DistanceField(self._passable, self.width, key)
+            self._fields[key] = field
+            while len(self._fields) > FIELD_CACHE_SIZE:
+                self._fields.popitem(last=False)
+        else:
+            self._fields.move_to_end(key)
+        return field
+
+    def exit_field(self) -> DistanceField:
+        return self.field_to(self._exits)
+
+    def player_field(self,
+                     player_pos: Sequence[int],
+                     max_distance: Optional[int] = None) -> DistanceField:
+        """Gets the distance field toward the player, updated for where the player is now.
+        With max_distance only tiles that close to the player are covered, which keeps updates cheap on big maps"""
+        pos = (player_pos[0], player_pos[1])
+        field = self._player_fields.get(max_distance)
+        if field is None:
+            field = DistanceField(self._passable, self.width, [pos],
+                                  max_distance)
+            self._player_fields[max_distance] = field
+        else:
+            field.move_goal(pos)
+        return field
+
+    def chase_steps(self,
+                    player_pos: Sequence[int],
+                    chasers: Iterable[Sequence[int]],
+                    max_distance: Optional[int] = None) -> List[Optional[Pos]]:
+        """Gets the next step toward the player for each chaser"""
+        field = self.player_field(player_pos, max_distance)
+        return [field.next_step(chaser) for chaser in chasers]
+
+    def find_path(self, start: Sequence[int],
+                  goal: Sequence[int]) -> Optional[List[Pos]]:
+        """A* search. Returns the tiles from start to goal (both included), None if there is no path"""
+        width = self.width
+        start_index = start[0] * width + start[1]
+        goal_index = goal[0] * width + goal[1]
+        if not (self.is_passable(start) and self.is_passable(goal)):
+            return None
+        goal_y, goal_x = goal[0], goal[1]
+        came_from: Dict[int, int] = {start_index: start_index}
+        cost: Dict[int, int] = {start_index: 0}
+        heap: List[Tuple[int, int, int]] = [
+            (abs(start[0] - goal_y) + abs(start[1] - goal_x), 0, start_index)
+        ]
+        while heap:
+            _, steps, index = heapq.heappop(heap)
+            if index == goal_index:
+                path: List[Pos] = [divmod(index, width)]
+                while index != start_index:
+                    index = came_from[index]
+                    path.append(divmod(index, width))
+                path.reverse()
+                return path
+            if steps > cost[index]:
+                continue
+            y, x = divmod(index, width)
+            for neighbour, ny, nx in ((index - 1, y, x - 1), (index + 1, y,
+                                                              x + 1),
+                                      (index - width, y - 1,
+                                       x), (index + width, y + 1, x)):
+                if not (0 <= ny < self.height
+                        and 0 <= nx < width) or not self._passable[neighbour]:
+                    continue
+                if neighbour in cost and cost[neighbour] <= steps + 1:
+                    continue
+                cost[neighbour] = steps + 1
+                came_from[neighbour] = index
+                heapq.heappush(heap, (steps + 1 + abs(ny - goal_y) +
+                                      abs(nx - goal_x), steps + 1, neighbour))
+        return None
+
+
+class WorldNavigator(Navigator):
+    """Pathfinding for a chunked world. Only fields toward the player that cover a limited distance are supported.
+    They are worked out on the part of the world within that distance of the player, which holds every path that short"""
+
+    def __init__(self, world: chunks.ChunkedMap):
+        # Nothing is read up front, unlike Navigator. _navigators is keyed by the world, so only a proxy is kept or the
+        # world would never be freed
+        self.world: chunks.ChunkedMap = weakref.proxy(world)
+        self.width: int = world.width
+        self.height: int = world.height
+        self.overlay_version: int = world.overlay_version
+        self._player_fields: Dict[Optional[int], DistanceField] = {}
+
+    def is_passable(self, pos: Sequence[int]) -> bool:
+        return self.world.is_passable(pos)
+
+    def player_field(self,
+                     player_pos: Sequence[int],
+                     max_distance: Optional[int] = None) -> DistanceField:
+        if max_distance is None:
+            raise ValueError(_WORLD_FIELDS_ONLY)
+        pos = (player_pos[0], player_pos[1])
+        field = self._player_fields.get(max_distance)
+        if field is None or field.goals != frozenset((pos, )):
+            size = 2 * max_distance + 1
+            origin = (pos[0] - max_distance, pos[1] - max_distance)
+            field = DistanceField(
+                self.world.get_passability_window(origin[0], origin[1], size,
+                                                  size), size, [pos],
+                max_distance, origin)
+            self._player_fields[max_distance] = field
+        return field
+
+    def field_to(self, goals: Iterable[Pos]) -> DistanceField:
+        raise ValueError(_WORLD_FIELDS_ONLY)
+
+    def find_path(self, start: Sequence[int],
+                  goal: Sequence[int]) -> Optional[List[Pos]]:
+        raise ValueError(_WORLD_FIELDS_ONLY)
+
+
+_navigators: "weakref.WeakKeyDictionary[Union[maps.Map, chunks.ChunkedMap], Navigator]" = weakref.WeakKeyDictionary(
+)
+
+
+def get_navigator(nav_map: Union[maps.Map, chunks.ChunkedMap]) -> Navigator:
+    """Gets the navigator for a map, shared by everything on that map. Made again once overlays change the map"""
+    navigator = _navigators.get(nav_map)
+    if navigator is None or (navigator.overlay_version
+                             != nav_map.overlay_version):
+        navigator = WorldNavigator(nav_map) if isinstance(
+            nav_map, chunks.ChunkedMap) else Navigator(nav_map)
+        _navigators[nav_map] = navigator
+    return navigator
@@ -0,0 +1,140 @@
+"""Recording play sessions so they can be replayed (see replay.py).
+
+A trace holds the random seed the session used (see rng_streams.py), whether the escape menu offered to save the
+profile (which moves its other options), every key the game read and the state of the game at the end. Keys are
+recorded with a keyloop hook, and typed text (like save names) as its keys followed by enter.
+Keys that only skip animations aren't recorded, since a replay runs without animations.
+"""
+
+import struct
+from array import array
+from pathlib import Path
+from typing import List, NamedTuple, Optional
+import game_class
+import instrument
+import keyloop
+import rng_streams
+
+# Trace file format:
+# header: magic, format version, seed, number of keys, length of the final state, flags
+# followed by the keys as unsigned 16 bit integers and then the final state as UTF-8
+TRACE_MAGIC: bytes = b"TGTR"
+TRACE_VERSION: int = 2
+TRACE_HEADER = struct.Struct("<4sHQIIB")
+# Version 1 traces have no flags
+TRACE_HEADER_V1 = struct.Struct("<4sHQII")
+# Flags: the escape menu had the Save Profile option
+FLAG_PROFILED: int = 1
+# Screens whose keys don't change what happens in the game
+UNRECORDED_SCREENS = ("story animation", )
+
+
+class Trace(NamedTuple):
+    seed: int
+    keys: List[int]
+    final_state: str
+    profiled: bool = False
+
+    def write(self, path: Path):
+        keys = array("H", self.keys)
+        if keys.itemsize != 2:
+            raise ValueError("Unsupported platform")
+        state = self.final_state.encode("utf-8")
+        with open(path, "wb") as f:
+            f.write(
+                TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, self.seed,
+                                  len(keys), len(state),
+                                  FLAG_PROFILED if self.profiled else 0))
+            f.write(keys.tobytes())
+            f.write(state)
+
+    @classmethod
+    def read(cls, path: Path):
+        with open(path, "rb") as f:
+            data = f.read()
+        magic, version = data[:4], int.from_bytes(data[4:6], "little")
+        if magic != TRACE_MAGIC:
+            raise ValueError(f"{path} is not a trace file.")
+        if version == 1:
+            header = TRACE_HEADER_V1
+            _, _, seed, key_count, state_length = header.unpack_from(data)
+            flags = 0
+        elif version == TRACE_VERSION:
+            header = TRACE_HEADER
+            _, _, seed, key_count, state_length, flags = header.unpack_from(
+                data)
+        else:
+            raise ValueError(f"Unsupported trace version: {version}")
+        keys_end = header.size + 2 * key_count
+        keys = array("H", data[header.size:keys_end])
+        state = data[keys_end:keys_end + state_length].decode("utf-8")
+        return cls(seed, keys.tolist(), state, bool(flags & FLAG_PROFILED))
+
+
+def game_state(game: Optional[game_class.Game]) -> str:
+    """Everything about a game that a replay has to end up with"""
+    if game is None:
+        return ""
+    return f"{game.save_data()}\n{game.player.hp}"
+
+
+class Recorder:
+
+    def __init__(self, path: Path, seed: int, profiled: bool = False):
+        self.path = path
+        self.seed = seed
+        self.profiled = profiled
+        self.keys: List[int] = []
+
+    def _on_key(self, screen: str, key: int) -> bool:
+        if screen not in UNRECORDED_SCREENS:
+            self.keys.append(key)
+        return False
+
+    def start(self):
+        keyloop.add_key_hook(self._on_key)
+
+    def text(self, text: str):
+        self.keys.extend(map(ord, text))
+        self.keys.append(ord("\n"))
+
+    def finish(self, game: Optional[game_class.Game]):
+        keyloop.remove_key_hook(self._on_key)
+        Trace(self.seed, self.keys, game_state(game),
+              self.profiled).write(self.path)
+
+
+_recorder: Optional[Recorder] = None
+# The game being played, for the final state of a trace
+_game: Optional[game_class.Game] = None
+
+
+def start_recording(path: Path, seed: Optional[int] = None):
+    """Seeds the random streams and starts recording keys. Profiling has to be set up before this"""
+    global _recorder
+    _recorder = Recorder(path, rng_streams.seed(seed),
+                         instrument.saves_results())
+    _recorder.start()
+
+
+def finish_recording():
+    """Writes the trace"""
+    global _recorder
+    if _recorder is not None:
+        _recorder.finish(_game)
+        _recorder = None
+
+
+def record_text(text: str):
+    """Records text typed without keyloop.get_key"""
+    if _recorder is not None:
+        _recorder.text(text)
+
+
+def set_game(game: game_class.Game):
+    global _game
+    _game = game
+
+
+def current_game() -> Optional[game_class.Game]:
+    return _game
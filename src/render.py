@@ -0,0 +1,243 @@
+"""Incremental map rendering. Only cells that changed since the last frame are drawn."""
+
+import abc
+import curses
+from typing import Iterable, List, Optional, Sequence, Set, Tuple, Union
+import maps
+import chunks
+import entities
+import fov
+import instrument
+import terminal
+
+PLAYER: str = "@"
+# Rows and columns drawn around the view, so the pad only has to be redrawn every so many steps.
+# World maps use their chunk size instead
+VIEWPORT_MARGIN: int = 16
+
+
+def diff_maps(old: maps.Map, new: maps.Map) -> Optional[List[Tuple[int, int]]]:
+    """Gets the (y, x) of every cell that is drawn differently in the two maps.
+    Returns None if the maps are not the same size"""
+    if old.LINES != new.LINES or old.COLS != new.COLS:
+        return None
+    changed: List[Tuple[int, int]] = []
+    for y, (old_line, new_line) in enumerate(zip(old.as_list, new.as_list)):
+        if old_line == new_line:
+            continue
+        for x, (old_char, new_char) in enumerate(zip(old_line, new_line)):
+            if old_char != new_char:
+                changed.append((y, x))
+    return changed
+
+
+class Renderer(abc.ABC):
+    """Keeps track of which cells of a map need to be redrawn. Shared by MapRenderer and ViewportRenderer"""
+
+    def __init__(self, current_map: Union[maps.Map, chunks.ChunkedMap]):
+        self.map = current_map
+        self._dirty: Set[Tuple[int, int]] = set()
+        self._player: Optional[Tuple[int, int]] = None
+        # Entities drawn over the map
+        self.world: Optional[entities.World] = None
+        # Hides what the player can't see
+        self.fov: Optional[fov.FieldOfView] = None
+        # Number of cells drawn by the last call to flush
+        self.cells_drawn: int = 0
+
+    def mark_dirty(self, cells: Iterable[Tuple[int, int]]):
+        self._dirty.update(cells)
+
+    def move_player(self, pos: Sequence[int]):
+        """Moves the drawn player to pos ([y, x, ...])"""
+        new = (pos[0], pos[1])
+        if new == self._player:
+            return
+        if self._player is not None:
+            self._dirty.add(self._player)
+        self._player = new
+        self._dirty.add(new)
+
+    @abc.abstractmethod
+    def restore_region(self, begin_y: int, begin_x: int, size_y: int,
+                       size_x: int):
+        """Redraws the part of the map that was under a window at the given screen position"""
+
+    def restore_regions(self, regions: Iterable[Tuple[int, int, int, int]]):
+        for region in regions:
+            self.restore_region(*region)
+
+    def _collect_changes(self):
+        """Marks the cells entities and line of sight changed since the last frame"""
+        if self.world is not None:
+            self._dirty.update(self.world.pop_changed_cells())
+        if self.fov is not None:
+            self._dirty.update(self.fov.pop_changed_cells())
+
+    def _cell(self, y: int, x: int) -> Tuple[str, int]:
+        """The character and attribute a map cell is drawn with"""
+        if (y, x) == self._player:
+            return PLAYER, curses.A_BOLD
+        if self.fov is not None and not self.fov.is_visible((y, x)):
+            if not self.fov.is_explored((y, x)):
+                return " ", curses.A_DIM
+            return self.map.row_text(y, x, x + 1), curses.A_DIM
+        glyph = self.world.glyph_at((y, x)) if self.world is not None else None
+        return glyph or self.map.row_text(y, x, x + 1), curses.A_NORMAL
+
+    def _finish_frame(self, drawn: int):
+        self._dirty.clear()
+        self.cells_drawn = drawn
+        instrument.count("render.cells_drawn", drawn)
+
+
+class MapRenderer(Renderer):
+    """Draws a map and the player to a window, keeping track of which cells need to be redrawn"""
+
+    def __init__(self, window: curses.window, current_map: maps.Map):
+        super().__init__(current_map)
+        self.window = window
+        self._full_redraw: bool = True
+        self._begin_y, self._begin_x = window.getbegyx()
+
+    def set_map(self, new_map: maps.Map):
+        """Switches to a different map, only the cells that differ are redrawn"""
+        changed = diff_maps(self.map, new_map)
+        self.map = new_map
+        if changed is None:
+            self._full_redraw = True
+            return
+        self._dirty.update(changed)
+
+    def restore_region(self, begin_y: int, begin_x: int, size_y: int,
+                       size_x: int):
+        """Redraws the part of the map that was under a window at the given screen position"""
+        top = max(begin_y - self._begin_y, 0)
+        left = max(begin_x - self._begin_x, 0)
+        bottom = min(begin_y + size_y - self._begin_y, self.map.LINES - 1)
+        right = min(begin_x + size_x - self._begin_x, self.map.COLS - 1)
+        for y in range(top, bottom):
+            for x in range(left, right):
+                self._dirty.add((y, x))
+
+    @instrument.timed("render.flush")
+    def flush(self) -> int:
+        """Draws every dirty cell and refreshes the window. Returns the number of cells drawn"""
+        lines = self.map.as_list
+        drawn = 0
+        self._collect_changes()
+        if self._full_redraw:
+            if self.fov is None:
+                self.window.addstr(0, 0, self.map.as_str)
+            else:
+                # Everything explored is drawn as remembered, then the visible cells over it
+                self.window.addstr(
+                    0, 0, "\n".join(
+                        self.fov.mask_row(y, 0, line)
+                        for y, line in enumerate(lines)), curses.A_DIM)
+                self._dirty.update(self.fov.visible)
+            drawn = sum(map(len, lines))
+            self._full_redraw = False
+            if self._player is not None:
+                self._dirty.add(self._player)
+        for y, x in self._dirty:
+            self.window.addch(y, x, *self._cell(y, x))
+            drawn += 1
+        self._finish_frame(drawn)
+        self.window.refresh()
+        return drawn
+
+
+class ViewportRenderer(Renderer):
+    """Draws the part of a map around the player, for maps bigger than the screen.
+
+    The cells around the view are drawn to a pad, and the part of the pad around the player is copied to the screen
+    each frame, so walking only redraws the pad when the view gets near its edge"""
+
+    def __init__(self, current_map: Union[maps.Map,
+                                          chunks.ChunkedMap], screen_y: int,
+                 screen_x: int, view_lines: int, view_cols: int):
+        super().__init__(current_map)
+        self.screen_y = screen_y
+        self.screen_x = screen_x
+        self.view_lines = min(view_lines, current_map.height)
+        self.view_cols = min(view_cols, current_map.width)
+        margin = current_map.chunk_size if isinstance(
+            current_map, chunks.ChunkedMap) else VIEWPORT_MARGIN
+        self.pad_lines = min(self.view_lines + 2 * margin, current_map.height)
+        self.pad_cols = min(self.view_cols + 2 * margin, current_map.width)
+        # One extra column so the bottom right cell can be written
+        self.pad = terminal.newpad(self.pad_lines, self.pad_cols + 1)
+        # Map position of the pad's top left cell
+        self._origin: Optional[Tuple[int, int]] = None
+
+    def set_map(self, new_map: Union[maps.Map, chunks.ChunkedMap]):
+        self.map = new_map
+        self._origin = None
+
+    def restore_region(self, begin_y: int, begin_x: int, size_y: int,
+                       size_x: int):
+        """The pad still has everything that was under a closed window, it only has to be copied again"""
+        self.pad.touchwin()
+
+    def _view_corner(self) -> Tuple[int, int]:
+        """Map position of the top left of the view, keeping the player in the middle where possible"""
+        player_y, player_x = self._player or (0, 0)
+        top = min(max(player_y - self.view_lines // 2, 0),
+                  self.map.height - self.view_lines)
+        left = min(max(player_x - self.view_cols // 2, 0),
+                   self.map.width - self.view_cols)
+        return top, left
+
+    def _redraw_pad(self, top: int, left: int) -> int:
+        """Moves the pad so the view is in its middle and draws all of it. Returns the number of cells drawn"""
+        origin_y = min(max(top - (self.pad_lines - self.view_lines) // 2, 0),
+                       self.map.height - self.pad_lines)
+        origin_x = min(max(left - (self.pad_cols - self.view_cols) // 2, 0),
+                       self.map.width - self.pad_cols)
+        self._origin = (origin_y, origin_x)
+        if isinstance(self.map, chunks.ChunkedMap):
+            self.map.load_around((origin_y + self.pad_lines // 2,
+                                  origin_x + self.pad_cols // 2),
+                                 self.pad_lines + 1, self.pad_cols + 1)
+        for row in range(self.pad_lines):
+            text = self.map.row_text(origin_y + row, origin_x,
+                                     origin_x + self.pad_cols)
+            if self.fov is None:
+                self.pad.addstr(row, 0, text)
+            else:
+                self.pad.addstr(
+                    row, 0, self.fov.mask_row(origin_y + row, origin_x, text),
+                    curses.A_DIM)
+        self._dirty.clear()
+        if self.fov is not None:
+            self._dirty.update(self.fov.visible)
+        if self.world is not None:
+            for entity in list(self.world.entities.values()):
+                if entity.glyph is not None:
+                    self._dirty.update(entity.cells)
+        if self._player is not None:
+            self._dirty.add(self._player)
+        return self.pad_lines * self.pad_cols
+
+    @instrument.timed("render.flush")
+    def flush(self) -> int:
+        """Draws every dirty cell in the pad and copies the view to the screen. Returns the number of cells drawn"""
+        drawn = 0
+        self._collect_changes()
+        top, left = self._view_corner()
+        if self._origin is None or not (
+                self._origin[0] <= top and top + self.view_lines
+                <= self._origin[0] + self.pad_lines and self._origin[1] <= left
+                and left + self.view_cols <= self._origin[1] + self.pad_cols):
+            drawn += self._redraw_pad(top, left)
+        origin_y, origin_x = self._origin or (0, 0)
+        for y, x in self._dirty:
+            if origin_y <= y < origin_y + self.pad_lines and origin_x <= x < origin_x + self.pad_cols:
+                self.pad.addch(y - origin_y, x - origin_x, *self._cell(y, x))
+                drawn += 1
+        self._finish_frame(drawn)
+        self.pad.refresh(top - origin_y, left - origin_x, self.screen_y,
+                         self.screen_x, self.screen_y + self.view_lines - 1,
+                         self.screen_x + self.view_cols - 1)
+        return drawn
@@ -0,0 +1,86 @@
+"""Replays a session recorded with `main.py --record PATH` without a terminal, as fast as possible.
+
+Reports how long the replay took in total and in each part of the game, and fails if the game doesn't end in the
+same state as when it was recorded. Saves are written to a temporary copy of the saves folder.
+"""
+
+import argparse
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, NamedTuple
+import game_class
+import instrument
+import main
+import recording
+import rng_streams
+import save_service
+import terminal
+
+
+class ReplayResult(NamedTuple):
+    wall_time: float
+    keys_read: int
+    final_state: str
+    expected_state: str
+    timings: Dict[str, Dict[str, Any]]
+
+    @property
+    def diverged(self) -> bool:
+        return self.final_state != self.expected_state
+
+
+def replay(trace: recording.Trace) -> ReplayResult:
+    """Plays back a trace, starting from a copy of the current saves folder"""
+    save_dir = game_class.SAVE_DIR
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        replay_save_dir = Path(tmp_dir) / "saves"
+        if save_dir.exists():
+            shutil.copytree(save_dir, replay_save_dir)
+        game_class.SAVE_DIR = replay_save_dir
+        rng_streams.seed(trace.seed)
+        instrument.enable(dump_at_exit=False)
+        # The escape menu has to have the options it had when recording. A profile saved from it goes with the saves
+        profile_settings = instrument.set_saves_results(
+            trace.profiled,
+            Path(tmp_dir) / instrument.DEFAULT_PATH.name)
+        start = time.perf_counter()
+        try:
+            # Stops when the game exits or the recording stopped in the middle of the game
+            backend = terminal.run_headless(main.main, trace.keys)
+        finally:
+            save_service.flush()
+            game_class.SAVE_DIR = save_dir
+            instrument.set_saves_results(*profile_settings)
+        wall_time = time.perf_counter() - start
+    return ReplayResult(wall_time, backend.keys_read,
+                        recording.game_state(recording.current_game()),
+                        trace.final_state,
+                        instrument.results()["timings"])
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("trace", type=Path)
+    args = parser.parse_args()
+
+    trace = recording.Trace.read(args.trace)
+    result = replay(trace)
+    print(f"Replayed {result.keys_read}/{len(trace.keys)} keys in "
+          f"{result.wall_time * 1e3:.1f} ms")
+    print(f"{'':40} {'calls':>7} {'total ms':>10} {'self ms':>10}")
+    for name, timing in result.timings.items():
+        print(f"{name:40} {timing['count']:7} {timing['total_s'] * 1e3:10.2f} "
+              f"{timing['self_s'] * 1e3:10.2f}")
+    if result.diverged:
+        print("Final game state diverged from the recording")
+        print(f"Recorded:\n{result.expected_state}")
+        print(f"Replayed:\n{result.final_state}")
+        sys.exit(1)
+    print("Final game state matches the recording")
+
+
+if __name__ == "__main__":
+    main_cli()
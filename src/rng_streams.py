@@ -0,0 +1,41 @@
+"""Seeded random number streams, one for each subsystem that needs randomness.
+
+Each stream is seeded from one session seed and the stream's name, so a session can be replayed exactly (see recording.py),
+and using one stream more or less (say, a change to how enemies wander) doesn't change the rolls of the others.
+"""
+
+import random
+from typing import Dict, Optional
+
+# combat - attack and skill damage rolls
+# spawn - stats of newly made enemies
+# world - entities moving around on maps
+STREAMS = ("combat", "spawn", "world")
+SEED_LIMIT: int = 2**63
+
+_seed: int = random.SystemRandom().randrange(SEED_LIMIT)
+_streams: Dict[str, random.Random] = {}
+
+
+def seed(value: Optional[int] = None) -> int:
+    """Reseeds every stream from value (a new random seed if not given). Returns the seed"""
+    global _seed
+    _seed = value if value is not None else random.SystemRandom().randrange(
+        SEED_LIMIT)
+    for name, stream in _streams.items():
+        stream.seed(f"{_seed}:{name}")
+    return _seed
+
+
+def current_seed() -> int:
+    return _seed
+
+
+def get(name: str) -> random.Random:
+    """Gets the stream called name. Streams are reseeded in place, so they can be kept"""
+    if name not in STREAMS:
+        raise ValueError(f"Unknown random stream: {name}")
+    stream = _streams.get(name)
+    if stream is None:
+        stream = _streams[name] = random.Random(f"{_seed}:{name}")
+    return stream
@@ -0,0 +1,188 @@
+"""Index of save files so saves can be listed, sorted and filtered without opening each one.
+
+The index is a file of fixed size records (name, timestamp, story progress, level).
+Each save keeps the same record, which is overwritten in place at its byte offset when the save is updated.
+Records of removed saves are blanked out and reused by the next new save. When the save folder's modification time
+changes, the index is checked against the names of the save files, so saves copied in or deleted outside the game are
+picked up. Only the new save files are opened. The game's own saves also change the folder, but they update their
+record themselves, so they don't make the next lookup check the folder.
+"""
+
+import struct
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+INDEX_NAME: str = "catalog.idx"
+# Bytes of a record used by the save name
+NAME_SIZE: int = 256
+RECORD = struct.Struct(f"<{NAME_SIZE}sdii")
+
+
+class CatalogEntry(NamedTuple):
+    name: str
+    timestamp: float
+    story_progress: int
+    level: int
+    offset: int  # Byte offset of this entry's record in the index file
+
+    def __str__(self):
+        saved = time.strftime("%Y-%m-%d %H:%M", time.localtime(self.timestamp))
+        return f"{self.name}  (Lvl {self.level}, {saved})"
+
+
+class SaveCatalog:
+
+    def __init__(self, save_dir: Path):
+        self.save_dir = save_dir
+        self.path = save_dir / INDEX_NAME
+        self._entries: Optional[Dict[str, CatalogEntry]] = None
+        # Offsets of blanked out records, reused before the index grows
+        self._free: List[int] = []
+        # Modification time of the save folder when the index was last checked against it
+        self._dir_mtime: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _folder_mtime(self) -> Optional[int]:
+        try:
+            return self.save_dir.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _load(self) -> Dict[str, CatalogEntry]:
+        mtime = self._folder_mtime()
+        if self._entries is not None and mtime == self._dir_mtime:
+            return self._entries
+        if self._entries is None and not self.path.exists():
+            return self._rebuild()
+        if self._entries is None:
+            self._read()
+        return self._sync()
+
+    def _read(self):
+        with self.path.open("rb") as f:
+            data = f.read()
+        entries: Dict[str, CatalogEntry] = {}
+        self._free = []
+        usable = len(data) - len(data) % RECORD.size
+        for offset in range(0, usable, RECORD.size):
+            raw_name, timestamp, story_progress, level = RECORD.unpack_from(
+                data, offset)
+            name = raw_name.rstrip(b"\0").decode("utf-8")
+            if not name:
+                # Removed save
+                self._free.append(offset)
+                continue
+            entries[name] = CatalogEntry(name, timestamp, story_progress,
+                                         level, offset)
+        self._entries = entries
+
+    def _rebuild(self) -> Dict[str, CatalogEntry]:
+        """Makes a new index from the save files. Only needed when the index is missing"""
+        self.save_dir.mkdir(parents=True, exist_ok=True)
+        self._entries = {}
+        self._free = []
+        with self.path.open("wb"):
+            pass
+        return self._sync()
+
+    def _sync(self) -> Dict[str, CatalogEntry]:
+        """Adds save files the index doesn't know about and removes records of save files that are gone"""
+        assert self._entries is not None
+        save_files = {
+            save_file.stem: save_file
+            for save_file in self.save_dir.glob("*.save")
+        }
+        for name in [name for name in self._entries if name not in save_files]:
+            self._blank(self._entries.pop(name))
+        for name, save_file in save_files.items():
+            if name in self._entries:
+                continue
+            try:
+                with save_file.open("r") as f:
+                    story_progress = int(f.readline())
+                    level = int(f.readline())
+                timestamp = save_file.stat().st_mtime
+            except (OSError, ValueError):
+                continue
+            self._write(name, timestamp, story_progress, level)
+        self._dir_mtime = self._folder_mtime()
+        return self._entries
+
+    def _write(self, name: str, timestamp: float, story_progress: int,
+               level: int):
+        assert self._entries is not None
+        raw_name = name.encode("utf-8")
+        if len(raw_name) > NAME_SIZE:
+            raise ValueError("Save name is too long.")
+        existing = self._entries.get(name)
+        with self.path.open("r+b") as f:
+            if existing is not None:
+                offset = existing.offset
+            elif self._free:
+                offset = self._free.pop()
+            else:
+                offset = f.seek(0, 2)
+                offset -= offset % RECORD.size
+            f.seek(offset)
+            f.write(RECORD.pack(raw_name, timestamp, story_progress, level))
+        self._entries[name] = CatalogEntry(name, timestamp, story_progress,
+                                           level, offset)
+
+    def _blank(self, entry: CatalogEntry):
+        with self.path.open("r+b") as f:
+            f.seek(entry.offset)
+            f.write(RECORD.pack(b"", 0, 0, 0))
+        self._free.append(entry.offset)
+
+    def update(self,
+               name: str,
+               story_progress: int,
+               level: int,
+               timestamp: Optional[float] = None):
+        """Records that the game wrote the save `name`"""
+        with self._lock:
+            if self._entries is None:
+                self._load()
+            self._write(name, timestamp or time.time(), story_progress, level)
+            # Writing the save changed the folder, but the index knows about it now
+            self._dir_mtime = self._folder_mtime()
+
+    def remove(self, name: str):
+        """Forgets a save. Its record is blanked out"""
+        with self._lock:
+            entry = self._load().pop(name, None)
+            if entry is not None:
+                self._blank(entry)
+
+    def get(self, name: str) -> Optional[CatalogEntry]:
+        with self._lock:
+            return self._load().get(name)
+
+    def entries(self,
+                sort_by: str = "timestamp",
+                newest_first: bool = True,
+                prefix: str = "") -> List[CatalogEntry]:
+        """Lists saves whose name starts with prefix, sorted by a CatalogEntry field"""
+        with self._lock:
+            found = [
+                entry for entry in self._load().values()
+                if entry.name.startswith(prefix)
+            ]
+        reverse = newest_first if sort_by == "timestamp" else False
+        return sorted(found,
+                      key=lambda entry: getattr(entry, sort_by),
+                      reverse=reverse)
+
+
+_catalogs: Dict[Path, SaveCatalog] = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_catalog(save_dir: Path) -> SaveCatalog:
+    """Gets the shared catalog for a save directory"""
+    with _catalogs_lock:
+        if save_dir not in _catalogs:
+            _catalogs[save_dir] = SaveCatalog(save_dir)
+        return _catalogs[save_dir]
@@ -0,0 +1,119 @@
+"""Writes save files safely. Saves are written to a temporary file, synced to disk and renamed over the old save,
+so a crash in the middle of a write never leaves a half written save behind.
+Autosaves are written on a background thread and bursts of them are combined into one write."""
+
+import atexit
+import os
+import tempfile
+import threading
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+
+def write_atomic(path: Path, data: str):
+    """Replaces the contents of path with data in one step. The folder is made if it doesn't exist yet.
+    Each write has its own temporary file, so two writes to the same path never mix"""
+    try:
+        fd, tmp_name = tempfile.mkstemp(prefix=f".{path.name}.",
+                                        suffix=".tmp",
+                                        dir=path.parent)
+    except FileNotFoundError:
+        # Only the first save in a new folder gets here
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(prefix=f".{path.name}.",
+                                        suffix=".tmp",
+                                        dir=path.parent)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_name, path)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+    if hasattr(os, "O_DIRECTORY"):
+        # Make sure the rename itself reaches the disk
+        dir_fd = os.open(path.parent, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class SaveService:
+    """Writes saves on a background thread. Only the newest data for each file is written"""
+
+    def __init__(self):
+        self._pending: Dict[Path, Tuple[str, Optional[Callable[[],
+                                                               None]]]] = {}
+        self._condition = threading.Condition()
+        self._writing: bool = False
+        self._thread: Optional[threading.Thread] = None
+        # Last error from the background thread, re-raised by flush
+        self._error: Optional[BaseException] = None
+        # Number of saves requested and actually written
+        self.requested: int = 0
+        self.written: int = 0
+
+    def request(self,
+                path: Path,
+                data: str,
+                after_write: Optional[Callable[[], None]] = None):
+        """Queues data to be written to path. Replaces any queued data for the same path that hasn't been written yet.
+        after_write is called on the background thread once the data is written"""
+        with self._condition:
+            self._pending[path] = (data, after_write)
+            self.requested += 1
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run,
+                                                name="save-service",
+                                                daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+
+    def flush(self, timeout: Optional[float] = None):
+        """Waits until every queued save has been written"""
+        with self._condition:
+            self._condition.wait_for(
+                lambda: not self._pending and not self._writing, timeout)
+            error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending)
+                batch = self._pending
+                self._pending = {}
+                self._writing = True
+            try:
+                for path, (data, after_write) in batch.items():
+                    write_atomic(path, data)
+                    self.written += 1
+                    if after_write is not None:
+                        after_write()
+            except Exception as e:
+                self._error = e
+            finally:
+                with self._condition:
+                    self._writing = False
+                    self._condition.notify_all()
+
+
+_service = SaveService()
+
+
+def request(path: Path,
+            data: str,
+            after_write: Optional[Callable[[], None]] = None):
+    _service.request(path, data, after_write)
+
+
+def flush(timeout: Optional[float] = None):
+    """Waits for queued autosaves to be written. Call before exiting"""
+    _service.flush(timeout)
+
+
+atexit.register(flush, 5)
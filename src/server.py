@@ -0,0 +1,395 @@
+"""Hosts the game for many players at once, like a telnet BBS.
+
+    python src/server.py serve --port 4000         # then `telnet localhost 4000`
+    python src/server.py connect --port 4000       # or play from this terminal without telnet
+    python src/server.py loopback --sessions 100   # scripted players on this machine, then prints stats
+
+Every connection gets its own game on its own thread, drawing through a terminal.SocketBackend. Maps and the story are
+loaded once and shared by all sessions (maps.Map.from_name and story.get_story cache them and never change them), so a
+session only holds its own player, screen, explored tiles and key loop. Saves go in a folder per player name.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import select
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional
+import game_class
+import io_functs
+import keyloop
+import main
+import maps
+import story
+import terminal
+
+DEFAULT_HOST: str = "127.0.0.1"
+DEFAULT_PORT: int = 4000
+SESSION_LINES: int = 25
+SESSION_COLS: int = 85
+SERVER_SAVE_DIR: Path = game_class.SAVE_DIR / "server"
+# Seconds between the stats lines serve prints
+STATS_INTERVAL: float = 60.0
+NAME_PROMPT: str = "Player name: "
+NAME_CHARS: str = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_"
+# Loopback players press a key this often (seconds), choosing from these keys
+LOOPBACK_KEY_DELAY: float = 0.02
+LOOPBACK_KEYS: bytes = b"wasd \r"
+
+
+class Session:
+    """One connected player"""
+
+    def __init__(self, number: int, peer: str):
+        self.number = number
+        self.peer = peer
+        self.name: str = ""
+        self.started: float = time.monotonic()
+        self.backend: Optional[terminal.SocketBackend] = None
+        # CPU time the session's thread used, set when it ends
+        self.cpu_time: float = 0.0
+
+
+class ServerStats(NamedTuple):
+    sessions: int
+    peak_sessions: int
+    total_sessions: int
+    cores: int
+    # Average number of cores the process kept busy since the last stats
+    cores_used: float
+    # Resident memory now and before any session started (bytes)
+    memory: int
+    baseline_memory: int
+    shared_maps: int
+
+    @property
+    def sessions_per_core(self) -> float:
+        return self.sessions / self.cores
+
+    @property
+    def sessions_per_busy_core(self) -> Optional[float]:
+        """How many sessions like the current ones one core could run, None if the server is idle"""
+        return self.sessions / self.cores_used if self.cores_used > 0 else None
+
+    @property
+    def memory_per_session(self) -> float:
+        """Memory used since the server started, shared maps included, per session (bytes)"""
+        return max(self.memory - self.baseline_memory, 0) / max(
+            self.sessions, 1)
+
+    def __str__(self):
+        busy = self.sessions_per_busy_core
+        return (
+            f"{self.sessions} sessions ({self.peak_sessions} peak, {self.total_sessions} total), "
+            f"{self.sessions_per_core:.1f} per core, "
+            f"{self.cores_used:.2f} of {self.cores} cores busy"
+            f"{f' ({busy:.0f} sessions per busy core)' if busy else ''}, "
+            f"{self.memory / 2**20:.1f} MiB resident, "
+            f"{self.memory_per_session / 2**10:.0f} KiB per session, "
+            f"{self.shared_maps} shared maps")
+
+
+def resident_memory() -> int:
+    """Resident memory of this process in bytes, 0 if it can't be found"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    # Peak rather than current, in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def player_name(typed: str) -> str:
+    """Turns a typed name into one that is safe to use as a folder name"""
+    name = "".join(char for char in typed if char in NAME_CHARS)
+    return name[:20] or "guest"
+
+
+class GameServer:
+    """Accepts connections and runs a game for each one"""
+
+    def __init__(self,
+                 host: str = DEFAULT_HOST,
+                 port: int = DEFAULT_PORT,
+                 save_dir: Path = SERVER_SAVE_DIR,
+                 lines: int = SESSION_LINES,
+                 cols: int = SESSION_COLS):
+        self.host = host
+        self.port = port
+        self.save_dir = save_dir
+        self.lines = lines
+        self.cols = cols
+        self.sessions: Dict[int, Session] = {}
+        self.total_sessions: int = 0
+        self.peak_sessions: int = 0
+        # CPU time of sessions that have ended
+        self.finished_cpu_time: float = 0.0
+        self.baseline_memory: int = 0
+        self._lock = threading.Lock()
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._last_sample = (time.perf_counter(), time.process_time())
+
+    async def start(self):
+        # Loaded before anyone connects so every session shares it
+        story.get_story()
+        self.baseline_memory = resident_memory()
+        self._server = await asyncio.start_server(self._handle, self.host,
+                                                  self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._last_sample = (time.perf_counter(), time.process_time())
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def serve_forever(self, stats_interval: float = STATS_INTERVAL):
+        assert self._server is not None
+        while True:
+            await asyncio.sleep(stats_interval)
+            print(self.stats(), flush=True)
+
+    async def wait_for_sessions(self):
+        """Waits until every session has ended"""
+        while self.sessions:
+            await asyncio.sleep(0.05)
+
+    def stats(self) -> ServerStats:
+        now, cpu = time.perf_counter(), time.process_time()
+        last_now, last_cpu = self._last_sample
+        self._last_sample = (now, cpu)
+        with self._lock:
+            sessions = len(self.sessions)
+        cpu_use = 0.0
+        if now > last_now:
+            cpu_use = (cpu - last_cpu) / (now - last_now)
+        return ServerStats(sessions, self.peak_sessions, self.total_sessions,
+                           os.cpu_count() or 1, cpu_use, resident_memory(),
+                           self.baseline_memory, maps.cached_maps())
+
+    async def _handle(self, reader: asyncio.StreamReader,
+                      writer: asyncio.StreamWriter):
+        loop = asyncio.get_running_loop()
+        # The session's thread reads the player's keys from key_socket
+        key_socket, input_socket = socket.socketpair()
+        input_socket.setblocking(False)
+        with self._lock:
+            self.total_sessions += 1
+            session = Session(self.total_sessions,
+                              str(writer.get_extra_info("peername")))
+            self.sessions[session.number] = session
+            self.peak_sessions = max(self.peak_sessions, len(self.sessions))
+
+        def write(data: bytes):
+            if not writer.is_closing():
+                writer.write(data)
+
+        def send(data: bytes):
+            loop.call_soon_threadsafe(write, data)
+
+        writer.write(terminal.TELNET_SETUP)
+        threading.Thread(
+            target=self._run_session,
+            args=(session, key_socket, send,
+                  lambda: loop.call_soon_threadsafe(writer.close)),
+            name=f"session-{session.number}",
+            daemon=True).start()
+        try:
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                await loop.sock_sendall(input_socket, data)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            # The session sees the player as disconnected the next time it waits for a key
+            input_socket.close()
+            writer.close()
+
+    def _run_session(self, session: Session, key_socket: socket.socket,
+                     send: Callable[[bytes], object], close: Callable[[],
+                                                                      object]):
+        backend = terminal.SocketBackend(key_socket, send, self.lines,
+                                         self.cols)
+        session.backend = backend
+        terminal.set_backend(backend)
+        try:
+            terminal.echo()
+            terminal.curs_set(1)
+            session.name = player_name(io_functs.input_screen(NAME_PROMPT))
+            terminal.noecho()
+            game_class.set_save_dir(self.save_dir / session.name)
+            main.main(backend.stdscr)
+        except (terminal.Disconnected, SystemExit):
+            pass
+        except Exception:
+            traceback.print_exc()
+        finally:
+            session.cpu_time = time.thread_time()
+            keyloop.close()
+            key_socket.close()
+            with self._lock:
+                del self.sessions[session.number]
+                self.finished_cpu_time += session.cpu_time
+            close()
+
+
+class LoopbackResult(NamedTuple):
+    peak: ServerStats
+    sessions: int
+    wall_time: float
+    # Totals over every session
+    cpu_time: float
+    bytes_received: int
+
+    def __str__(self):
+        return (
+            f"Peak: {self.peak}\n"
+            f"{self.sessions} sessions in {self.wall_time:.1f} s, "
+            f"{self.cpu_time / self.sessions * 1e3:.1f} ms CPU and "
+            f"{self.bytes_received / self.sessions / 1024:.1f} KiB sent per session"
+        )
+
+
+async def _loopback_player(port: int, number: int, key_count: int) -> int:
+    """Connects, starts a new game and presses random keys. Returns the number of bytes the server sent"""
+    reader, writer = await asyncio.open_connection(DEFAULT_HOST, port)
+    received = 0
+
+    async def drain_output():
+        nonlocal received
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            received += len(data)
+
+    output = asyncio.create_task(drain_output())
+    rng = random.Random(number)
+    # Name, then New Game
+    writer.write(f"player{number}\r".encode("ascii"))
+    await asyncio.sleep(LOOPBACK_KEY_DELAY)
+    writer.write(b"\r")
+    for _ in range(key_count):
+        await asyncio.sleep(LOOPBACK_KEY_DELAY)
+        writer.write(bytes([rng.choice(LOOPBACK_KEYS)]))
+    await writer.drain()
+    writer.close()
+    await output
+    return received
+
+
+async def loopback(sessions: int, key_count: int) -> LoopbackResult:
+    """Runs a server with scripted players connected over the loopback interface"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        server = GameServer(DEFAULT_HOST, 0, Path(tmp_dir))
+        await server.start()
+        start = time.perf_counter()
+        players = asyncio.gather(
+            *(_loopback_player(server.port, number, key_count)
+              for number in range(sessions)))
+        peak: Optional[ServerStats] = None
+        while not players.done():
+            await asyncio.sleep(0.5)
+            sample = server.stats()
+            if peak is None or sample.sessions >= peak.sessions:
+                peak = sample
+        received: List[int] = await players
+        await server.wait_for_sessions()
+        wall_time = time.perf_counter() - start
+        await server.close()
+    if peak is None:
+        peak = server.stats()
+    return LoopbackResult(peak, sessions, wall_time, server.finished_cpu_time,
+                          sum(received))
+
+
+def connect(host: str, port: int):
+    """Plays on a server from this terminal"""
+    # Not on Windows
+    import termios
+    import tty
+    connection = socket.create_connection((host, port))
+    stdin = sys.stdin.fileno()
+    stdout = sys.stdout.fileno()
+    old_settings = termios.tcgetattr(stdin)
+    try:
+        tty.setraw(stdin)
+        while True:
+            readable, _, _ = select.select([connection, stdin], [], [])
+            if connection in readable:
+                data = connection.recv(65536)
+                if not data:
+                    break
+                os.write(stdout, data.replace(terminal.TELNET_SETUP, b""))
+            if stdin in readable:
+                connection.sendall(os.read(stdin, 1024))
+    finally:
+        termios.tcsetattr(stdin, termios.TCSADRAIN, old_settings)
+        os.write(stdout, b"\x1b[0m\x1b[?25h\x1b[2J\x1b[H")
+        connection.close()
+
+
+async def serve(host: str, port: int, save_dir: Path, stats_interval: float):
+    server = GameServer(host, port, save_dir)
+    await server.start()
+    print(f"Serving on {server.host}:{server.port}", flush=True)
+    try:
+        await server.serve_forever(stats_interval)
+    finally:
+        print(server.stats(), flush=True)
+        await server.close()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve_parser = commands.add_parser("serve", help="host the game")
+    serve_parser.add_argument("--host", default=DEFAULT_HOST)
+    serve_parser.add_argument("--port", default=DEFAULT_PORT, type=int)
+    serve_parser.add_argument("--save-dir", default=SERVER_SAVE_DIR, type=Path)
+    serve_parser.add_argument("--stats-interval",
+                              default=STATS_INTERVAL,
+                              type=float,
+                              help="seconds between stats lines")
+    connect_parser = commands.add_parser(
+        "connect", help="play on a server from this terminal")
+    connect_parser.add_argument("--host", default=DEFAULT_HOST)
+    connect_parser.add_argument("--port", default=DEFAULT_PORT, type=int)
+    loopback_parser = commands.add_parser(
+        "loopback", help="run scripted players against a local server")
+    loopback_parser.add_argument("--sessions", default=50, type=int)
+    loopback_parser.add_argument("--keys",
+                                 default=200,
+                                 type=int,
+                                 help="keys each player presses")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        try:
+            asyncio.run(
+                serve(args.host, args.port, args.save_dir,
+                      args.stats_interval))
+        except KeyboardInterrupt:
+            pass
+    elif args.command == "connect":
+        connect(args.host, args.port)
+    elif args.command == "loopback":
+        print(asyncio.run(loopback(args.sessions, args.keys)))
+
+
+if __name__ == "__main__":
+    main_cli()
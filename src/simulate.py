@@ -0,0 +1,179 @@
+"""Headless combat simulator for balancing enemy and player stat curves.
+
+Every fight of a batch is stepped together round by round over the stat arrays
+of two `enemies.CombatantPool`s, one per side, taking the same turns as
+`enemies.auto_battle` but without writing a combat log, so whole level sweeps
+can be run from the command line:
+
+    python src/simulate.py --levels 1-100 --fights 2000
+"""
+
+import argparse
+import statistics
+from collections import Counter
+from typing import List, NamedTuple, Optional, Sequence
+import enemies
+import rng_streams
+
+
+class BatchResult(NamedTuple):
+    """Summary of many simulated fights with the same setup"""
+    player_lvl: int
+    enemy_lvl: int
+    enemy_count: int
+    fights: int
+    wins: int
+    rounds: Counter  # rounds needed to win -> number of fights
+    hp_left: List[int]  # player hp left after each won fight
+
+    @property
+    def win_rate(self) -> float:
+        return self.wins / self.fights if self.fights else 0.0
+
+    @property
+    def mean_rounds(self) -> float:
+        if not self.wins:
+            return 0.0
+        return sum(r * n for r, n in self.rounds.items()) / self.wins
+
+    def rounds_percentile(self, percent: float) -> int:
+        """Smallest round count that at least `percent` of the won fights finished in"""
+        needed = self.wins * percent / 100
+        seen = 0
+        for rounds in sorted(self.rounds):
+            seen += self.rounds[rounds]
+            if seen >= needed:
+                return rounds
+        return 0
+
+    def __str__(self):
+        if not self.wins:
+            return (f"Lvl {self.player_lvl} vs {self.enemy_count}x"
+                    f"Lvl {self.enemy_lvl}: win {self.win_rate:6.1%}")
+        return (f"Lvl {self.player_lvl} vs {self.enemy_count}x"
+                f"Lvl {self.enemy_lvl}: win {self.win_rate:6.1%}  "
+                f"rounds mean {self.mean_rounds:5.2f} "
+                f"p50 {self.rounds_percentile(50)} "
+                f"p90 {self.rounds_percentile(90)}  "
+                f"hp left {statistics.mean(self.hp_left):6.1f}")
+
+
+def simulate(player_lvl: int,
+             enemy_lvl: int,
+             enemy_count: int = 3,
+             fights: int = 1000,
+             skill: str = "Punch",
+             seed: Optional[int] = None,
+             max_rounds: int = 1000) -> BatchResult:
+    """Simulates `fights` fights of a player against a group of slimes, all stepped together round by round.
+    Each fight takes the turns of `enemies.auto_battle` with `enemies.repeat_last_action`: every round the player
+    uses `skill` on the first living enemy until their turns run out or it is defeated, then every living enemy
+    attacks. If seed is given, the random streams are reseeded with it first"""
+    if skill not in enemies.SKILLS:
+        raise ValueError(f"Unknown skill: {skill}")
+    if seed is not None:
+        rng_streams.seed(seed)
+    # Combatants are made by the game's own classes, one pool per side holding every fight
+    players = enemies.CombatantPool()
+    foes = enemies.CombatantPool()
+    for _ in range(fights):
+        enemies.Player(player_lvl, [skill], players)
+        enemies.slime_wave(enemy_lvl, enemy_count, foes)
+    randint = rng_streams.get("combat").randint
+    bonus = enemies.SKILL_BONUS
+    player_hp = list(players.hp)
+    player_turns = players.turns
+    skill_base = [enemies.skill_damage(skill, atk, 0) for atk in players.atk]
+    foe_hp = list(foes.hp)
+    foe_turns = foes.turns
+    foe_hits = [enemies.hit_range(atk) for atk in foes.atk]
+    # Slot of the enemy each player attacks. Enemies are defeated in order, so the ones after it are still alive
+    targets = list(range(0, fights * enemy_count, enemy_count))
+
+    rounds: Counter = Counter()
+    hp_left: List[int] = []
+    wins = 0
+    active = list(range(fights))
+    round_number = 0
+    while active and round_number < max_rounds:
+        round_number += 1
+        still_active: List[int] = []
+        for fight in active:
+            target = targets[fight]
+            hp = foe_hp[target]
+            for _ in range(player_turns[fight]):
+                hp -= skill_base[fight] + randint(0, bonus)
+                if hp <= 0:
+                    break
+            foe_hp[target] = hp
+            end = (fight + 1) * enemy_count
+            if hp <= 0:
+                target += 1
+                targets[fight] = target
+                if target == end:
+                    wins += 1
+                    rounds[round_number] += 1
+                    hp_left.append(player_hp[fight])
+                    continue
+
+            hp = player_hp[fight]
+            for foe in range(target, end):
+                low, high = foe_hits[foe]
+                for _ in range(foe_turns[foe]):
+                    hp -= randint(low, high)
+                    if hp <= 0:
+                        break
+                if hp <= 0:
+                    break
+            player_hp[fight] = hp
+            if hp > 0:
+                still_active.append(fight)
+        active = still_active
+
+    return BatchResult(player_lvl, enemy_lvl, enemy_count, fights, wins,
+                       rounds, hp_left)
+
+
+def sweep(levels: Sequence[int],
+          enemy_count: int = 3,
+          fights: int = 1000,
+          skill: str = "Punch",
+          enemy_lvl_offset: int = 0,
+          seed: Optional[int] = None) -> List[BatchResult]:
+    """Simulates each level in `levels` against enemies of the same level plus `enemy_lvl_offset`"""
+    results: List[BatchResult] = []
+    for index, lvl in enumerate(levels):
+        enemy_lvl = max(1, lvl + enemy_lvl_offset)
+        level_seed = None if seed is None else seed + index
+        results.append(
+            simulate(lvl, enemy_lvl, enemy_count, fights, skill, level_seed))
+    return results
+
+
+def _parse_levels(text: str) -> List[int]:
+    """Parses `5`, `1-100` or `1,5,10` into a list of levels"""
+    if "-" in text:
+        start, end = text.split("-", 1)
+        return list(range(int(start), int(end) + 1))
+    return [int(part) for part in text.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--levels", default="1-100", type=_parse_levels)
+    parser.add_argument("--fights", default=1000, type=int)
+    parser.add_argument("--enemies", default=3, type=int)
+    parser.add_argument("--skill", default="Punch", choices=enemies.SKILLS)
+    parser.add_argument("--offset",
+                        default=0,
+                        type=int,
+                        help="Enemy level relative to player level")
+    parser.add_argument("--seed", default=None, type=int)
+    args = parser.parse_args()
+    for result in sweep(args.levels, args.enemies, args.fights, args.skill,
+                        args.offset, args.seed):
+        print(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+"""Story scripts (see story/story_format.md).
+
+Each chapter's .story file is compiled to a list of steps per section, with blocks (choice options, map handlers)
+turned into jumps, and the steps are cached in a .storyc file next to the script. Chapters are only loaded when the
+story reaches them: story/chapters.txt says which story_progress each chapter starts at, so resuming a save only
+loads the chapter it is in.
+"""
+
+import bisect
+import marshal
+import os
+import struct
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+STORY_DIR: Path = Path(__file__).parent.parent / "story"
+CHAPTER_INDEX: str = "chapters.txt"
+# Compiled chapter format (.storyc): header (magic, format version) followed by the marshalled sections
+STORYC_MAGIC: bytes = b"TGSC"
+STORYC_VERSION: int = 1
+STORYC_HEADER = struct.Struct("<4sH")
+CHAPTER_CACHE_SIZE: int = 8
+
+Step = Tuple[Any, ...]
+# (section name, steps)
+Section = Tuple[str, Tuple[Step, ...]]
+
+# Command -> number of words its argument is split into (0 for none, 1 for the whole rest of the line)
+_ARGUMENTS: Dict[str, int] = {
+    "print": 1,
+    "clear": 0,
+    "advance": 0,
+    "autosave": 0,
+    "end": 0,
+    "grant": 1,
+    "battle": 3,
+    "choice": 1,
+    "option": 1,
+    "map": 1,
+    "on": 1,
+    "take": 0,
+    "swap_map": 1,
+}
+# Commands that must have an indented block, and the only command allowed directly in it
+_BLOCK_CHILDREN: Dict[str, str] = {"choice": "option", "map": "on"}
+# Commands that only make sense while a map handler is running
+_HANDLER_COMMANDS = ("take", "swap_map")
+
+
+class StoryError(ValueError):
+    """A story script that can't be compiled, or a step that can't be run"""
+
+
+class _Node(NamedTuple):
+    command: str
+    argument: str
+    line: int
+    children: List["_Node"]
+
+
+def _parse(text: str) -> List[_Node]:
+    """Turns the lines of a script into a tree of commands using their indentation"""
+    roots: List[_Node] = []
+    # (indent, children of the node at that indent)
+    stack: List[Tuple[int, List[_Node]]] = [(-1, roots)]
+    for line_num, line in enumerate(text.splitlines(), start=1):
+        stripped = line.strip()
+        if not stripped or stripped.startswith("#"):
+            continue
+        indent = len(line) - len(line.lstrip())
+        while indent <= stack[-1][0]:
+            stack.pop()
+        command, _, argument = stripped.partition(" ")
+        node = _Node(command, argument.strip(), line_num, [])
+        stack[-1][1].append(node)
+        stack.append((indent, node.children))
+    return roots
+
+
+class _Compiler:
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.steps: List[Step] = []
+
+    def error(self, node: _Node, message: str) -> StoryError:
+        return StoryError(f"{self.file_name}:{node.line}: {message}")
+
+    def section(self, node: _Node) -> Section:
+        if node.command != "section" or not node.argument:
+            raise self.error(node, "Expected `section <name>`.")
+        if not any(child.command in ("advance", "end")
+                   for child in node.children):
+            raise self.error(node, "Section never uses advance or end.")
+        self.steps = []
+        self.block(node.children, in_handler=False)
+        return node.argument, tuple(self.steps)
+
+    def block(self, nodes: List[_Node], in_handler: bool):
+        for node in nodes:
+            self.command(node, in_handler)
+
+    def command(self, node: _Node, in_handler: bool):
+        command = node.command
+        if command not in _ARGUMENTS:
+            raise self.error(node, f"Unknown command: {command}")
+        for parent, child in _BLOCK_CHILDREN.items():
+            if command == child:
+                raise self.error(node,
+                                 f"{command} must be in a {parent} block.")
+        if command in _HANDLER_COMMANDS and not in_handler:
+            raise self.error(node,
+                             f"{command} can only be used in a map handler.")
+        word_count = _ARGUMENTS[command]
+        words = node.argument.split()
+        if word_count == 0:
+            valid = not words
+        elif word_count == 1:
+            valid = bool(words)
+        else:
+            valid = len(words) == word_count
+        if not valid:
+            raise self.error(node, f"Wrong arguments for {command}.")
+        if node.children and command not in _BLOCK_CHILDREN:
+            raise self.error(node, f"{command} can't have a block.")
+
+        if command == "choice":
+            self.choice(node, in_handler)
+        elif command == "map":
+            if in_handler:
+                raise self.error(node,
+                                 "Maps can't be opened from a map handler.")
+            self.map(node)
+        elif command == "battle":
+            kind, lvl, count = words
+            if not (lvl.isdigit() and count.isdigit()):
+                raise self.error(node,
+                                 "Expected `battle <kind> <level> <count>`.")
+            self.steps.append((command, kind, int(lvl), int(count)))
+        elif word_count:
+            self.steps.append((command, node.argument))
+        else:
+            self.steps.append((command, ))
+
+    def _children(self, node: _Node) -> List[_Node]:
+        child_command = _BLOCK_CHILDREN[node.command]
+        if not node.children:
+            raise self.error(
+                node, f"{node.command} needs at least one {child_command}.")
+        for child in node.children:
+            if child.command != child_command or not child.argument:
+                raise self.error(child, f"Expected `{child_command} <...>`.")
+        return node.children
+
+    def choice(self, node: _Node, in_handler: bool):
+        """choice, then each option's block followed by a jump past the others"""
+        options = self._children(node)
+        choice_index = len(self.steps)
+        self.steps.append(())
+        targets: List[int] = []
+        jumps: List[int] = []
+        for option in options:
+            targets.append(len(self.steps))
+            self.block(option.children, in_handler)
+            jumps.append(len(self.steps))
+            self.steps.append(())
+        end = len(self.steps)
+        for jump in jumps:
+            self.steps[jump] = ("jump", end)
+        names = tuple(option.argument for option in options)
+        self.steps[choice_index] = ("choice", node.argument, names,
+                                    tuple(targets))
+
+    def map(self, node: _Node):
+        """map, then each handler's block followed by a return"""
+        handlers: Dict[int, int] = {}
+        map_index = len(self.steps)
+        self.steps.append(())
+        for handler in self._children(node):
+            if not handler.argument.isdigit() or not 1 <= int(
+                    handler.argument) <= 8:
+                raise self.error(handler, "Expected `on <1-8>`.")
+            handlers[int(handler.argument)] = len(self.steps)
+            self.block(handler.children, in_handler=True)
+            self.steps.append(("return", ))
+        self.steps[map_index] = ("map", node.argument, handlers,
+                                 len(self.steps))
+
+
+def compile_script(text: str,
+                   file_name: str = "<story>") -> Tuple[Section, ...]:
+    """Compiles the text of a .story file to its sections"""
+    compiler = _Compiler(file_name)
+    return tuple(compiler.section(node) for node in _parse(text))
+
+
+def _compile_chapter(script_path: Path,
+                     compiled_path: Path) -> Tuple[Section, ...]:
+    """Loads a chapter from its .storyc file if that is up to date, otherwise compiles the script and writes one"""
+    try:
+        if compiled_path.stat().st_mtime_ns >= script_path.stat().st_mtime_ns:
+            with compiled_path.open("rb") as f:
+                data = f.read()
+            magic, version = STORYC_HEADER.unpack_from(data)
+            if magic == STORYC_MAGIC and version == STORYC_VERSION:
+                return marshal.loads(data[STORYC_HEADER.size:])
+    except (OSError, ValueError, EOFError, TypeError, struct.error):
+        # Missing, old or corrupt compiled chapter
+        pass
+    with script_path.open("r") as f:
+        sections = compile_script(f.read(), script_path.name)
+    tmp_path = Path(f"{compiled_path}.tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(STORYC_HEADER.pack(STORYC_MAGIC, STORYC_VERSION))
+            f.write(marshal.dumps(sections))
+        os.replace(tmp_path, compiled_path)
+    except OSError:
+        # Read only story folder
+        pass
+    return sections
+
+
+class Story:
+    """All of the chapters in a story folder"""
+
+    def __init__(self, story_dir: Path = STORY_DIR):
+        self.story_dir = story_dir
+        self._starts: List[int] = []
+        self._names: List[str] = []
+        with (story_dir / CHAPTER_INDEX).open("r") as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                start, name = line.split(maxsplit=1)
+                if self._starts and int(start) <= self._starts[-1]:
+                    raise StoryError(
+                        f"{CHAPTER_INDEX}: Chapters are out of order.")
+                self._starts.append(int(start))
+                self._names.append(name)
+        self._chapters: "OrderedDict[str, Tuple[Section, ...]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def chapter(self, name: str) -> Tuple[Section, ...]:
+        """Gets the sections of a chapter, loading it if it isn't cached"""
+        with self._lock:
+            sections = self._chapters.get(name)
+            if sections is None:
+                sections = _compile_chapter(self.story_dir / f"{name}.story",
+                                            self.story_dir / f"{name}.storyc")
+                self._chapters[name] = sections
+                while len(self._chapters) > CHAPTER_CACHE_SIZE:
+                    self._chapters.popitem(last=False)
+            else:
+                self._chapters.move_to_end(name)
+            return sections
+
+    def section(self, story_progress: int) -> Optional[Section]:
+        """Gets the section for a story_progress, None if the story doesn't go that far"""
+        chapter_num = bisect.bisect_right(self._starts, story_progress) - 1
+        if chapter_num < 0:
+            return None
+        sections = self.chapter(self._names[chapter_num])
+        offset = story_progress - self._starts[chapter_num]
+        if offset >= len(sections):
+            if chapter_num + 1 < len(self._starts):
+                raise StoryError(
+                    f"{self._names[chapter_num]}.story ends before story_progress {story_progress}, "
+                    "where the next chapter starts.")
+            return None
+        return sections[offset]
+
+
+_stories: Dict[Path, Story] = {}
+_stories_lock = threading.Lock()
+
+
+def get_story(story_dir: Path = STORY_DIR) -> Story:
+    """Gets the shared Story for a story folder"""
+    with _stories_lock:
+        if story_dir not in _stories:
+            _stories[story_dir] = Story(story_dir)
+        return _stories[story_dir]
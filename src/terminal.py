@@ -0,0 +1,674 @@
+"""Screen backends. The game draws through the active backend, which is curses by default.
+The in-memory backend keeps the screen in arrays and reads keys from a script, so the game can run without a terminal:
+
+    backend = terminal.run_headless(main.main, ["\\n", " ", ...])
+    print("\\n".join(backend.snapshot()))
+
+The socket backend does the same but sends the screen to a remote terminal and reads its keys from a socket (see
+server.py). Each thread has its own active backend, so many games can run at once in one process.
+"""
+
+import curses
+import select
+import socket
+import sys
+import threading
+import time
+from array import array
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Tuple, Union
+
+
+class ScriptExhausted(Exception):
+    """Raised by the in-memory backend when the game wants a key and the key script is empty"""
+
+
+class Disconnected(Exception):
+    """Raised by the socket backend when the game wants a key and the player has disconnected"""
+
+
+class CursesBackend:
+    """Draws to the real terminal with curses"""
+    delays: bool = True
+
+    def newwin(self,
+               nlines: int,
+               ncols: int,
+               begin_y: int = 0,
+               begin_x: int = 0):
+        return curses.newwin(nlines, ncols, begin_y, begin_x)
+
+    def newpad(self, nlines: int, ncols: int):
+        return curses.newpad(nlines, ncols)
+
+    def lines(self) -> int:
+        return curses.LINES
+
+    def fileno(self) -> Optional[int]:
+        return sys.stdin.fileno()
+
+    def cols(self) -> int:
+        return curses.COLS
+
+    def update_lines_cols(self):
+        curses.update_lines_cols()
+
+    def curs_set(self, visibility: int):
+        curses.curs_set(visibility)
+
+    def echo(self):
+        curses.echo()
+
+    def noecho(self):
+        curses.noecho()
+
+    def halfdelay(self, tenths: int):
+        curses.halfdelay(tenths)
+
+    def cbreak(self):
+        curses.cbreak()
+
+
+class MemoryWindow:
+    """A window whose characters and attributes are stored in arrays. Supports the parts of the curses window API the game uses"""
+
+    def __init__(self, backend: "MemoryBackend", nlines: int, ncols: int,
+                 begin_y: int, begin_x: int):
+        self._backend = backend
+        self._lines = nlines
+        self._cols = ncols
+        self._begin_y = begin_y
+        self._begin_x = begin_x
+        self._chars = array("u", " " * (nlines * ncols))
+        self._attrs = array("q", bytes(8 * nlines * ncols))
+        self._y = 0
+        self._x = 0
+        self._nodelay = False
+        self._timeout = -1
+
+    # Output
+    def _put(self, char: str, attr: int):
+        if char == "\n":
+            self.clrtoeol()
+            if self._y == self._lines - 1:
+                raise curses.error("addch() returned ERR")
+            self._y += 1
+            self._x = 0
+            return
+        index = self._y * self._cols + self._x
+        self._chars[index] = char
+        self._attrs[index] = attr
+        self._x += 1
+        if self._x == self._cols:
+            if self._y == self._lines - 1:
+                self._x -= 1
+                raise curses.error("addch() returned ERR")
+            self._x = 0
+            self._y += 1
+
+    def _parse_args(self, args: Tuple[Any, ...]) -> Tuple[Any, int]:
+        """Handles the optional y, x and attr arguments of addch and addstr"""
+        if len(args) >= 3:
+            self.move(args[0], args[1])
+            args = args[2:]
+        text = args[0]
+        attr = args[1] if len(args) > 1 else curses.A_NORMAL
+        return text, attr
+
+    def addch(self, *args):
+        char, attr = self._parse_args(args)
+        if isinstance(char, int):
+            char = chr(char)
+        self._put(char, attr)
+
+    def addstr(self, *args):
+        text, attr = self._parse_args(args)
+        for char in text:
+            self._put(char, attr)
+
+    def move(self, y: int, x: int):
+        if not (0 <= y < self._lines and 0 <= x < self._cols):
+            raise curses.error("wmove() returned ERR")
+        self._y = y
+        self._x = x
+
+    def clear(self):
+        self.erase()
+
+    def erase(self):
+        size = self._lines * self._cols
+        self._chars[:] = array("u", " " * size)
+        self._attrs[:] = array("q", bytes(8 * size))
+        self._y = 0
+        self._x = 0
+
+    def clrtoeol(self):
+        start = self._y * self._cols + self._x
+        end = (self._y + 1) * self._cols
+        for index in range(start, end):
+            self._chars[index] = " "
+            self._attrs[index] = curses.A_NORMAL
+
+    def box(self):
+        last_y = self._lines - 1
+        last_x = self._cols - 1
+        for x in range(1, last_x):
+            self._chars[x] = "-"
+            self._chars[last_y * self._cols + x] = "-"
+        for y in range(1, last_y):
+            self._chars[y * self._cols] = "|"
+            self._chars[y * self._cols + last_x] = "|"
+        for y, x in ((0, 0), (0, last_x), (last_y, 0), (last_y, last_x)):
+            self._chars[y * self._cols + x] = "+"
+
+    def refresh(self):
+        self._backend._blit(self)
+
+    def noutrefresh(self):
+        self._backend._blit(self)
+
+    def redrawwin(self):
+        self._backend._blit(self)
+
+    def touchwin(self):
+        pass
+
+    def resize(self, nlines: int, ncols: int):
+        self._lines = nlines
+        self._cols = ncols
+        self._chars = array("u", " " * (nlines * ncols))
+        self._attrs = array("q", bytes(8 * nlines * ncols))
+        self._y = min(self._y, nlines - 1)
+        self._x = min(self._x, ncols - 1)
+
+    def mvwin(self, new_y: int, new_x: int):
+        self._begin_y = new_y
+        self._begin_x = new_x
+
+    # Information
+    def getyx(self) -> Tuple[int, int]:
+        return self._y, self._x
+
+    def getmaxyx(self) -> Tuple[int, int]:
+        return self._lines, self._cols
+
+    def getbegyx(self) -> Tuple[int, int]:
+        return self._begin_y, self._begin_x
+
+    def instr(self, y: int, x: int, n: int) -> bytes:
+        start = y * self._cols + x
+        return self._chars[start:start + n].tounicode().encode("utf-8")
+
+    # Input
+    def keypad(self, flag: bool):
+        pass
+
+    def nodelay(self, flag: bool):
+        self._nodelay = flag
+
+    def timeout(self, delay: int):
+        self._timeout = delay
+
+    def getch(self) -> int:
+        self.refresh()
+        if self._nodelay:
+            return self._backend._poll_key()
+        if self._timeout >= 0:
+            if self._backend.delays:
+                time.sleep(self._timeout / 1000)
+            return curses.ERR
+        return self._backend._next_key()
+
+    def getstr(self, *args) -> bytes:
+        if len(args) >= 2:
+            self.move(args[0], args[1])
+        limit = None
+        if len(args) >= 3:
+            limit = args[2]
+        elif len(args) == 1:
+            limit = args[0]
+        typed: List[str] = []
+        while True:
+            key = self._backend._next_key()
+            if key in (ord("\n"), ord("\r"), curses.KEY_ENTER):
+                break
+            if key in (curses.KEY_BACKSPACE, 127, 8):
+                if typed:
+                    typed.pop()
+                    if self._backend.echoing and self._x > 0:
+                        self._x -= 1
+                        self._put(" ", curses.A_NORMAL)
+                        self._x -= 1
+                        self.refresh()
+                continue
+            if limit is not None and len(typed) >= limit:
+                continue
+            typed.append(chr(key))
+            if self._backend.echoing:
+                self._put(chr(key), curses.A_NORMAL)
+                self.refresh()
+        return "".join(typed).encode("utf-8")
+
+
+class MemoryPad(MemoryWindow):
+    """A window that isn't on the screen. Part of it is shown with refresh, like a curses pad"""
+
+    def __init__(self, backend: "MemoryBackend", nlines: int, ncols: int):
+        super().__init__(backend, nlines, ncols, 0, 0)
+
+    def refresh(self, pminrow: int, pmincol: int, sminrow: int, smincol: int,
+                smaxrow: int, smaxcol: int):
+        pminrow = max(pminrow, 0)
+        pmincol = max(pmincol, 0)
+        lines = min(smaxrow - sminrow + 1, self._lines - pminrow)
+        cols = min(smaxcol - smincol + 1, self._cols - pmincol)
+        if lines > 0 and cols > 0:
+            self._backend._blit_region(self, pminrow, pmincol, sminrow,
+                                       smincol, lines, cols)
+
+    def noutrefresh(self, *args):
+        self.refresh(*args)
+
+    def redrawwin(self):
+        pass
+
+
+class MemoryBackend:
+    """Keeps the screen in memory and reads keys from a script"""
+
+    def __init__(self,
+                 lines: int = 25,
+                 cols: int = 85,
+                 keys: Iterable[Union[int, str]] = (),
+                 delays: bool = False):
+        self._lines = lines
+        self._cols = cols
+        self.delays = delays
+        self.echoing = False
+        self.cursor_visibility = 1
+        self._keys: Deque[int] = deque()
+        self.feed(keys)
+        self._screen_chars = array("u", " " * (lines * cols))
+        self._screen_attrs = array("q", bytes(8 * lines * cols))
+        self.stdscr = MemoryWindow(self, lines, cols, 0, 0)
+        # Number of keys the game has read
+        self.keys_read = 0
+
+    def feed(self, keys: Iterable[Union[int, str]]):
+        """Adds keys to the end of the key script. Strings are split into one key per character"""
+        for key in keys:
+            if isinstance(key, str):
+                self._keys.extend(map(ord, key))
+            else:
+                self._keys.append(key)
+
+    def _next_key(self) -> int:
+        if not self._keys:
+            raise ScriptExhausted()
+        self.keys_read += 1
+        return self._keys.popleft()
+
+    def _poll_key(self) -> int:
+        """The next key if one has already been typed, curses.ERR otherwise"""
+        # Scripted keys are typed later, there is never anything buffered
+        return curses.ERR
+
+    def _blit(self, window: MemoryWindow):
+        """Copies a window onto the screen, clipped to the screen edges"""
+        lines, cols = window.getmaxyx()
+        begin_y, begin_x = window.getbegyx()
+        self._blit_region(window, 0, 0, begin_y, begin_x, lines, cols)
+
+    def _blit_region(self, window: MemoryWindow, top: int, left: int,
+                     screen_y: int, screen_x: int, lines: int, cols: int):
+        """Copies lines x cols cells of a window, starting at (top, left), to (screen_y, screen_x) on the screen"""
+        window_cols = window.getmaxyx()[1]
+        first = max(0, -screen_x)
+        last = min(cols, self._cols - screen_x)
+        if last <= first:
+            return
+        for y in range(max(0, -screen_y), min(lines, self._lines - screen_y)):
+            src = (top + y) * window_cols + left
+            dest = (screen_y + y) * self._cols + screen_x
+            self._screen_chars[dest + first:dest +
+                               last] = window._chars[src + first:src + last]
+            self._screen_attrs[dest + first:dest +
+                               last] = window._attrs[src + first:src + last]
+
+    def snapshot(self) -> List[str]:
+        """Gets the text on the screen, one string per line"""
+        text = self._screen_chars.tounicode()
+        return [
+            text[y * self._cols:(y + 1) * self._cols]
+            for y in range(self._lines)
+        ]
+
+    def attr_at(self, y: int, x: int) -> int:
+        return self._screen_attrs[y * self._cols + x]
+
+    # The rest mirrors CursesBackend
+    def newwin(self,
+               nlines: int,
+               ncols: int,
+               begin_y: int = 0,
+               begin_x: int = 0) -> MemoryWindow:
+        if nlines <= 0 or ncols <= 0:
+            raise curses.error("curses function returned NULL")
+        return MemoryWindow(self, nlines, ncols, begin_y, begin_x)
+
+    def lines(self) -> int:
+        return self._lines
+
+    def newpad(self, nlines: int, ncols: int) -> "MemoryPad":
+        if nlines <= 0 or ncols <= 0:
+            raise curses.error("curses function returned NULL")
+        return MemoryPad(self, nlines, ncols)
+
+    def fileno(self) -> Optional[int]:
+        """Keys come from the script, there is nothing to wait on"""
+        return None
+
+    def cols(self) -> int:
+        return self._cols
+
+    def update_lines_cols(self):
+        pass
+
+    def curs_set(self, visibility: int):
+        self.cursor_visibility = visibility
+
+    def echo(self):
+        self.echoing = True
+
+    def noecho(self):
+        self.echoing = False
+
+    def halfdelay(self, tenths: int):
+        pass
+
+    def cbreak(self):
+        pass
+
+
+# Telnet commands (RFC 854) and the options the server asks for, so telnet clients send each key as it is typed
+# and don't echo it themselves
+IAC: int = 255
+SB: int = 250
+SE: int = 240
+WILL: int = 251
+ECHO: int = 1
+SUPPRESS_GO_AHEAD: int = 3
+TELNET_SETUP: bytes = bytes([IAC, WILL, ECHO, IAC, WILL, SUPPRESS_GO_AHEAD])
+# ANSI escape sequences and the keys they stand for
+ESCAPE_KEYS: Dict[bytes, int] = {
+    b"[A": curses.KEY_UP,
+    b"[B": curses.KEY_DOWN,
+    b"[C": curses.KEY_RIGHT,
+    b"[D": curses.KEY_LEFT,
+    b"OA": curses.KEY_UP,
+    b"OB": curses.KEY_DOWN,
+    b"OC": curses.KEY_RIGHT,
+    b"OD": curses.KEY_LEFT,
+}
+# Attribute -> Select Graphic Rendition parameter
+SGR_CODES: Tuple[Tuple[int, int], ...] = (
+    (curses.A_BOLD, 1),
+    (curses.A_DIM, 2),
+    (getattr(curses, "A_ITALIC", 0), 3),
+    (curses.A_UNDERLINE, 4),
+    (curses.A_REVERSE | curses.A_STANDOUT, 7),
+)
+
+
+def decode_keys(data: bytearray) -> List[int]:
+    """Takes the keys out of the start of data, raw input from a telnet client or terminal.
+    Leaves an incomplete escape sequence or telnet command at the end in data"""
+    keys: List[int] = []
+    i = 0
+    while i < len(data):
+        byte = data[i]
+        if byte == IAC:
+            if i + 1 >= len(data):
+                break
+            command = data[i + 1]
+            if command == IAC:
+                keys.append(IAC)
+                i += 2
+            elif command == SB:
+                end = data.find(bytes([IAC, SE]), i + 2)
+                if end == -1:
+                    break
+                i = end + 2
+            elif command >= WILL:
+                if i + 2 >= len(data):
+                    break
+                i += 3
+            else:
+                i += 2
+        elif byte == 27:
+            # A lone escape is the escape key, otherwise it starts an escape sequence
+            if i + 1 >= len(data):
+                keys.append(27)
+                i += 1
+                continue
+            if data[i + 1] not in b"[O":
+                keys.append(27)
+                i += 1
+                continue
+            end = i + 2
+            while end < len(data) and not 0x40 <= data[end] <= 0x7e:
+                end += 1
+            if end >= len(data):
+                break
+            sequence = bytes(data[i + 1:end + 1])
+            if sequence in ESCAPE_KEYS:
+                keys.append(ESCAPE_KEYS[sequence])
+            i = end + 1
+        elif byte == ord("\r"):
+            keys.append(ord("\n"))
+            i += 1
+            # Telnet sends enter as \r\n or \r\0
+            if i < len(data) and data[i] in b"\n\0":
+                i += 1
+        elif byte == 0:
+            i += 1
+        else:
+            keys.append(byte)
+            i += 1
+    del data[:i]
+    return keys
+
+
+def sgr(attr: int) -> str:
+    """The escape sequence that switches a terminal to an attribute"""
+    codes = ["0"] + [str(code) for flag, code in SGR_CODES if attr & flag]
+    return f"\x1b[{';'.join(codes)}m"
+
+
+class SocketBackend(MemoryBackend):
+    """Keeps the screen in memory and sends the parts that change to a remote terminal as ANSI escape sequences.
+    Keys are read from key_socket, which the server writes the player's input to"""
+
+    def __init__(self,
+                 key_socket: socket.socket,
+                 send: Callable[[bytes], object],
+                 lines: int = 25,
+                 cols: int = 85):
+        super().__init__(lines, cols, delays=True)
+        self._key_socket = key_socket
+        self._key_socket.setblocking(False)
+        self._send = send
+        self._input = bytearray()
+        # What the remote terminal is showing
+        self._sent_chars = array("u", " " * (lines * cols))
+        self._sent_attrs = array("q", bytes(8 * lines * cols))
+        self.bytes_sent = 0
+        self._send_text("\x1b[0m\x1b[2J\x1b[?25l")
+
+    def _send_text(self, text: str):
+        data = text.encode("utf-8", errors="replace")
+        self.bytes_sent += len(data)
+        self._send(data)
+
+    def _read_input(self, wait: bool):
+        """Reads whatever the player has typed. If wait is True, waits until they type something"""
+        if wait:
+            select.select([self._key_socket], [], [])
+        try:
+            data = self._key_socket.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            raise Disconnected()
+        self._input += data
+        self._keys.extend(decode_keys(self._input))
+
+    def _next_key(self) -> int:
+        while not self._keys:
+            self._read_input(True)
+        self.keys_read += 1
+        return self._keys.popleft()
+
+    def _poll_key(self) -> int:
+        if not self._keys:
+            self._read_input(False)
+        if not self._keys:
+            return curses.ERR
+        self.keys_read += 1
+        return self._keys.popleft()
+
+    def fileno(self) -> Optional[int]:
+        return self._key_socket.fileno()
+
+    def _blit_region(self, window: MemoryWindow, top: int, left: int,
+                     screen_y: int, screen_x: int, lines: int, cols: int):
+        super()._blit_region(window, top, left, screen_y, screen_x, lines,
+                             cols)
+        self._send_rows(max(screen_y, 0), min(screen_y + lines, self._lines))
+
+    def _send_rows(self, first: int, last: int):
+        """Sends the changed part of each screen row from first to last"""
+        parts: List[str] = []
+        for y in range(first, last):
+            start = y * self._cols
+            end = start + self._cols
+            if (self._screen_chars[start:end] == self._sent_chars[start:end]
+                    and self._screen_attrs[start:end]
+                    == self._sent_attrs[start:end]):
+                continue
+            changed = [
+                index for index in range(start, end)
+                if self._screen_chars[index] != self._sent_chars[index]
+                or self._screen_attrs[index] != self._sent_attrs[index]
+            ]
+            first_changed, last_changed = changed[0], changed[-1] + 1
+            parts.append(f"\x1b[{y + 1};{first_changed - start + 1}H")
+            attr = None
+            for index in range(first_changed, last_changed):
+                if self._screen_attrs[index] != attr:
+                    attr = self._screen_attrs[index]
+                    parts.append(sgr(attr))
+                parts.append(self._screen_chars[index])
+            self._sent_chars[first_changed:last_changed] = self._screen_chars[
+                first_changed:last_changed]
+            self._sent_attrs[first_changed:last_changed] = self._screen_attrs[
+                first_changed:last_changed]
+        if parts:
+            parts.append("\x1b[0m")
+            self._send_text("".join(parts))
+
+    def curs_set(self, visibility: int):
+        super().curs_set(visibility)
+        self._send_text("\x1b[?25h" if visibility else "\x1b[?25l")
+
+
+Backend = Union[CursesBackend, MemoryBackend]
+
+
+class _ActiveBackend(threading.local):
+    """The backend of the current thread. Every thread draws with curses until it sets another one"""
+    backend: Backend = CursesBackend()
+
+
+_active = _ActiveBackend()
+
+
+def get_backend() -> Backend:
+    return _active.backend
+
+
+def set_backend(backend: Backend):
+    """Sets the backend of the current thread"""
+    _active.backend = backend
+
+
+def run_headless(func: Callable[[Any], Any],
+                 keys: Iterable[Union[int, str]] = (),
+                 lines: int = 25,
+                 cols: int = 85,
+                 delays: bool = False) -> MemoryBackend:
+    """Runs func(stdscr) on an in-memory screen until it returns, exits or runs out of keys.
+    Returns the backend so the screen can be checked"""
+    backend = MemoryBackend(lines, cols, keys, delays)
+    previous = get_backend()
+    set_backend(backend)
+    try:
+        func(backend.stdscr)
+    except (ScriptExhausted, SystemExit):
+        pass
+    finally:
+        set_backend(previous)
+    return backend
+
+
+# Functions the game calls instead of the curses ones
+def newwin(nlines: int, ncols: int, begin_y: int = 0, begin_x: int = 0):
+    return _active.backend.newwin(nlines, ncols, begin_y, begin_x)
+
+
+def newpad(nlines: int, ncols: int):
+    return _active.backend.newpad(nlines, ncols)
+
+
+def lines() -> int:
+    return _active.backend.lines()
+
+
+def fileno() -> Optional[int]:
+    """File descriptor keys are read from, None if keys don't come from a file"""
+    return _active.backend.fileno()
+
+
+def cols() -> int:
+    return _active.backend.cols()
+
+
+def update_lines_cols():
+    _active.backend.update_lines_cols()
+
+
+def curs_set(visibility: int):
+    _active.backend.curs_set(visibility)
+
+
+def echo():
+    _active.backend.echo()
+
+
+def noecho():
+    _active.backend.noecho()
+
+
+def halfdelay(tenths: int):
+    _active.backend.halfdelay(tenths)
+
+
+def cbreak():
+    _active.backend.cbreak()
+
+
+def delays_enabled() -> bool:
+    """Whether animations like the story_print typewriter effect should play"""
+    return _active.backend.delays
@@ -0,0 +1,41 @@
+import random
+from typing import Callable, List
+import pytest
+import maps
+
+
+def make_rows(height: int,
+              width: int,
+              wall_chance: float = 0.25,
+              seed: int = 0) -> List[str]:
+    """Map data rows with walls around the edge and scattered inside, the start in the top left"""
+    rng = random.Random(seed)
+    rows = []
+    for y in range(height):
+        if y in (0, height - 1):
+            rows.append("#" * width)
+            continue
+        inside = "".join("#" if rng.random() < wall_chance else " "
+                         for _ in range(width - 2))
+        rows.append("#" + inside + "#")
+    rows[1] = "#S" + rows[1][2:]
+    return rows
+
+
+def make_map(height: int,
+             width: int,
+             wall_chance: float = 0.25,
+             seed: int = 0) -> maps.Map:
+    """A map made from make_rows, drawn the same as its map data"""
+    rows = make_rows(height, width, wall_chance, seed)
+    return maps.Map.from_list(list(rows), rows)
+
+
+@pytest.fixture
+def random_rows() -> Callable[..., List[str]]:
+    return make_rows
+
+
+@pytest.fixture
+def random_map() -> Callable[..., maps.Map]:
+    return make_map
@@ -0,0 +1,107 @@
+import pytest
+import enemies
+import rng_streams
+
+
+def test_strongest_skill():
+    assert enemies.Player(1, ["Punch"]).strongest_skill() == "Punch"
+    assert enemies.Player(
+        1, ["Punch", "Sword Strike"]).strongest_skill() == "Sword Strike"
+    assert enemies.Player(
+        1, ["Sword Strike", "Punch"]).strongest_skill() == "Sword Strike"
+
+
+def test_pool_views_share_stats():
+    pool = enemies.CombatantPool()
+    slimes = [enemies.Slime(3, num, pool) for num in range(1, 5)]
+    assert len(pool) == 4 and pool.alive_count == 4
+    slimes[1].hp = 0
+    slimes[3].hp -= 1000
+    assert not slimes[1].alive and slimes[0].alive
+    assert pool.alive_count == 2
+    assert pool.living() == [slimes[0], slimes[2]]
+    assert pool.view(2) is slimes[2]
+    assert pool.hp[0] == slimes[0].hp
+
+
+def test_attack_all_matches_one_attack_at_a_time():
+    for seed in range(20):
+        rng_streams.seed(seed)
+        pool = enemies.slime_wave(9, 6)
+        pool.view(2).hp = 0
+        player = enemies.Player(4, ["Punch"])
+        hits = pool.attack_all(player)
+
+        rng_streams.seed(seed)
+        slimes = enemies.slime_wave(9, 6)
+        slimes.view(2).hp = 0
+        target = enemies.Player(4, ["Punch"])
+        expected = []
+        for slime in slimes.living():
+            for _ in range(slime.turns):
+                hp = target.hp
+                slime.attack(target)
+                expected.append((slime.index, hp - target.hp))
+                if not target.alive:
+                    break
+            if not target.alive:
+                break
+        assert hits == expected
+        assert player.hp == target.hp
+        assert player.alive == target.alive
+
+
+def test_combat_log_keeps_newest_lines():
+    log = enemies.CombatLog(size=3)
+    for number in range(5):
+        log.add(f"Hit `b{number} `ndamage.")
+    assert list(log) == ["Hit 2 damage.", "Hit 3 damage.", "Hit 4 damage."]
+    assert len(log) == 3
+    assert log.dropped == 2
+
+
+@pytest.mark.parametrize("policy", list(enemies.AUTO_POLICIES.values()))
+def test_auto_battle_result_adds_up(policy):
+    for seed in range(20):
+        rng_streams.seed(seed)
+        player = enemies.Player(10, ["Punch", "Sword Strike"])
+        foes = enemies.slime_wave(4, 5)
+        foe_hp = sum(foes.hp)
+        log = enemies.CombatLog()
+        result = enemies.auto_battle(player,
+                                     foes,
+                                     policy,
+                                     "Sword Strike",
+                                     log=log)
+        assert result.won == (not foes.alive_count) == (player.hp > 0)
+        assert result.defeated == 5 - foes.alive_count
+        assert result.damage_taken == 10 * 6 + 15 - player.hp
+        assert result.damage_dealt == foe_hp - sum(foes.hp)
+        assert sum(line.endswith("has been defeated!")
+                   for line in log) == result.defeated
+        assert ("You have been defeated!" in log) == (not result.won)
+
+
+def test_auto_battle_stops_after_max_rounds():
+    player = enemies.Player(1, ["Punch"])
+    foes = enemies.CombatantPool()
+    enemies.Combatant("Wall", 10**6, 0, 1, 1, [""], foes)
+    result = enemies.auto_battle(player,
+                                 foes,
+                                 enemies.repeat_last_action,
+                                 "Punch",
+                                 max_rounds=7)
+    assert result.rounds == 7
+    assert not result.won and player.alive
+
+
+def test_lowest_hp_target():
+    foes = enemies.CombatantPool()
+    for hp in (9, 4, 6):
+        enemies.Combatant("Slime", hp, 1, 1, 1, [""], foes)
+    player = enemies.Player(1, ["Punch"])
+    assert enemies.lowest_hp_target(player, foes, "Punch",
+                                    None) == ("Punch", foes.view(1))
+    foes.view(1).hp = 0
+    assert enemies.lowest_hp_target(player, foes, "Punch",
+                                    None) == ("Punch", foes.view(2))
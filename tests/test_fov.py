@@ -0,0 +1,95 @@
+import random
+import fov
+import maps
+
+
+def floor_tiles(test_map):
+    return [(y, x) for y in range(test_map.height)
+            for x in range(test_map.width) if test_map.is_passable((y, x))]
+
+
+def visible_from(test_map, pos, radius=fov.FOV_RADIUS):
+    view = fov.FieldOfView(test_map, radius=radius)
+    view.update(pos)
+    return view.visible
+
+
+def test_sight_is_symmetric(random_map):
+    test_map = random_map(30, 30, wall_chance=0.3, seed=1)
+    tiles = floor_tiles(test_map)
+    seen = {tile: visible_from(test_map, tile) for tile in tiles}
+    for tile, visible in seen.items():
+        for other in visible:
+            if other in seen:
+                assert tile in seen[other], (tile, other)
+
+
+def test_walls_block_sight():
+    rows = ["#" * 9, "#   #   #", "#S  #   #", "#   #   #", "#" * 9]
+    test_map = maps.Map.from_list(list(rows), rows)
+    visible = visible_from(test_map, (2, 1))
+    assert (2, 4) in visible
+    assert not any(x > 4 for _, x in visible)
+
+
+def test_radius_limits_sight(random_map):
+    test_map = random_map(41, 41, wall_chance=0, seed=2)
+    visible = visible_from(test_map, (20, 20), radius=5)
+    assert (20, 25) in visible
+    assert all(max(abs(y - 20), abs(x - 20)) <= 5 for y, x in visible)
+
+
+def test_incremental_updates_match_fresh_scans(random_map):
+    test_map = random_map(40, 40, wall_chance=0.25, seed=3).layered()
+    rng = random.Random(4)
+    view = fov.FieldOfView(test_map)
+    pos = floor_tiles(test_map)[0]
+    for move in range(600):
+        y, x = pos
+        if move % 3 == 0:
+            # Open or close a door somewhere near the player
+            cell = (y + rng.randint(-4, 4), x + rng.randint(-4, 4))
+            inside = 0 < cell[0] < test_map.height - 1 and 0 < cell[
+                1] < test_map.width - 1
+            if inside and cell != pos:
+                opaque = test_map.is_passable(cell)
+                tile = "#" if opaque else " "
+                test_map.apply("doors", {cell: (tile, tile)})
+                view.set_opaque(cell, opaque)
+        else:
+            steps = [
+                step
+                for step in ((y - 1, x), (y + 1, x), (y, x - 1), (y, x + 1))
+                if test_map.is_passable(step)
+            ]
+            if steps and rng.random() < 0.8:
+                pos = rng.choice(steps)
+        view.update(pos)
+        assert view.visible == visible_from(test_map, pos), move
+
+
+def test_explored_keeps_what_was_seen(random_map):
+    test_map = random_map(30, 30, seed=5)
+    view = fov.FieldOfView(test_map)
+    seen = set()
+    for pos in floor_tiles(test_map)[:40:4]:
+        view.update(pos)
+        seen |= view.visible
+    explored = fov.decode_explored(fov.encode_explored(view.explored))
+    reloaded = fov.FieldOfView(test_map, explored)
+    for y in range(test_map.height):
+        for x in range(test_map.width):
+            assert reloaded.is_explored((y, x)) == ((y, x) in seen)
+
+
+def test_pop_changed_cells(random_map):
+    test_map = random_map(30, 30, seed=6)
+    view = fov.FieldOfView(test_map)
+    start, end = floor_tiles(test_map)[0], floor_tiles(test_map)[-1]
+    view.update(start)
+    before = set(view.visible)
+    view.pop_changed_cells()
+    view.update(end)
+    assert view.pop_changed_cells() == before ^ view.visible
+    view.update(end)
+    assert view.pop_changed_cells() == set()
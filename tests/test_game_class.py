@@ -0,0 +1,28 @@
+import pytest
+import game_class
+
+
+@pytest.mark.parametrize("name", ["autosave", "my save", "Ünïcode", "a.b"])
+def test_valid_save_names(name):
+    assert game_class.is_valid_save_name(name)
+
+
+@pytest.mark.parametrize(
+    "name",
+    ["", "   ", "..", "../bob/autosave", "a/b", "a\\b", "a\0b", "x" * 201])
+def test_invalid_save_names(name):
+    assert not game_class.is_valid_save_name(name)
+    with pytest.raises(ValueError):
+        game_class.Game.save_path(name)
+
+
+def test_save_round_trip(tmp_path):
+    game_class.set_save_dir(tmp_path / "alice")
+    try:
+        game = game_class.Game(4)
+        game.make_save("first")
+        with game_class.Game.save_path("first").open("r") as f:
+            loaded = game_class.Game.from_save(f.readlines())
+    finally:
+        game_class.set_save_dir(None)
+    assert loaded.save_data() == game.save_data()
@@ -0,0 +1,133 @@
+from pathlib import Path
+import pytest
+import chunks
+import maps
+
+MAP_DIR = Path(__file__).parent.parent / "maps"
+
+
+@pytest.fixture
+def compiled_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(maps, "COMPILED_DIR", tmp_path)
+    maps.clear_cache()
+    yield tmp_path
+    maps.clear_cache()
+
+
+def assert_same_map(loaded: maps.Map, expected: maps.Map):
+    assert (loaded.LINES, loaded.COLS) == (expected.LINES, expected.COLS)
+    assert loaded.as_list == expected.as_list
+    for y in range(expected.height):
+        for x in range(expected.width):
+            assert loaded.get_metamap_char(
+                (y, x)) == expected.get_metamap_char((y, x))
+            assert loaded.get_tile_class((y, x)) == expected.get_tile_class(
+                (y, x))
+    assert loaded.get_passability() == expected.get_passability()
+    for symbol in maps.INDEXED_SYMBOLS:
+        assert loaded.get_symbol_positions(
+            symbol) == expected.get_symbol_positions(symbol)
+
+
+def test_compiled_map_loads_equal_to_text(random_rows, tmp_path):
+    rows = random_rows(30, 45, seed=1)
+    rows[5] = rows[5][:10] + "e%&" + rows[5][13:]
+    tiles = [row.replace("#", "X") for row in rows]
+    original = maps.Map.from_list(tiles, rows)
+    path = tmp_path / "test.mapc"
+    original.compile(path)
+    assert_same_map(maps.Map.from_compiled(path), original)
+
+
+def test_compiled_map_rejects_other_files(tmp_path):
+    path = tmp_path / "test.mapc"
+    path.write_bytes(b"not a map at all")
+    with pytest.raises(ValueError):
+        maps.Map.from_compiled(path)
+
+
+def test_from_name_compiles_into_cache_folder(compiled_dir):
+    from_text = maps.Map.from_files(MAP_DIR / "cave.map",
+                                    MAP_DIR / "cave.mapdata")
+    first = maps.Map.from_name("cave")
+    compiled_path = maps.Map.compiled_path(MAP_DIR, "cave")
+    assert compiled_path.exists()
+    assert compiled_dir in compiled_path.parents
+    assert not (MAP_DIR / "cave.mapc").exists()
+    assert maps.Map.from_name("cave") is first
+    maps.clear_cache()
+    assert_same_map(maps.Map.from_name("cave"), from_text)
+
+
+def test_overlay_layers_stack_and_remove_cleanly():
+    overlays = maps.Overlays()
+    assert overlays.apply("items", {(1, 1): ("/", "%"), (1, 2): ("$", "&")})
+    assert overlays.apply("doors", {(1, 1): ("+", "#")}) == [(1, 1)]
+    assert overlays.cells == {(1, 1): ("+", "#"), (1, 2): ("$", "&")}
+    # Same value again changes nothing
+    assert overlays.apply("doors", {(1, 1): ("+", "#")}) == []
+    restored = maps.Overlays.from_json(overlays.to_json())
+    assert restored.cells == overlays.cells
+    assert overlays.remove("doors", [(1, 1), (5, 5)]) == [(1, 1)]
+    assert overlays.cells == {(1, 1): ("/", "%"), (1, 2): ("$", "&")}
+    assert "doors" not in overlays.layers
+    assert sorted(overlays.remove("items", [(1, 1), (1, 2)])) == [(1, 1),
+                                                                  (1, 2)]
+    assert overlays.cells == {} and overlays.layers == {}
+
+
+def test_overlay_cells_are_one_character():
+    with pytest.raises(ValueError):
+        maps.Overlays().apply("items", {(1, 1): ("ab", " ")})
+
+
+def test_layered_map_follows_overlays(random_rows):
+    rows = random_rows(12, 20, wall_chance=0, seed=2)
+    base = maps.Map.from_list(list(rows), rows)
+    with pytest.raises(ValueError):
+        base.apply("items", {(2, 3): ("/", "%")})
+    variant = base.layered()
+    version = variant.overlay_version
+    assert variant.apply("items", {
+        (2, 3): ("/", "%"),
+        (4, 5): ("#", "#")
+    }) == [(2, 3), (4, 5)]
+    assert variant.overlay_version > version
+    assert variant.row_text(2, 0, 6) == rows[2][:3] + "/" + rows[2][4:6]
+    assert variant.as_list[4][5] == "#"
+    assert variant.get_trigger((2, 3)) == 1
+    assert not variant.is_passable((4, 5))
+    assert variant.get_passability()[4 * variant.width + 5] == 0
+    assert variant.get_symbol_positions("%") == [(2, 3)]
+    # The shared map underneath doesn't change
+    assert base.as_list == rows
+    assert base.is_passable((4, 5))
+
+    variant.remove("items", [(2, 3), (4, 5)])
+    assert variant.as_list == rows
+    assert variant.row_text(2, 0, 20) == rows[2]
+    assert variant.get_passability() == base.get_passability()
+    assert variant.get_symbol_positions("%") == []
+    assert variant._overlay_rows == {}
+
+
+def test_world_overlays_match_map_overlays(random_rows, tmp_path):
+    rows = random_rows(40, 50, wall_chance=0.2, seed=3)
+    path = tmp_path / "test.mapw"
+    chunks.write_world(path, ((row, row) for row in rows),
+                       len(rows),
+                       len(rows[0]),
+                       chunk_size=16)
+    world = chunks.ChunkedMap(path).layered()
+    try:
+        variant = maps.Map.from_list(list(rows), rows).layered()
+        cells = {(y, 2 * y): ("%", "%") for y in range(1, 39)}
+        for layered in (world, variant):
+            layered.apply("items", cells)
+            layered.remove("items", list(cells)[::2])
+        for y in range(40):
+            assert world.row_text(y, 0, 50) == variant.row_text(y, 0, 50)
+            for x in range(50):
+                assert world.is_passable((y, x)) == variant.is_passable((y, x))
+    finally:
+        world.close()
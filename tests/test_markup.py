@@ -0,0 +1,54 @@
+import curses
+import random
+import pytest
+import markup
+
+
+def test_runs_follow_tags():
+    compiled = markup.compile_text("You hit `bSlime 1 `nfor `i3`n.")
+    assert compiled.runs == ((curses.A_NORMAL, "You hit "), (curses.A_BOLD,
+                                                             "Slime 1 "),
+                             (curses.A_NORMAL, "for "), (curses.A_ITALIC, "3"),
+                             (curses.A_NORMAL, "."))
+    assert compiled.length == len("You hit Slime 1 for 3.")
+    assert not compiled.invalid_tags
+
+
+def test_invalid_tag_is_flagged_and_dropped():
+    compiled = markup.compile_text("a`xb")
+    assert compiled.invalid_tags
+    assert markup.plain_text("a`xb") == "ab"
+
+
+@pytest.mark.parametrize("width", [2, 5, 12, 40])
+def test_wrap_keeps_lines_short_and_words_whole(width):
+    rng = random.Random(width)
+    words = [
+        "".join(rng.choice("abc") for _ in range(rng.randint(1, 8)))
+        for _ in range(200)
+    ]
+    text = " ".join(words)
+    wrapped = "".join(run for _, run in markup.compile_text(text, width).runs)
+    assert wrapped.replace("\n", " ") == text
+    for line in wrapped.split("\n"):
+        # Only lines with a word longer than a line (left for curses to wrap) may stick out
+        assert len(line) <= width - 1 or any(
+            len(word) > width - 1 for word in line.split(" "))
+    if width > 8:
+        assert wrapped.split() == words
+
+
+def test_wrap_restarts_at_newlines():
+    chars = list("aaaa\nbb bb bb")
+    markup._wrap(chars, 7)
+    assert "".join(chars) == "aaaa\nbb bb\nbb"
+
+
+def test_slice_runs():
+    compiled = markup.compile_text("ab`bcd`nef`ugh")
+    text = "".join(run for _, run in compiled.runs)
+    for start in range(len(text) + 1):
+        for end in range(start, len(text) + 1):
+            sliced = markup.slice_runs(compiled.runs, start, end)
+            assert "".join(run for _, run in sliced) == text[start:end]
+            assert start == end or all(run for _, run in sliced)
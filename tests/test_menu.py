@@ -0,0 +1,74 @@
+import curses
+import random
+import pytest
+import io_functs
+import terminal
+
+OPTIONS = [
+    "Punch", "pull lever", "Sword Strike", "Save", "sAVE as", "Exit", ""
+]
+
+
+def matching(options, query):
+    return sorted((option.lower(), index)
+                  for index, option in enumerate(options)
+                  if option.lower().startswith(query.lower()))
+
+
+def test_prefix_index_matches_filter():
+    rng = random.Random(3)
+    options = [
+        "".join(rng.choice("abAB ") for _ in range(rng.randint(0, 5)))
+        for _ in range(300)
+    ]
+    index = io_functs.PrefixIndex(options)
+    for _ in range(200):
+        if index.query and rng.random() < 0.4:
+            index.pop()
+        else:
+            index.push(rng.choice("abAB "))
+        expected = matching(options, index.query)
+        assert [index[i] for i in range(len(index))
+                ] == [option_index for _, option_index in expected]
+
+
+def test_prefix_index_pops_back_to_everything():
+    index = io_functs.PrefixIndex(OPTIONS)
+    for char in "sav":
+        index.push(char)
+    assert sorted(OPTIONS[index[i]]
+                  for i in range(len(index))) == ["Save", "sAVE as"]
+    index.push("x")
+    assert len(index) == 0
+    for _ in range(10):
+        index.pop()
+    assert index.query == ""
+    assert len(index) == len(OPTIONS)
+
+
+def run_menu(keys, options=OPTIONS):
+    chosen = []
+    terminal.run_headless(
+        lambda stdscr: chosen.append(io_functs.menu(options, "Pick")), keys)
+    return chosen
+
+
+@pytest.mark.parametrize("keys, expected", [
+    (["\n"], "Punch"),
+    (["jj\n"], "Sword Strike"),
+    (["/sw\n"], "Sword Strike"),
+    (["/save", "\n"], "Save"),
+    (["/sa", 127, 127, "e\n"], "Exit"),
+    (["/p", 27, "j\n"], "pull lever"),
+])
+def test_menu_choice(keys, expected):
+    assert run_menu(keys) == [expected]
+
+
+def test_menu_scrolls_long_lists():
+    options = [f"Option {number}" for number in range(100)]
+    assert run_menu(["j" * 60 + "\n"], options) == ["Option 60"]
+    # Letters typed while filtering are part of the filter, so only the arrow keys move
+    assert run_menu(["/option 9j\n"], options) == []
+    assert run_menu(["/option 9", curses.KEY_DOWN, "\n"],
+                    options) == ["Option 90"]
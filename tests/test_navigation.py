@@ -0,0 +1,175 @@
+import gc
+import random
+import weakref
+from collections import deque
+from typing import Dict, Optional
+import chunks
+import entities
+import maps
+import navigation
+
+
+def bfs(nav: navigation.Navigator,
+        goal: navigation.Pos) -> Dict[navigation.Pos, int]:
+    """Steps from every tile that can reach goal, worked out the slow way"""
+    distances = {goal: 0}
+    queue = deque([goal])
+    while queue:
+        y, x = queue.popleft()
+        for step in ((y - 1, x), (y + 1, x), (y, x - 1), (y, x + 1)):
+            if nav.is_passable(step) and step not in distances:
+                distances[step] = distances[(y, x)] + 1
+                queue.append(step)
+    return distances
+
+
+def floor_tiles(nav: navigation.Navigator):
+    return [(y, x) for y in range(nav.height) for x in range(nav.width)
+            if nav.is_passable((y, x))]
+
+
+def check_field(nav: navigation.Navigator,
+                field: navigation.DistanceField,
+                goal: navigation.Pos,
+                max_distance: Optional[int] = None):
+    expected = bfs(nav, goal)
+    for tile in floor_tiles(nav):
+        distance = expected.get(tile)
+        if max_distance is not None and distance is not None and distance > max_distance:
+            distance = None
+        assert field.distance(tile) == distance, tile
+
+
+def test_field_matches_bfs(random_map):
+    nav = navigation.Navigator(random_map(30, 40, seed=1))
+    goal = floor_tiles(nav)[50]
+    check_field(nav, navigation.DistanceField(nav._passable, nav.width,
+                                              [goal]), goal)
+
+
+def test_move_goal_matches_fresh_field(random_map):
+    nav = navigation.Navigator(random_map(25, 35, wall_chance=0.2, seed=2))
+    rng = random.Random(3)
+    pos = floor_tiles(nav)[0]
+    field = nav.player_field(pos)
+    limited = nav.player_field(pos, max_distance=6)
+    for move in range(500):
+        if move % 97 == 0:
+            # Jumps, like the player arriving on the map somewhere else
+            pos = rng.choice(floor_tiles(nav))
+        else:
+            y, x = pos
+            steps = [
+                step
+                for step in ((y - 1, x), (y + 1, x), (y, x - 1), (y, x + 1))
+                if nav.is_passable(step)
+            ]
+            if steps:
+                pos = rng.choice(steps)
+        assert nav.player_field(pos) is field
+        nav.player_field(pos, max_distance=6)
+        if move % 25 == 0:
+            check_field(nav, field, pos)
+            check_field(nav, limited, pos, max_distance=6)
+
+
+def test_next_step_goes_downhill(random_map):
+    nav = navigation.Navigator(random_map(20, 30, seed=4))
+    goal = floor_tiles(nav)[-1]
+    field = nav.field_to([goal])
+    for tile in floor_tiles(nav):
+        distance = field.distance(tile)
+        step = field.next_step(tile)
+        if distance is None or distance == 0:
+            assert step is None
+        else:
+            assert field.distance(step) == distance - 1
+            assert abs(step[0] - tile[0]) + abs(step[1] - tile[1]) == 1
+
+
+def test_find_path_is_shortest(random_map):
+    nav = navigation.Navigator(random_map(30, 30, wall_chance=0.3, seed=5))
+    rng = random.Random(6)
+    tiles = floor_tiles(nav)
+    for _ in range(50):
+        start, goal = rng.choice(tiles), rng.choice(tiles)
+        path = nav.find_path(start, goal)
+        expected = bfs(nav, goal).get(start)
+        if expected is None:
+            assert path is None
+            continue
+        assert path is not None
+        assert path[0] == start and path[-1] == goal
+        assert len(path) == expected + 1
+        for a, b in zip(path, path[1:]):
+            assert nav.is_passable(b)
+            assert abs(a[0] - b[0]) + abs(a[1] - b[1]) == 1
+
+
+def test_find_path_into_wall(random_map):
+    nav = navigation.Navigator(random_map(10, 10, seed=7))
+    assert nav.find_path((1, 1), (0, 0)) is None
+
+
+def test_paths_follow_overlay_changes():
+    rows = ["#####", "#S#e#", "#####"]
+    door_map = maps.Map.from_list(list(rows), rows).layered()
+    world = entities.World.from_map(door_map)
+    assert world.navigator.find_path((1, 1), (1, 3)) is None
+    door_map.apply("doors", {(1, 2): (" ", " ")})
+    assert world.navigator.find_path((1, 1), (1, 3)) == [(1, 1), (1, 2),
+                                                         (1, 3)]
+    assert navigation.get_navigator(door_map) is world.navigator
+
+
+def test_world_fields_match_map_fields(random_rows, tmp_path):
+    rows = random_rows(70, 90, wall_chance=0.2, seed=8)
+    path = tmp_path / "test.mapw"
+    chunks.write_world(path, ((row, row) for row in rows),
+                       len(rows),
+                       len(rows[0]),
+                       chunk_size=16)
+    world = chunks.ChunkedMap(path)
+    try:
+        nav = navigation.Navigator(maps.Map.from_list(list(rows), rows))
+        world_nav = navigation.get_navigator(world)
+        rng = random.Random(9)
+        for pos in rng.sample(floor_tiles(nav), 20):
+            field = nav.player_field(pos, max_distance=8)
+            world_field = world_nav.player_field(pos, max_distance=8)
+            for tile in floor_tiles(nav):
+                assert world_field.distance(tile) == field.distance(tile)
+                if field.distance(tile):
+                    step = world_field.next_step(tile)
+                    assert field.distance(step) == field.distance(tile) - 1
+    finally:
+        world.close()
+
+
+def test_chasers_move_on_worlds(random_rows, tmp_path):
+    rows = random_rows(40, 40, wall_chance=0, seed=10)
+    path = tmp_path / "test.mapw"
+    chunks.write_world(path, ((row, row) for row in rows), 40, 40)
+    world_map = chunks.ChunkedMap(path)
+    try:
+        world = entities.World.from_map(world_map)
+        world.add(entities.Entity("player", (20, 20)))
+        chaser = world.add(
+            entities.Chaser("slime", (20, 26), "s", tick_interval=1))
+        world.advance(3)
+        assert chaser.pos == (20, 23)
+    finally:
+        world_map.close()
+
+
+def test_world_navigator_lets_world_be_freed(random_rows, tmp_path):
+    rows = random_rows(20, 20, seed=11)
+    path = tmp_path / "test.mapw"
+    chunks.write_world(path, ((row, row) for row in rows), 20, 20)
+    world = chunks.ChunkedMap(path)
+    navigation.get_navigator(world)
+    world_ref = weakref.ref(world)
+    world.close()
+    del world
+    gc.collect()
+    assert world_ref() is None
@@ -0,0 +1,18 @@
+from pathlib import Path
+import struct
+import recording
+
+
+def test_trace_round_trip(tmp_path: Path):
+    trace = recording.Trace(1234, [ord("w"), 27, 10], "state", True)
+    path = tmp_path / "session.trace"
+    trace.write(path)
+    assert recording.Trace.read(path) == trace
+
+
+def test_version_1_trace_is_not_profiled(tmp_path: Path):
+    path = tmp_path / "old.trace"
+    path.write_bytes(
+        struct.pack("<4sHQII", recording.TRACE_MAGIC, 1, 7, 1, 2) +
+        struct.pack("<H", 27) + b"ok")
+    assert recording.Trace.read(path) == recording.Trace(7, [27], "ok", False)
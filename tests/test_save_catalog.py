@@ -0,0 +1,88 @@
+import os
+import shutil
+import save_catalog
+import save_service
+
+
+def write_save(folder, name, story_progress=1, level=1):
+    (folder / f"{name}.save").write_text(f"{story_progress}\n{level}\nPunch\n")
+
+
+def names(catalog):
+    return sorted(entry.name for entry in catalog.entries())
+
+
+def test_rebuilds_from_save_files(tmp_path):
+    write_save(tmp_path, "a", 3, 7)
+    write_save(tmp_path, "b")
+    catalog = save_catalog.SaveCatalog(tmp_path)
+    assert names(catalog) == ["a", "b"]
+    entry = catalog.get("a")
+    assert (entry.story_progress, entry.level) == (3, 7)
+
+
+def test_updates_in_place(tmp_path):
+    catalog = save_catalog.SaveCatalog(tmp_path)
+    for level in range(5):
+        write_save(tmp_path, "a", level=level)
+        catalog.update("a", 1, level)
+    assert catalog.get("a").level == 4
+    assert os.path.getsize(tmp_path /
+                           save_catalog.INDEX_NAME) == save_catalog.RECORD.size
+    # A new catalog reads the same entries back from the index
+    assert save_catalog.SaveCatalog(tmp_path).get("a") == catalog.get("a")
+
+
+def test_notices_files_changed_outside(tmp_path):
+    write_save(tmp_path, "a")
+    write_save(tmp_path, "b")
+    catalog = save_catalog.SaveCatalog(tmp_path)
+    assert names(catalog) == ["a", "b"]
+    (tmp_path / "b.save").unlink()
+    shutil.copy(tmp_path / "a.save", tmp_path / "c.save")
+    # Make sure the folder looks changed even on file systems with coarse timestamps
+    stat = tmp_path.stat()
+    os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert names(catalog) == ["a", "c"]
+
+
+def test_reuses_removed_records(tmp_path):
+    catalog = save_catalog.SaveCatalog(tmp_path)
+    for name in "abc":
+        write_save(tmp_path, name)
+        catalog.update(name, 1, 1)
+    (tmp_path / "b.save").unlink()
+    catalog.remove("b")
+    write_save(tmp_path, "d")
+    catalog.update("d", 1, 1)
+    assert names(catalog) == ["a", "c", "d"]
+    assert os.path.getsize(
+        tmp_path / save_catalog.INDEX_NAME) == 3 * save_catalog.RECORD.size
+    assert names(save_catalog.SaveCatalog(tmp_path)) == ["a", "c", "d"]
+
+
+def test_sorts_and_filters(tmp_path):
+    catalog = save_catalog.SaveCatalog(tmp_path)
+    for timestamp, name in enumerate(["b1", "a1", "b2"]):
+        write_save(tmp_path, name)
+        catalog.update(name, 1, 1, timestamp=timestamp + 1)
+    assert [entry.name for entry in catalog.entries()] == ["b2", "a1", "b1"]
+    assert [entry.name for entry in catalog.entries(sort_by="name")
+            ] == ["a1", "b1", "b2"]
+    assert [entry.name
+            for entry in catalog.entries(prefix="b")] == ["b2", "b1"]
+
+
+def test_own_saves_dont_rescan_folder(tmp_path, monkeypatch):
+    catalog = save_catalog.SaveCatalog(tmp_path)
+    write_save(tmp_path, "a")
+    assert names(catalog) == ["a"]
+    syncs = []
+    sync = save_catalog.SaveCatalog._sync
+    monkeypatch.setattr(save_catalog.SaveCatalog, "_sync",
+                        lambda self: syncs.append(1) or sync(self))
+    for name in "bc":
+        save_service.write_atomic(tmp_path / f"{name}.save", "1\n1\nPunch\n")
+        catalog.update(name, 1, 1)
+    assert names(catalog) == ["a", "b", "c"]
+    assert not syncs
@@ -0,0 +1,28 @@
+import threading
+import save_service
+
+
+def test_write_atomic_makes_folder_and_leaves_no_temp_files(tmp_path):
+    path = tmp_path / "new" / "game.save"
+    save_service.write_atomic(path, "data")
+    assert path.read_text() == "data"
+    assert [p.name for p in path.parent.iterdir()] == ["game.save"]
+
+
+def test_concurrent_writes_never_mix(tmp_path):
+    path = tmp_path / "autosave.save"
+    contents = [str(i) * 100_000 for i in range(4)]
+
+    def write(data):
+        for _ in range(20):
+            save_service.write_atomic(path, data)
+
+    threads = [
+        threading.Thread(target=write, args=(data, )) for data in contents
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert path.read_text() in contents
+    assert [p.name for p in tmp_path.iterdir()] == ["autosave.save"]
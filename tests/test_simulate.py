@@ -0,0 +1,37 @@
+import pytest
+import enemies
+import rng_streams
+import simulate
+
+
+@pytest.mark.parametrize("lvl, count, skill", [(1, 3, "Punch"),
+                                               (2, 1, "Sword Strike"),
+                                               (5, 2, "Punch"),
+                                               (12, 3, "Sword Strike")])
+def test_one_fight_matches_auto_battle(lvl, count, skill):
+    for seed in range(20):
+        result = simulate.simulate(lvl, lvl, count, 1, skill, seed)
+        rng_streams.seed(seed)
+        player = enemies.Player(lvl, [skill])
+        battle = enemies.auto_battle(player,
+                                     enemies.slime_wave(lvl, count),
+                                     enemies.repeat_last_action,
+                                     skill,
+                                     max_rounds=1000)
+        assert result.wins == battle.won
+        if battle.won:
+            assert result.rounds == {battle.rounds: 1}
+            assert result.hp_left == [player.hp]
+
+
+def test_batches_are_reproducible():
+    first = simulate.simulate(3, 2, fights=200, seed=4)
+    second = simulate.simulate(3, 2, fights=200, seed=4)
+    assert first == second
+    assert 0 < first.wins <= 200
+    assert sum(first.rounds.values()) == first.wins == len(first.hp_left)
+
+
+def test_unknown_skill():
+    with pytest.raises(ValueError):
+        simulate.simulate(1, 1, skill="Kick")
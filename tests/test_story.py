@@ -0,0 +1,97 @@
+import os
+import pytest
+import story
+
+SCRIPT = """\
+# A test chapter
+section first
+    print Hello
+    choice Which way?
+        option Left
+            print You went left.
+        option Right
+            grant Sword Strike
+    advance
+
+section second
+    map cave
+        on 1
+            take
+            swap_map cave_no_sword
+    battle slime 2 3
+    end
+"""
+
+
+def test_compiles_blocks_to_jumps():
+    first, second = story.compile_script(SCRIPT)
+    assert first == ("first", (
+        ("print", "Hello"),
+        ("choice", "Which way?", ("Left", "Right"), (2, 4)),
+        ("print", "You went left."),
+        ("jump", 6),
+        ("grant", "Sword Strike"),
+        ("jump", 6),
+        ("advance", ),
+    ))
+    assert second == ("second", (
+        ("map", "cave", {
+            1: 1
+        }, 4),
+        ("take", ),
+        ("swap_map", "cave_no_sword"),
+        ("return", ),
+        ("battle", "slime", 2, 3),
+        ("end", ),
+    ))
+
+
+@pytest.mark.parametrize("script, line", [
+    ("section a\n    jump 3\n    advance\n", 2),
+    ("section a\n    take\n    advance\n", 2),
+    ("section a\n    option Left\n    advance\n", 2),
+    ("section a\n    choice Pick\n    advance\n", 2),
+    ("section a\n    battle slime two 3\n    advance\n", 2),
+    ("section a\n    print Hi\n", 1),
+])
+def test_reports_the_bad_line(script, line):
+    with pytest.raises(story.StoryError, match=f"test.story:{line}:"):
+        story.compile_script(script, "test.story")
+
+
+def test_storyc_round_trip(tmp_path):
+    script_path = tmp_path / "test.story"
+    compiled_path = tmp_path / "test.storyc"
+    script_path.write_text(SCRIPT)
+    expected = story.compile_script(SCRIPT)
+    assert story._compile_chapter(script_path, compiled_path) == expected
+    assert compiled_path.read_bytes().startswith(story.STORYC_MAGIC)
+    # Loading again has to use the compiled file, not the script
+    script_path.write_text("not a story")
+    stat = compiled_path.stat()
+    os.utime(script_path, ns=(stat.st_atime_ns, stat.st_mtime_ns - 10**9))
+    assert story._compile_chapter(script_path, compiled_path) == expected
+
+
+def test_broken_storyc_is_compiled_again(tmp_path):
+    script_path = tmp_path / "test.story"
+    compiled_path = tmp_path / "test.storyc"
+    script_path.write_text(SCRIPT)
+    compiled_path.write_bytes(story.STORYC_MAGIC + b"\x01\x00garbage")
+    assert story._compile_chapter(
+        script_path, compiled_path) == story.compile_script(SCRIPT)
+
+
+def test_sections_span_chapters(tmp_path):
+    (tmp_path / story.CHAPTER_INDEX).write_text("0 one\n2 two\n")
+    (tmp_path / "one.story").write_text(SCRIPT)
+    (tmp_path / "two.story").write_text("section third\n    end\n")
+    chapters = story.Story(tmp_path)
+    assert [chapters.section(progress)[0]
+            for progress in range(3)] == ["first", "second", "third"]
+    assert chapters.section(3) is None
+
+
+def test_game_story_compiles():
+    chapters = story.Story()
+    assert chapters.section(0) is not None
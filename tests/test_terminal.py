@@ -0,0 +1,46 @@
+import curses
+import pytest
+import terminal
+
+IAC = terminal.IAC
+
+
+@pytest.mark.parametrize("data, keys", [
+    (b"wasd", list(b"wasd")),
+    (b"\x1b[A\x1b[B\x1b[C\x1b[D",
+     [curses.KEY_UP, curses.KEY_DOWN, curses.KEY_RIGHT, curses.KEY_LEFT]),
+    (b"\x1bOA", [curses.KEY_UP]),
+    (b"\x1bq", [27, ord("q")]),
+    (b"\x1b[1;5A", []),
+    (b"\r\n\r\0\r", [10, 10, 10]),
+    (bytes([IAC, IAC]), [IAC]),
+    (bytes([IAC, 253, 1]) + b"x", [ord("x")]),
+    (bytes([IAC, 241]) + b"x", [ord("x")]),
+    (bytes([IAC, 250, 31, 0, 80, 0, 24, IAC, 240]) + b"x", [ord("x")]),
+])
+def test_decode_keys(data, keys):
+    buffer = bytearray(data)
+    assert terminal.decode_keys(buffer) == keys
+    assert buffer == bytearray()
+
+
+@pytest.mark.parametrize(
+    "data, first_cut",
+    [
+        # A lone escape at the end of a read is the escape key
+        (b"\x1b[A", 2),
+        (b"\x1b[1;5A", 2),
+        (bytes([IAC, 253, 1]), 1),
+        (bytes([IAC, 250, 31, 0, 80, 0, 24, IAC, 240]), 1),
+    ])
+def test_split_sequences_wait_for_the_rest(data, first_cut):
+    """Sequences cut off at the end of a read are kept until the rest arrives"""
+    whole = terminal.decode_keys(bytearray(data + b"x"))
+    for cut in range(first_cut, len(data)):
+        buffer = bytearray(data[:cut])
+        keys = terminal.decode_keys(buffer)
+        assert buffer == bytearray(data[:cut])
+        buffer += data[cut:] + b"x"
+        keys += terminal.decode_keys(buffer)
+        assert keys == whole
+        assert buffer == bytearray()